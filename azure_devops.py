@@ -0,0 +1,248 @@
+import base64
+from pathlib import Path
+from typing import Iterable
+
+import niquests
+from loguru import logger
+from niquests.auth import HTTPBasicAuth
+
+from config import settings
+from http_client import get_session
+from metrics import span
+from mirror_cache import get_mirror_cache
+from models import BitbucketRepo, MigrationResult, MigrationStatus, TrackedMigration
+from retry import REJECTED_STATUSES, AdaptiveLimiter, RetryPolicy, request_with_retry
+from scheduler import run_migration
+from state_store import MigrationStateStore
+from targets import MigrationTarget
+
+AZURE_API_VERSION = "7.1"
+
+# Final states of an Azure DevOps import request, "queued" and "inProgress" are still running
+IMPORT_FINAL_STATUSES = {
+    "completed": MigrationStatus.DONE,
+    "failed": MigrationStatus.FAILED,
+    "abandoned": MigrationStatus.FAILED,
+}
+
+# Creating a repository or an import request is not idempotent
+SUBMIT_RETRY_POLICY = RetryPolicy(statuses=REJECTED_STATUSES)
+
+
+class AzureDevOpsClient:
+    """
+    Azure DevOps Git API of one project, over a shared keep-alive session.
+
+    The project ID and the IDs of the existing repositories are fetched once and kept.
+    """
+
+    def __init__(self, organization: str | None = None, project: str | None = None, token: str | None = None):
+        self.organization = organization or settings.AZURE_DEVOPS_ORGANIZATION
+        self.project = project or settings.AZURE_DEVOPS_PROJECT
+        self.base_url = f"{(settings.AZURE_DEVOPS_URL or 'https://dev.azure.com').rstrip('/')}/{self.organization}"
+        self.repositories_url = f"{self.base_url}/{self.project}/_apis/git/repositories"
+        self.auth = HTTPBasicAuth("", token or settings.AZURE_DEVOPS_TOKEN)
+        self.auth_header = f"Authorization: Basic {base64.b64encode(f':{token or settings.AZURE_DEVOPS_TOKEN}'.encode()).decode()}"
+        self.headers = {"Content-Type": "application/json", "Accept": "application/json"}
+        self.session = get_session(self.base_url)
+        self.limiter = AdaptiveLimiter(self.base_url, settings.AZURE_DEVOPS_CONCURRENCY)
+        self._project_id: str | None = None
+        self._repository_ids: dict[str, str] | None = None
+
+    def request(self, method: str, url: str, policy: RetryPolicy | None = None, **kwargs) -> niquests.Response:
+        separator = "&" if "?" in url else "?"
+        return request_with_retry(
+            self.session,
+            method,
+            f"{url}{separator}api-version={AZURE_API_VERSION}",
+            policy=policy,
+            limiter=self.limiter,
+            headers=self.headers,
+            auth=self.auth,
+            **kwargs,
+        )
+
+    @property
+    def project_id(self) -> str:
+        if self._project_id is None:
+            with span("azure.project_lookup"):
+                response = self.request("GET", f"{self.base_url}/_apis/projects/{self.project}")
+            if response.status_code != 200:
+                logger.error(f"Failed to retrieve project ID for '{self.project}'. Status Code: {response.status_code}, Message: {response.text}")
+                response.raise_for_status()
+                raise RuntimeError(f"Failed to retrieve project ID for '{self.project}': {response.status_code}")
+            self._project_id = response.json()["id"]
+        return self._project_id  # type: ignore
+
+    @property
+    def repository_ids(self) -> dict[str, str]:
+        """
+        IDs of the project's repositories by lowercase name, listed in one request.
+        """
+        if self._repository_ids is None:
+            with span("azure.repository_list"):
+                response = self.request("GET", self.repositories_url)
+            response.raise_for_status()
+            self._repository_ids = {repo["name"].lower(): repo["id"] for repo in response.json()["value"]}
+            logger.info(f"Found {len(self._repository_ids)} repositories in Azure DevOps project '{self.project}'")
+        return self._repository_ids
+
+    def ensure_repository(self, repo_name: str) -> str | None:
+        """
+        Return the ID of the repository, creating it when it does not exist yet.
+        """
+        if repo_id := self.repository_ids.get(repo_name.lower()):
+            return repo_id
+
+        payload = {"name": repo_name, "project": {"id": self.project_id}}
+        with span("azure.repository_create") as create_span:
+            response = self.request("POST", self.repositories_url, policy=SUBMIT_RETRY_POLICY, json=payload)
+            create_span.error = response.status_code not in (201, 409)
+        if response.status_code == 201:
+            logger.success(f"Repository '{repo_name}' created successfully.")
+            repo_id = response.json()["id"]
+        elif response.status_code == 409:
+            # Created by someone else since the listing
+            response = self.request("GET", f"{self.repositories_url}/{repo_name}")
+            repo_id = response.json()["id"] if response.status_code == 200 else None
+        else:
+            logger.error(f"Failed to create repository '{repo_name}'. Status Code: {response.status_code}, Message: {response.text}")
+            return None
+
+        if repo_id:
+            self.repository_ids[repo_name.lower()] = repo_id
+        return repo_id
+
+    def delete_repository(self, repo_name: str) -> bool:
+        """
+        Delete the repository if it exists. Azure DevOps keeps it in the recycle bin.
+        """
+        repo_id = self.repository_ids.get(repo_name.lower())
+        if repo_id is None:
+            return True
+        with span("azure.repository_delete") as delete_span:
+            response = self.request("DELETE", f"{self.repositories_url}/{repo_id}")
+            delete_span.error = response.status_code not in (204, 404)
+        if response.status_code not in (204, 404):
+            logger.error(f"Failed to delete repository '{repo_name}'. Status Code: {response.status_code}, Message: {response.text}")
+            return False
+        del self.repository_ids[repo_name.lower()]
+        return True
+
+    def submit_import(self, repo_id: str, source_url: str) -> int | None:
+        """
+        Create an import request from an external Git source, returning its ID.
+        """
+        payload = {"parameters": {"gitSource": {"url": source_url, "username": settings.BITBUCKET_USERNAME, "password": settings.BITBUCKET_PASSWORD}}}
+        with span("azure.import_submit") as submit_span:
+            response = self.request("POST", f"{self.repositories_url}/{repo_id}/importRequests", policy=SUBMIT_RETRY_POLICY, json=payload)
+            submit_span.error = response.status_code != 201
+        if response.status_code == 201:
+            logger.success(f"Import request for repository ID '{repo_id}' created successfully.")
+            return response.json()["importRequestId"]
+        logger.error(f"Failed to create import request for repository ID '{repo_id}'. Status Code: {response.status_code}, Message: {response.text}")
+        return None
+
+    def import_status_url(self, repo_id: str, request_id: int) -> str:
+        return f"{self.repositories_url}/{repo_id}/importRequests/{request_id}?api-version={AZURE_API_VERSION}"
+
+
+class AzureDevOpsTarget(MigrationTarget):
+    """
+    Azure DevOps import requests: `migrate` creates the repository when needed and
+    submits the import, `poll` checks all running imports in one multiplexed wave.
+    """
+
+    name = "azure"
+    asynchronous = True
+
+    def __init__(self, client: AzureDevOpsClient | None = None):
+        self.client = client or AzureDevOpsClient()
+        self.poll_interval = settings.AZURE_DEVOPS_POLL_INTERVAL
+        self._requests: dict[str, tuple[str, int]] = {}  # state key -> (repository ID, import request ID)
+        self.mirror_cache = get_mirror_cache()
+
+    @property
+    def concurrency(self) -> int:
+        return settings.AZURE_DEVOPS_CONCURRENCY
+
+    def prepare(self):
+        logger.info(f"Importing into Azure DevOps project '{self.client.project}' ({self.client.project_id})")
+        self.client.repository_ids  # list the existing repositories before the workers start
+
+    def plan(self, repo: BitbucketRepo) -> str:
+        if repo.newname.lower() in self.client.repository_ids:
+            return "into existing Azure DevOps repositories"
+        return "to create and import"
+
+    def migrate(self, repo: BitbucketRepo, replace_existing: bool = False) -> MigrationResult:
+        """
+        Push from the mirror cache when it is enabled, otherwise (and always for LFS
+        repositories, whose objects a git push would leave behind) submit an import request.
+
+        With `replace_existing`, a push overwrites the branches and tags (pruning the
+        others), while an import, which needs an empty repository, recreates it first.
+        """
+        logger.info(f"Processing repository: '{repo.newname}' from '{repo.link}'")
+        push = self.mirror_cache is not None and not repo.lfs
+        if replace_existing and not push and not self.client.delete_repository(repo.newname):
+            return MigrationResult(MigrationStatus.FAILED, error="existing repository not deleted")
+        repo_id = self.client.ensure_repository(repo.newname)
+        if not repo_id:
+            return MigrationResult(MigrationStatus.FAILED, error="repository not created")
+
+        if push:
+            # Push from the local mirror instead of having Azure DevOps clone from Bitbucket
+            with span("azure.push") as push_span:
+                error = self.mirror_cache.push(repo, f"{self.client.base_url}/{self.client.project}/_git/{repo.newname}", self.client.auth_header)  # type: ignore
+                push_span.error = error is not None
+            if error:
+                logger.error(f"Failed to push {repo.newname} to Azure DevOps: {error}")
+                return MigrationResult(MigrationStatus.FAILED, error=error)
+            return MigrationResult(MigrationStatus.DONE)
+
+        request_id = self.client.submit_import(repo_id, repo.link)
+        if request_id is None:
+            return MigrationResult(MigrationStatus.FAILED, error="import request not created")
+        self._requests[self.key(repo)] = (repo_id, request_id)
+        return MigrationResult(MigrationStatus.IN_PROGRESS, 201)
+
+    def poll(self, tracked: list[TrackedMigration]) -> dict[str, MigrationResult]:
+        session = get_session(self.client.base_url, multiplexed=True)
+        with span("azure.poll_wave"):
+            responses = [
+                (migration, session.get(self.client.import_status_url(*self._requests[migration.key]), headers=self.client.headers, auth=self.client.auth))  # type: ignore
+                for migration in tracked
+            ]
+            session.gather()
+
+        results: dict[str, MigrationResult] = {}
+        for migration, response in responses:
+            if response.status_code != 200:
+                logger.warning(f"Unexpected status while polling import of '{migration.repo.newname}': {response.status_code}")
+                continue
+            data = response.json()
+            status = data.get("status", "")
+            if status in IMPORT_FINAL_STATUSES:
+                error = (data.get("detailedStatus") or {}).get("errorMessage") or ""
+                results[migration.key] = MigrationResult(IMPORT_FINAL_STATUSES[status], response.status_code, error or ("" if status == "completed" else status))
+                del self._requests[migration.key]
+        return results
+
+
+def import_repositories(repositories: Iterable[BitbucketRepo], client: AzureDevOpsClient | None = None, state: MigrationStateStore | None = None):
+    """
+    Import the repositories into Azure DevOps.
+
+    The project ID and the existing repositories are resolved once, the import requests
+    are submitted concurrently (AZURE_DEVOPS_CONCURRENCY) and then polled until done.
+    """
+    run_migration(AzureDevOpsTarget(client), repositories, state or MigrationStateStore(settings.MIGRATION_STATE_DB))
+
+
+if __name__ == "__main__":
+    from catalogue import Catalogue
+    from gitea_migrate import CSV_REPOSITORIES
+
+    with Catalogue.open(Path(CSV_REPOSITORIES)) as catalogue:
+        import_repositories(catalogue)
@@ -0,0 +1,222 @@
+"""
+Benchmark the inventory and the migration against a local fake Bitbucket/Gitea server.
+
+    uv run benchmark.py --sizes 100,1000,10000 --latency 0.005 --error-rate 0.01
+
+For every size, the inventory (listing, sizes, CSV) and then the migration of that CSV
+to the fake Gitea are timed. Per-call latencies are measured client side.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+from fake_server import FakeServer, FakeServerConfig
+
+
+@dataclass
+class BenchmarkResult:
+    scenario: str
+    repos: int
+    elapsed: float
+    requests: int
+    throttled: int
+    p50_ms: float
+    p99_ms: float
+    calls: dict[str, int] = field(default_factory=dict)
+    phases: dict[str, dict] = field(default_factory=dict)
+
+    @property
+    def repos_per_second(self) -> float:
+        return self.repos / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.scenario:<10} {self.repos:>7} repos  {self.elapsed:8.2f}s  {self.repos_per_second:9.1f} repos/s  "
+            f"{self.requests:>7} requests ({self.throttled} throttled)  p50 {self.p50_ms:7.2f} ms  p99 {self.p99_ms:7.2f} ms"
+        )
+
+
+class LatencyRecorder:
+    """
+    Response hook collecting the client-side latency of every request.
+    """
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, response, **kwargs):
+        if response.elapsed is not None:
+            with self._lock:
+                self.latencies.append(response.elapsed.total_seconds())
+        return response
+
+    def reset(self):
+        with self._lock:
+            self.latencies.clear()
+
+    def percentiles(self) -> tuple[float, float]:
+        with self._lock:
+            latencies = list(self.latencies)
+        if len(latencies) < 2:
+            return (latencies[0] * 1000 if latencies else 0.0), (latencies[0] * 1000 if latencies else 0.0)
+        cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+        return cuts[49] * 1000, cuts[98] * 1000
+
+
+def configure_environment(args: argparse.Namespace, bitbucket: FakeServer, gitea: FakeServer, workdir: Path):
+    """
+    Point the settings at the fake servers. Must run before anything imports `config`,
+    which reads the environment once at import time.
+    """
+    os.environ.update(
+        {
+            "LOG_LEVEL": args.log_level,
+            "BITBUCKET_URL": bitbucket.url,
+            "BITBUCKET_USERNAME": "benchmark",
+            "BITBUCKET_PASSWORD": "benchmark",
+            "BITBUCKET_PAGE_LIMIT": str(args.page_limit),
+            "BITBUCKET_FETCH_SIZES": str(args.fetch_sizes).lower(),
+            "GITEA_URL": gitea.url,
+            "GITEA_API_URL": f"{gitea.url}/api/v1",
+            "GITEA_TOKEN": "benchmark",
+            "GITEA_PAGE_LIMIT": str(args.gitea_page_limit),
+            "MIGRATION_TARGET": "gitea",
+            "MIGRATION_CONCURRENCY": str(args.concurrency),
+            "GITEA_HOST_CONCURRENCY": str(args.concurrency),
+            "HTTP_RETRY_BACKOFF": "0.01",
+            "REPOSITORY_RULES_FILE": str(workdir / "no-rules.toml"),
+            "METRICS_REPORT_FILE": str(workdir / "run_report.json"),
+            "METRICS_PROMETHEUS_FILE": "",
+        }
+    )
+
+
+def server_config(args: argparse.Namespace, repos: int) -> FakeServerConfig:
+    return FakeServerConfig(
+        projects=max(1, -(-repos // args.repos_per_project)),
+        repos_per_project=min(repos, args.repos_per_project),
+        bitbucket_page_limit=args.server_page_limit,
+        gitea_page_limit=args.gitea_page_limit,
+        latency=args.latency,
+        migrate_latency=args.migrate_latency,
+        error_rate=args.error_rate,
+        lfs_ratio=args.lfs_ratio,
+    )
+
+
+def run(args: argparse.Namespace) -> list[BenchmarkResult]:
+    bitbucket = FakeServer().start()
+    gitea = FakeServer().start()
+    workdir = Path(tempfile.mkdtemp(prefix="benchmark-"))
+    configure_environment(args, bitbucket, gitea, workdir)
+
+    # Imported only now that the environment points at the fake servers
+    from bitbucket_repos import iter_all_repositories, list_projects, write_csv
+    from gitea_migrate import GiteaTarget, migrate_repositories
+    from http_client import add_response_hook, close_sessions, reset_pool_stats
+    from log_config import LOG_LEVEL, logger
+    from metrics import metrics
+    from state_store import MigrationStateStore
+
+    if logger.level(LOG_LEVEL).no > logger.level("INFO").no:
+        # The results are logged at INFO, keep them visible under the quieter default level
+        logger.add(sys.stderr, level="INFO", filter=lambda record: record["name"] == __name__ and record["level"].no < logger.level(LOG_LEVEL).no)
+
+    recorder = LatencyRecorder()
+    add_response_hook(recorder)
+    results: list[BenchmarkResult] = []
+
+    def measure(scenario: str, server: FakeServer, repos: int, action) -> BenchmarkResult:
+        close_sessions()
+        reset_pool_stats()
+        recorder.reset()
+        metrics.reset()
+        server.state.calls.clear()
+        started_at = time.perf_counter()
+        action()
+        elapsed = time.perf_counter() - started_at
+        calls = Counter({f"{method} {route}": count for (method, route), count in server.state.calls.items()})
+        p50, p99 = recorder.percentiles()
+        result = BenchmarkResult(
+            scenario=scenario,
+            repos=repos,
+            elapsed=elapsed,
+            requests=sum(calls.values()),
+            throttled=sum(count for call, count in calls.items() if call.endswith(" throttled")),
+            p50_ms=p50,
+            p99_ms=p99,
+            calls=dict(calls.most_common()),
+            phases=metrics.report()["phases"],
+        )
+        logger.info(result)
+        return result
+
+    for size in args.sizes:
+        config = server_config(args, size)
+        bitbucket.reset(config)
+        gitea.reset(config)
+        csv_file = workdir / f"repos-{size}.csv"
+
+        if "inventory" in args.scenarios or not csv_file.exists():
+
+            def inventory():
+                projects = list_projects()
+                write_csv((repo for _, repos in iter_all_repositories(projects, fetch_sizes=args.fetch_sizes) for repo in repos), filename=str(csv_file))
+
+            result = measure("inventory", bitbucket, size, inventory)
+            if "inventory" in args.scenarios:
+                results.append(result)
+
+        if "migration" in args.scenarios:
+
+            def migration():
+                state = MigrationStateStore(str(workdir / f"state-{size}.db"))
+                try:
+                    migrate_repositories(csv_file, state, GiteaTarget())
+                finally:
+                    state.close()
+
+            results.append(measure("migration", gitea, size, migration))
+
+    bitbucket.stop()
+    gitea.stop()
+    return results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma-separated numbers of repositories")
+    parser.add_argument("--scenarios", default="inventory,migration", help="inventory, migration or both")
+    parser.add_argument("--repos-per-project", type=int, default=100)
+    parser.add_argument("--page-limit", type=int, default=1000, help="page size the client asks Bitbucket for")
+    parser.add_argument("--server-page-limit", type=int, default=1000, help="largest page the fake Bitbucket hands out")
+    parser.add_argument("--gitea-page-limit", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds added to every request")
+    parser.add_argument("--migrate-latency", type=float, default=0.0, help="extra seconds per /repos/migrate")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered 429")
+    parser.add_argument("--lfs-ratio", type=float, default=0.0)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--no-sizes", dest="fetch_sizes", action="store_false", help="skip the size and LFS requests")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", type=Path, help="also write the results to this file")
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(",")]
+    args.scenarios = {scenario.strip() for scenario in args.scenarios.split(",")}
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run(args)
+    if args.json:
+        args.json.write_text(json.dumps([asdict(result) | {"repos_per_second": result.repos_per_second} for result in results], indent=2))
@@ -1,20 +1,28 @@
 import csv
+import heapq
 import os
+import tempfile
+import time
 from dataclasses import dataclass
-from pathlib import Path
+from typing import Iterable, Iterator
 
-import niquests
 from niquests.auth import HTTPBasicAuth
 
 from config import settings
+from http_client import get_session, log_pool_stats
+from inventory_cache import InventoryCache, diff_inventories, write_diff_report
 from log_config import logger
+from metrics import export_metrics, span
 from models import BitbucketProject, BitbucketRepo
+from retry import RetryPolicy, request_with_retry
+from rules import RepositoryRules, load_rules
 
 # API endpoint for listing repositories
 BITBUCKET_PROJECTS_API_URL = f"{settings.BITBUCKET_URL}/rest/api/1.0/projects"
 BITBUCKET_REPOS_API_URL = f"{settings.BITBUCKET_URL}/rest/api/1.0/projects/{settings.BITBUCKET_PROJECT}/repos"
 
 CSV_FILENAME = "bitbucket_repos.csv"
+CSV_FIELDNAMES = ["project", "projectname", "name", "newname", "link", "description", "action", "size", "lfs"]
 
 
 def list_projects() -> list[BitbucketProject]:
@@ -26,35 +34,56 @@ def list_projects() -> list[BitbucketProject]:
     start = 0
     is_last_page = False
 
-    # Using Niquests' Session with multiplexing enabled for improved performance
-    with niquests.Session(multiplexed=True) as session:
-        while not is_last_page:
-            response = session.get(f"{BITBUCKET_PROJECTS_API_URL}?start={start}", auth=auth, verify=True)  # type: ignore
-            if response.status_code == 200:
-                data = response.json()
-                projects = data["values"]
-                for project in projects:
-                    bitbucket_project = BitbucketProject(
-                        key=project["key"],
-                        id=project["id"],
-                        name=project["name"],
-                        description=project.get("description", "") or "",
-                        link=project["links"]["self"][0]["href"],
-                    )
-                    project_list.append(bitbucket_project)
-                    # logger.info(f"Project: {bitbucket_project.key}, Name: {bitbucket_project.name} - {bitbucket_project.description}")
-                    logger.info(bitbucket_project)
-
-                is_last_page = data["isLastPage"]
-                if not is_last_page:
-                    start = data["nextPageStart"]
-            else:
-                logger.error(f"Failed to list projects: {response.status_code} - {response.text}")
-                break
+    # Shared keep-alive session with multiplexing enabled for improved performance
+    session = get_session(settings.BITBUCKET_URL, multiplexed=True)
+    while not is_last_page:
+        with span("bitbucket.projects_page"):
+            response = request_with_retry(session, "GET", f"{BITBUCKET_PROJECTS_API_URL}?start={start}&limit={settings.BITBUCKET_PAGE_LIMIT}", auth=auth, verify=True)
+        if response.status_code == 200:
+            data = response.json()
+            projects = data["values"]
+            for project in projects:
+                bitbucket_project = BitbucketProject(
+                    key=project["key"],
+                    id=project["id"],
+                    name=project["name"],
+                    description=project.get("description", "") or "",
+                    link=project["links"]["self"][0]["href"],
+                )
+                project_list.append(bitbucket_project)
+                # logger.info(f"Project: {bitbucket_project.key}, Name: {bitbucket_project.name} - {bitbucket_project.description}")
+                logger.info(bitbucket_project)
+
+            is_last_page = data["isLastPage"]
+            if not is_last_page:
+                start = data["nextPageStart"]
+        else:
+            # Fail loudly rather than writing a truncated inventory
+            logger.error(f"Failed to list projects: {response.status_code} - {response.text}")
+            response.raise_for_status()
+            break
 
     return project_list
 
 
+def parse_repository(project: BitbucketProject, repo: dict) -> BitbucketRepo:
+    """
+    Build a BitbucketRepo from one entry of the Bitbucket repository listing.
+    """
+    clone_links = repo["links"]["clone"]
+    http_link = next(link["href"] for link in clone_links if link["name"] == "http")
+    org_prefix = f"{settings.ORG_PREFIX}-" if settings.ORG_PREFIX else ""
+    return BitbucketRepo(
+        project=f"{org_prefix}{project.key}",
+        projectname=project.name,
+        name=repo["name"],
+        newname="",  # Placeholder for the new name
+        link=http_link,
+        description=(repo.get("description", "") or "").replace("\r\n", " ").replace("\n", " ").replace(",", ";"),
+        action="",  # Placeholder for the action to take
+    )
+
+
 def list_repositories(project: BitbucketProject) -> list[BitbucketRepo]:
     """
     List all repositories for the specified Bitbucket project, handling pagination.
@@ -72,112 +101,321 @@ def list_repositories(project: BitbucketProject) -> list[BitbucketRepo]:
     start = 0
     is_last_page = False
 
-    # Using Niquests' Session with multiplexing enabled for improved performance
-    with niquests.Session(multiplexed=True) as session:
-        while not is_last_page:
-            response = session.get(f"{BITBUCKET_REPOS_API_URL}?start={start}", auth=auth, verify=True)  # type: ignore
-            if response.status_code == 200:
-                data = response.json()
-                repos = data["values"]
-                for repo in repos:
-                    clone_links = repo["links"]["clone"]
-                    http_link = next(link["href"] for link in clone_links if link["name"] == "http")
-                    org_prefix = f"{settings.ORG_PREFIX}-" if settings.ORG_PREFIX else ""
-                    repo_info = BitbucketRepo(
-                        project=f"{org_prefix}{project.key}",
-                        projectname=project.name,
-                        name=repo["name"],
-                        newname="",  # Placeholder for the new name
-                        link=http_link,
-                        description=repo.get("description", "").replace("\r\n", " ").replace("\n", " ").replace(",", ";"),
-                        action="",  # Placeholder for the action to take
-                    )
-                    repo_list.append(repo_info)
-                    logger.info(f"Repository: {repo_info.name}, Link: {repo_info.link}, Description: {repo_info.description}")
-
-                is_last_page = data["isLastPage"]
-                if not is_last_page:
-                    start = data["nextPageStart"]
-            else:
-                logger.error(f"Failed to list repositories: {response.status_code} - {response.text}")
-                break
+    # Shared keep-alive session with multiplexing enabled for improved performance
+    session = get_session(settings.BITBUCKET_URL, multiplexed=True)
+    while not is_last_page:
+        with span("bitbucket.repos_page"):
+            response = request_with_retry(session, "GET", f"{BITBUCKET_REPOS_API_URL}?start={start}&limit={settings.BITBUCKET_PAGE_LIMIT}", auth=auth, verify=True)
+        if response.status_code == 200:
+            data = response.json()
+            repos = data["values"]
+            for repo in repos:
+                repo_info = parse_repository(project, repo)
+                repo_list.append(repo_info)
+                logger.info(f"Repository: {repo_info.name}, Link: {repo_info.link}, Description: {repo_info.description}")
+
+            is_last_page = data["isLastPage"]
+            if not is_last_page:
+                start = data["nextPageStart"]
+        else:
+            # Fail loudly rather than writing a truncated inventory
+            logger.error(f"Failed to list repositories: {response.status_code} - {response.text}")
+            response.raise_for_status()
+            break
 
     return repo_list
 
 
-repository_actions: dict[str, list[str]] = {
-    "Archive": [
-        "my-repo1",
-        "my-repo2",
-    ],
-    "Ignore": [
-        "my-ignored-repo1",
-        "my-ignored-repo2",
-    ],
-    "Move": [
-        "my-moved-repo1",
-        "my-moved-repo2",
-    ],
-}
+def iter_all_repositories(
+    projects: list[BitbucketProject],
+    cache: InventoryCache | None = None,
+    fetch_sizes: bool = False,
+) -> Iterator[tuple[str, list[BitbucketRepo]]]:
+    """
+    List the repositories of all projects at once, yielding (project key, repositories)
+    as soon as each project is complete.
+
+    Pages are requested in waves: the next page of every unfinished project is sent
+    over one multiplexed connection and the whole wave is gathered together, so the
+    inventory costs as many round trips as the largest project has pages.
+
+    With a cache, the first page of each project that last fit on a single page is a
+    conditional request and projects answering 304 Not Modified are served from the
+    cache; larger projects are listed in full, since repositories added or removed on
+    a later page would not change the first page's validators. With `fetch_sizes`,
+    the projects completed in a wave get their missing sizes in one extra wave.
+    """
+    auth = HTTPBasicAuth(settings.BITBUCKET_USERNAME, settings.BITBUCKET_PASSWORD)
+    session = get_session(settings.BITBUCKET_URL, multiplexed=True)
+    fetched: dict[str, dict[str, BitbucketRepo]] = {project.key: {} for project in projects}
+    validators: dict[str, tuple[str, str]] = {}
+    page_counts: dict[str, int] = {}
+    projects_by_key = {project.key: project for project in projects}
+    total = 0
+
+    def complete(finished: dict[str, list[BitbucketRepo]]) -> Iterator[tuple[str, list[BitbucketRepo]]]:
+        nonlocal total
+        if fetch_sizes:
+            # Repositories served from the cache keep the size fetched last time
+            fetch_repository_sizes([repo for repos in finished.values() for repo in repos if not repo.size])
+        for key, repos in finished.items():
+            total += len(repos)
+            yield key, repos
+
+    pending: dict[str, int] = {}
+    finished: dict[str, list[BitbucketRepo]] = {}
+    for project in projects:
+        if cache and cache.is_fresh(project.key):
+            finished[project.key] = cache.repositories(project.key)
+        else:
+            pending[project.key] = 0
+    yield from complete(finished)
+
+    policy = RetryPolicy()
+    attempts: dict[str, int] = {}
+    while pending:
+        logger.info(f"Requesting repository pages for {len(pending)} projects")
+        with span("bitbucket.repos_wave"):
+            responses = {
+                key: session.get(  # type: ignore
+                    f"{BITBUCKET_PROJECTS_API_URL}/{key}/repos?start={start}&limit={settings.BITBUCKET_PAGE_LIMIT}",
+                    auth=auth,
+                    headers=cache.validators(key) if cache and start == 0 else None,
+                    verify=True,
+                )
+                for key, start in pending.items()
+            }
+            session.gather()
+
+        requested, pending, finished = pending, {}, {}
+        retry_delay = 0.0
+        for key, response in responses.items():
+            if response.status_code == 304 and cache and cache.validators(key):
+                logger.debug(f"Project {key} not modified, using cached listing")
+                finished[key] = cache.repositories(key)
+                cache.touch(key)
+                continue
+
+            if response.status_code in policy.statuses and attempts.get(key, 0) + 1 < policy.attempts:
+                # Throttled: ask for the same page again in the next wave
+                retry_delay = max(retry_delay, policy.delay(attempts.get(key, 0), response))
+                attempts[key] = attempts.get(key, 0) + 1
+                pending[key] = requested[key]
+                continue
+
+            if response.status_code != 200:
+                logger.error(f"Failed to list repositories for project {key}: {response.status_code} - {response.text}")
+                if not (cache and key in cache.projects):
+                    # Fail loudly rather than writing a truncated inventory
+                    response.raise_for_status()
+                    raise RuntimeError(f"Failed to list repositories for project {key}: {response.status_code}")
+                logger.warning(f"Falling back to the cached listing of project {key}")
+                finished[key] = cache.repositories(key)
+                continue
+
+            attempts.pop(key, None)
+            page_counts[key] = page_counts.get(key, 0) + 1
+            if requested[key] == 0:
+                validators[key] = (response.headers.get("ETag", ""), response.headers.get("Last-Modified", ""))
+
+            data = response.json()
+            for repo in data["values"]:
+                fetched[key][str(repo["id"])] = parse_repository(projects_by_key[key], repo)
+
+            if not data["isLastPage"]:
+                pending[key] = data["nextPageStart"]
+            else:
+                repos = fetched.pop(key)
+                finished[key] = list(repos.values())
+                if cache:
+                    cache.store(key, repos, *validators[key], pages=page_counts[key])
+
+        yield from complete(finished)
+
+        if retry_delay:
+            logger.warning(f"Bitbucket is throttling, waiting {retry_delay:.1f}s before the next wave")
+            time.sleep(retry_delay)
+
+    logger.info(f"Listed {total} repositories in {len(projects)} projects")
 
 
-def write_csv(data: list[BitbucketRepo], prefix: str = "", mode: str = "w"):
+def list_all_repositories(projects: list[BitbucketProject], cache: InventoryCache | None = None) -> dict[str, list[BitbucketRepo]]:
     """
-    Write the list of repositories to a CSV file.
+    List the repositories of all projects at once, keyed by project key.
     """
+    return dict(iter_all_repositories(projects, cache))
 
-    if "-" not in prefix and prefix:
-        prefix = f"{prefix}-"
 
-    file_exists = os.path.exists(CSV_FILENAME) and os.path.getsize(CSV_FILENAME) > 0
+def list_refs(repo: BitbucketRepo) -> dict[str, str]:
+    """
+    Return the branch and tag heads of a Bitbucket repository as {"refs/heads/main": sha, ...}.
 
-    # Open file in append or write mode
-    with open(CSV_FILENAME, mode, newline="") as f:
-        writer = csv.writer(f)
+    Annotated tags map to the tag object, lightweight tags to the commit, matching what
+    `git ls-remote` (and Gitea's git/refs endpoint) reports.
+    """
+    auth = HTTPBasicAuth(settings.BITBUCKET_USERNAME, settings.BITBUCKET_PASSWORD)
+    session = get_session(settings.BITBUCKET_URL)
+    repo_api_url = f"{BITBUCKET_PROJECTS_API_URL}/{repo.project_key}/repos/{repo.slug}"
+    refs: dict[str, str] = {}
+
+    for kind, prefix in (("branches", "refs/heads/"), ("tags", "refs/tags/")):
+        start = 0
+        is_last_page = False
+        while not is_last_page:
+            response = request_with_retry(session, "GET", f"{repo_api_url}/{kind}?start={start}&limit={settings.BITBUCKET_PAGE_LIMIT}", auth=auth, verify=True)
+            response.raise_for_status()
+            data = response.json()
+            for ref in data["values"]:
+                refs[f"{prefix}{ref['displayId']}"] = ref.get("hash") or ref["latestCommit"]
+
+            is_last_page = data["isLastPage"]
+            if not is_last_page:
+                start = data["nextPageStart"]
 
-        # Write header only if the file is empty and we're not in append mode
-        if not file_exists or mode == "w":
-            writer.writerow(["project", "projectname", "name", "newname", "link", "description", "action"])
+    return refs
 
-        for repo in data:
-            # Determine the action to take based on the repository name, if name is not found, default to "Move"
-            try:
-                action = next(action for action, repos in repository_actions.items() if repo.name in repos)
-            except StopIteration:
-                action = "Move"
 
-            # Clean up the repository name
-            new_name = repo.name.replace("aiis", "ais").replace("_", "-")
+def has_branches(repo: BitbucketRepo) -> bool:
+    """
+    Whether the Bitbucket repository has any branch, i.e. is not empty.
+    """
+    auth = HTTPBasicAuth(settings.BITBUCKET_USERNAME, settings.BITBUCKET_PASSWORD)
+    url = f"{BITBUCKET_PROJECTS_API_URL}/{repo.project_key}/repos/{repo.slug}/branches?limit=1"
+    response = request_with_retry(get_session(settings.BITBUCKET_URL), "GET", url, auth=auth, verify=True)
+    response.raise_for_status()
+    return bool(response.json()["values"])
 
-            # Active repository names should start with "ais-"
-            if action == "Move":
-                # new_name = f"{prefix}{new_name.replace('ais-', '')}"
-                new_name = f"{prefix}{new_name}"
-                logger.info(f"Moving repository: {repo.name} to {new_name}")
 
-            elif action == "Ignore":
-                logger.info(f"Ignoring repository: {repo.name}")
-                continue  # Skip ignored repositories
+def fetch_repository_sizes(repos: list[BitbucketRepo]):
+    """
+    Fill in the size and LFS flag of the given repositories, in place.
 
-            elif action == "Archive":
-                new_name = f"zArchive-ais-{new_name.replace('ais-', '')}"
-                logger.info(f"Archiving repository: {repo.name}")
+    Two requests per repository (the sizes endpoint and the LFS admin endpoint), all
+    sent at once over the multiplexed Bitbucket session. Those without a definite answer
+    (throttled, failed) are sent again one by one with retries.
+    """
+    if not repos:
+        return
+
+    auth = HTTPBasicAuth(settings.BITBUCKET_USERNAME, settings.BITBUCKET_PASSWORD)
+    session = get_session(settings.BITBUCKET_URL, multiplexed=True)
+
+    def sizes_url(repo: BitbucketRepo) -> str:
+        return f"{settings.BITBUCKET_URL}/projects/{repo.project_key}/repos/{repo.slug}/sizes"
+
+    def lfs_url(repo: BitbucketRepo) -> str:
+        return f"{settings.BITBUCKET_URL}/rest/git-lfs/admin/projects/{repo.project_key}/repos/{repo.slug}/enabled"
+
+    logger.info(f"Fetching size and LFS status of {len(repos)} repositories")
+    with span("bitbucket.sizes_wave"):
+        responses = [
+            (
+                repo,
+                session.get(sizes_url(repo), auth=auth, verify=True),  # type: ignore
+                session.get(lfs_url(repo), auth=auth, verify=True),  # type: ignore
+            )
+            for repo in repos
+        ]
+        session.gather()
+
+    retry_session = get_session(settings.BITBUCKET_URL)
+    retried = 0
+    for repo, size_response, lfs_response in responses:
+        if size_response.status_code != 200:
+            retried += 1
+            size_response = request_with_retry(retry_session, "GET", sizes_url(repo), auth=auth, verify=True)
+        if size_response.status_code == 200:
+            repo.size = size_response.json().get("repository", 0)
+        else:
+            logger.warning(f"Failed to get the size of {repo.project_key}/{repo.slug}: {size_response.status_code}")
+
+        # 200/204 means LFS is enabled, 404 that it is not
+        if lfs_response.status_code not in (200, 204, 404):
+            retried += 1
+            lfs_response = request_with_retry(retry_session, "GET", lfs_url(repo), auth=auth, verify=True)
+        if lfs_response.status_code in (200, 204, 404):
+            repo.lfs = lfs_response.status_code != 404
+        else:
+            logger.warning(f"Failed to get the LFS status of {repo.project_key}/{repo.slug}: {lfs_response.status_code}, leaving it at {repo.lfs}")
+    if retried:
+        logger.info(f"Sent {retried} size and LFS requests again after failed answers")
+
+
+def csv_row(repo: BitbucketRepo, rules: RepositoryRules, prefix: str = "") -> list | None:
+    """
+    Decide the action and new name of a repository and return its CSV row, or None if it is ignored.
+    """
+    action, new_name = rules.classify(repo, prefix)
 
-            new_name = new_name.lower().replace(" ", "-").replace("_", "-").replace(".", "-").replace("(", "").replace(")", "")
+    if action == "Move":
+        logger.info(f"Moving repository: {repo.name} to {new_name}")
+    elif action == "Ignore":
+        logger.info(f"Ignoring repository: {repo.name}")
+        return None  # Skip ignored repositories
+    elif action == "Archive":
+        logger.info(f"Archiving repository: {repo.name}")
 
-            # Write repository details to CSV
-            writer.writerow([repo.project, repo.projectname, repo.name, new_name, repo.link, repo.description, action])
+    return [repo.project, repo.projectname, repo.name, new_name, repo.link, repo.description, action, repo.size, repo.lfs]
 
-    # Sort the file properly after all projects have been processed
-    if mode == "w" or not file_exists:  # Only sort once at the end
-        with open(CSV_FILENAME, "r", newline="") as f:
-            data = list(csv.DictReader(f))
-            data.sort(key=lambda x: (x["newname"], x["name"]))
 
-        with open(CSV_FILENAME, "w", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=["project", "projectname", "name", "newname", "link", "description", "action"])
-            writer.writeheader()
-            writer.writerows(data)
+def _row_sort_key(row: list) -> tuple[str, str]:
+    return row[3], row[2]  # newname, name
+
+
+def sorted_rows(rows: Iterable[list], chunk_rows: int | None = None) -> Iterator[list]:
+    """
+    Sort CSV rows by new name, spilling sorted runs of `chunk_rows` rows to temporary
+    files and merging them back (an external merge sort), so memory stays bounded for
+    very large inventories. Inventories that fit in one chunk never touch the disk.
+    """
+    chunk_rows = max(1, chunk_rows or settings.CSV_SORT_CHUNK_ROWS)
+    with tempfile.TemporaryDirectory(prefix="bitbucket_repos-") as tmpdir:
+        runs: list[str] = []
+        chunk: list[list] = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_rows:
+                chunk.sort(key=_row_sort_key)
+                runs.append(os.path.join(tmpdir, f"run-{len(runs)}.csv"))
+                with open(runs[-1], "w", newline="") as f:
+                    csv.writer(f).writerows(chunk)
+                chunk = []
+
+        chunk.sort(key=_row_sort_key)
+        if not runs:
+            yield from chunk
+            return
+
+        logger.debug(f"Merging {len(runs)} sorted runs of {chunk_rows} rows")
+        files = [open(run, newline="") for run in runs]
+        try:
+            yield from heapq.merge(*(csv.reader(f) for f in files), chunk, key=_row_sort_key)
+        finally:
+            for f in files:
+                f.close()
+
+
+def write_csv(data: Iterable[BitbucketRepo], prefix: str = "", filename: str = CSV_FILENAME, rules: RepositoryRules | None = None) -> int:
+    """
+    Write the repositories to a CSV file, sorted by new name, in a single pass.
+
+    `data` may be a generator: rows are classified as they arrive (with the rules file
+    unless `rules` are given) and the file is replaced atomically once everything is
+    written. Returns the number of rows written.
+    """
+    rules = rules or load_rules()
+    rows = (row for repo in data if (row := csv_row(repo, rules, prefix)) is not None)
+    count = 0
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_FIELDNAMES)
+        for row in sorted_rows(rows):
+            writer.writerow(row)
+            count += 1
+    os.replace(tmp_filename, filename)
+    logger.info(f"Wrote {count} repositories to {filename}")
+    return count
 
 
 if __name__ == "__main__":
@@ -186,11 +424,18 @@ if __name__ == "__main__":
     for project in projects:
         logger.info(project)
 
-    if Path(CSV_FILENAME).exists():
-        Path(CSV_FILENAME).unlink()
+    cache = InventoryCache(ttl=settings.BITBUCKET_CACHE_TTL)
+    previous = cache.snapshot()
+    cache.prune({project.key for project in projects})
 
-    for project in projects:
-        repositories = list_repositories(project)
-        write_csv(repositories, "", mode="a")
+    # Repositories stream from the listing straight into the sorted writer
+    listing = iter_all_repositories(projects, cache, fetch_sizes=settings.BITBUCKET_FETCH_SIZES)
+    write_csv(repo for _, repos in listing for repo in repos)
+
+    cache.save()
+    if previous:
+        write_diff_report(diff_inventories(previous, cache.snapshot()))
 
+    log_pool_stats()
+    export_metrics()
     exit()
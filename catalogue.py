@@ -0,0 +1,321 @@
+"""
+Indexed, memory-mapped catalogue of the repositories of a CSV file.
+
+    uv run catalogue.py build [--csv bitbucket_repos.csv]
+    uv run catalogue.py find [ORG | ORG/NEWNAME | --link URL | --newname NAME]
+    uv run catalogue.py stats
+
+Next to bitbucket_repos.csv, bitbucket_repos.catalogue holds one compact record per line
+(a JSON array of the CSV fields) and bitbucket_repos.catalogue.idx the record offsets and
+hash tables by project, by new name (alone and as org/newname) and by clone link. Both
+files are memory-mapped: opening the catalogue parses nothing but a small header, and a
+lookup reads a few table slots and decodes only the matching records. They are rebuilt
+whenever the CSV changes.
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import mmap
+import os
+import struct
+from collections.abc import Iterator
+from dataclasses import astuple, fields
+from pathlib import Path
+from typing import Callable
+
+from log_config import logger
+from models import BitbucketRepo
+
+CATALOGUE_VERSION = 1
+FIELDS = [f.name for f in fields(BitbucketRepo)]
+MAGIC = b"BBCATIDX"
+
+# Header: magic and length of the JSON header that follows
+PREFIX = struct.Struct("<8sQ")
+OFFSET = struct.Struct("<Q")  # start of a record in the data file
+SLOT = struct.Struct("<QII")  # key hash, start in the positions array, number of positions (0: empty slot)
+POSITION = struct.Struct("<I")
+
+
+def link_key(link: str) -> str:
+    """
+    "KEY/slug" of a clone link, so http(s) and host variants of a link find the same repository.
+    """
+    project_key, slug = link.rstrip("/").split("/")[-2:]
+    return f"{project_key}/{slug.removesuffix('.git')}".lower()
+
+
+# Index name -> key of a repository in that index
+INDEXES: dict[str, Callable[[BitbucketRepo], str]] = {
+    "projects": lambda repo: repo.project.lower(),
+    "names": lambda repo: f"{repo.project}/{repo.newname}".lower(),
+    "newnames": lambda repo: repo.newname.lower(),
+    "links": lambda repo: link_key(repo.link),
+}
+
+
+def key_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+
+
+def catalogue_paths(csv_file: Path) -> tuple[Path, Path]:
+    data_path = csv_file.with_suffix(".catalogue")
+    return data_path, data_path.with_name(f"{data_path.name}.idx")
+
+
+def _source_signature(csv_file: Path) -> dict:
+    stat = csv_file.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _hash_table(keys: dict[str, list[int]]) -> tuple[bytes, bytes]:
+    """
+    An open-addressing hash table (linear probing, at most half full) over the positions
+    of each key, and the positions array it points into.
+    """
+    slots = 1
+    while slots < 2 * len(keys):
+        slots *= 2
+    table = bytearray(slots * SLOT.size)
+    positions = bytearray()
+    for key, key_positions in keys.items():
+        hashed = key_hash(key)
+        slot = hashed & (slots - 1)
+        while SLOT.unpack_from(table, slot * SLOT.size)[2]:
+            slot = (slot + 1) & (slots - 1)
+        SLOT.pack_into(table, slot * SLOT.size, hashed, len(positions) // POSITION.size, len(key_positions))
+        positions += struct.pack(f"<{len(key_positions)}I", *key_positions)
+    return bytes(table), bytes(positions)
+
+
+def build_catalogue(csv_file: Path) -> int:
+    """
+    Stream the CSV into the record file and its index, replacing both. Returns the number of records.
+    """
+    data_path, index_path = catalogue_paths(csv_file)
+    source = _source_signature(csv_file)
+    offsets = bytearray()
+    keys: dict[str, dict[str, list[int]]] = {name: {} for name in INDEXES}
+
+    tmp_data_path = data_path.with_name(f"{data_path.name}.{os.getpid()}.tmp")
+    with open(csv_file, newline="") as source_file, open(tmp_data_path, "wb") as data_file:
+        for position, row in enumerate(csv.DictReader(source_file)):
+            repo = BitbucketRepo(**row)
+            offsets += OFFSET.pack(data_file.tell())
+            data_file.write(json.dumps(astuple(repo), ensure_ascii=False, separators=(",", ":")).encode() + b"\n")
+            for name, index_key in INDEXES.items():
+                keys[name].setdefault(index_key(repo), []).append(position)
+        data_size = data_file.tell()
+    count = len(offsets) // OFFSET.size
+
+    sections: list[tuple[str, bytes]] = [("offsets", bytes(offsets))]
+    for name in INDEXES:
+        table, positions = _hash_table(keys[name])
+        sections += [(f"{name}.table", table), (f"{name}.positions", positions)]
+    header = {"version": CATALOGUE_VERSION, "source": source, "fields": FIELDS, "data_size": data_size, "count": count, "sections": {}}
+    # Section offsets depend on the header length, which depends on them: reserve room for the digits
+    header_size = len(json.dumps(header)) + len(sections) * 48
+    position = PREFIX.size + header_size + (-(PREFIX.size + header_size)) % 8
+    for name, content in sections:
+        header["sections"][name] = [position, len(content)]
+        position += len(content) + (-len(content)) % 8
+    header_bytes = json.dumps(header).encode().ljust(header_size)
+
+    tmp_index_path = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+    with open(tmp_index_path, "wb") as index_file:
+        index_file.write(PREFIX.pack(MAGIC, header_size) + header_bytes)
+        for name, content in sections:
+            index_file.seek(header["sections"][name][0])
+            index_file.write(content)
+    os.replace(tmp_data_path, data_path)
+    os.replace(tmp_index_path, index_path)
+    logger.info(f"Built the catalogue of {count} repositories from {csv_file} ({data_size / 1024 / 1024:.1f} MB)")
+    return count
+
+
+def _map(path: Path) -> mmap.mmap | bytes:
+    with open(path, "rb") as f:
+        # mmap refuses empty files
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+
+def _read_header(index_path: Path) -> dict | None:
+    try:
+        with open(index_path, "rb") as f:
+            magic, header_size = PREFIX.unpack(f.read(PREFIX.size))
+            return json.loads(f.read(header_size)) if magic == MAGIC else None
+    except (FileNotFoundError, struct.error, json.JSONDecodeError):
+        return None
+
+
+class Catalogue:
+    """
+    Read-only view of a built catalogue. A lookup hashes the key, probes the index table
+    and decodes the records it points to (checking their key, hashes may collide).
+    """
+
+    def __init__(self, data_path: Path, index_path: Path, header: dict):
+        self.data_path = data_path
+        self.header = header
+        self._data = _map(data_path)
+        self._index = _map(index_path)
+        self._sections: dict[str, list[int]] = header["sections"]
+
+    @classmethod
+    def open(cls, csv_file: Path) -> "Catalogue":
+        """
+        Open the catalogue of the CSV file, building it first if it is missing or outdated.
+        """
+        data_path, index_path = catalogue_paths(csv_file)
+        header = _read_header(index_path)
+        if (
+            header is None
+            or header.get("version") != CATALOGUE_VERSION
+            or header.get("fields") != FIELDS
+            or header.get("source") != _source_signature(csv_file)
+            or not data_path.exists()
+            or data_path.stat().st_size != header.get("data_size")
+        ):
+            build_catalogue(csv_file)
+            header = _read_header(index_path)
+            assert header is not None
+        return cls(data_path, index_path, header)
+
+    def __len__(self) -> int:
+        return self.header["count"]
+
+    def __getitem__(self, position: int) -> BitbucketRepo:
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        start = OFFSET.unpack_from(self._index, self._sections["offsets"][0] + position * OFFSET.size)[0]
+        end = self._data.find(b"\n", start)
+        return BitbucketRepo(*json.loads(self._data[start:end]))
+
+    def __iter__(self) -> Iterator[BitbucketRepo]:
+        for position in range(len(self)):
+            yield self[position]
+
+    def __enter__(self) -> "Catalogue":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _slots(self, index: str) -> Iterator[tuple[int, int, int]]:
+        """
+        The occupied slots of an index table: (key hash, start, count).
+        """
+        offset, size = self._sections[f"{index}.table"]
+        for slot_offset in range(offset, offset + size, SLOT.size):
+            slot = SLOT.unpack_from(self._index, slot_offset)
+            if slot[2]:
+                yield slot
+
+    def _positions(self, index: str, start: int, count: int) -> tuple[int, ...]:
+        return struct.unpack_from(f"<{count}I", self._index, self._sections[f"{index}.positions"][0] + start * POSITION.size)
+
+    def _lookup(self, index: str, key: str) -> list[BitbucketRepo]:
+        offset, size = self._sections[f"{index}.table"]
+        slots = size // SLOT.size
+        if not slots:
+            return []
+        hashed = key_hash(key)
+        slot = hashed & (slots - 1)
+        while True:
+            slot_hash, start, count = SLOT.unpack_from(self._index, offset + slot * SLOT.size)
+            if not count:
+                return []
+            if slot_hash == hashed:
+                repos = [self[position] for position in self._positions(index, start, count)]
+                return [repo for repo in repos if INDEXES[index](repo) == key]
+            slot = (slot + 1) & (slots - 1)
+
+    def get(self, project: str, newname: str) -> BitbucketRepo | None:
+        """
+        The repository that becomes {project}/{newname} in the target.
+        """
+        return next(iter(self._lookup("names", f"{project}/{newname}".lower())), None)
+
+    def by_link(self, link: str) -> BitbucketRepo | None:
+        return next(iter(self._lookup("links", link_key(link))), None)
+
+    def by_slug(self, project_key: str, slug: str) -> BitbucketRepo | None:
+        """
+        The repository with this Bitbucket project key and slug (as in webhooks and REST URLs).
+        """
+        return next(iter(self._lookup("links", f"{project_key}/{slug}".lower())), None)
+
+    def by_project(self, project: str) -> list[BitbucketRepo]:
+        return self._lookup("projects", project.lower())
+
+    def by_newname(self, newname: str) -> list[BitbucketRepo]:
+        """
+        Repositories with this new name, in any organization.
+        """
+        return self._lookup("newnames", newname.lower())
+
+    def project_sizes(self) -> dict[str, int]:
+        """
+        Number of repositories per project, decoding one record per project.
+        """
+        return {self[self._positions("projects", start, 1)[0]].project: count for _, start, count in self._slots("projects")}
+
+    def organizations(self) -> dict[str, str]:
+        """
+        The organizations mapped to their full name, decoding one record per project.
+        """
+        organizations: dict[str, str] = {}
+        for _, start, _ in self._slots("projects"):
+            repo = self[self._positions("projects", start, 1)[0]]
+            organizations[repo.project] = repo.projectname
+        return organizations
+
+    def close(self):
+        for mapped in (self._data, self._index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+
+
+def parse_args() -> argparse.Namespace:
+    from gitea_migrate import CSV_REPOSITORIES
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--csv", type=Path, default=CSV_REPOSITORIES)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("build", help="(re)build the catalogue of the CSV")
+    find_parser = commands.add_parser("find", help="look repositories up")
+    find_parser.add_argument("name", nargs="?", help="ORG or ORG/NEWNAME")
+    find_parser.add_argument("--link", help="clone link")
+    find_parser.add_argument("--newname", help="new name, in any organization")
+    commands.add_parser("stats", help="count the repositories per organization")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "build":
+        build_catalogue(args.csv)
+        exit(0)
+
+    with Catalogue.open(args.csv) as catalogue:
+        if args.command == "stats":
+            sizes = catalogue.project_sizes()
+            logger.info(f"{len(catalogue)} repositories in {len(sizes)} organizations")
+            for project, count in sorted(sizes.items()):
+                logger.info(f"  {project}: {count}")
+        else:
+            if args.link:
+                found = [catalogue.by_link(args.link)]
+            elif args.newname:
+                found = catalogue.by_newname(args.newname)
+            elif args.name and "/" in args.name:
+                found = [catalogue.get(*args.name.split("/", 1))]
+            else:
+                found = catalogue.by_project(args.name or "")
+            found = [repo for repo in found if repo is not None]
+            for repo in found:
+                logger.info(",".join(str(value) for value in astuple(repo)))
+            if not found:
+                logger.warning("No repository found")
@@ -9,6 +9,11 @@ class Settings(BaseSettings):
     BITBUCKET_USERNAME: str = ""
     BITBUCKET_PASSWORD: str = ""
     BITBUCKET_TOKEN: str = ""
+    BITBUCKET_PAGE_LIMIT: int = 1000
+    BITBUCKET_CACHE_TTL: int = 0
+    BITBUCKET_FETCH_SIZES: bool = True
+    CSV_SORT_CHUNK_ROWS: int = 100_000
+    REPOSITORY_RULES_FILE: str = "repository_rules.toml"
 
     GITEA_URL: str = ""
     GITEA_API_URL: str = ""
@@ -17,13 +22,64 @@ class Settings(BaseSettings):
     GITEA_USER_ID: str = "1"
     GITEA_ORGANIZATION: str = ""
     GITEA_SET_AS_MIRROR: bool = False
+    GITEA_PAGE_LIMIT: int = 50
+    GITEA_PREFLIGHT_INDEX: bool = True
 
     ORG_PREFIX: str = ""
 
+    MIGRATION_TARGET: str = "gitea"
+    LOCAL_MIRROR_DIR: str = "mirrors"
+    LOCAL_MIRROR_TIMEOUT: int = 3600
+    MIRROR_CACHE_ENABLED: bool = False
+    MIRROR_CACHE_DIR: str = "mirror_cache"
+    MIRROR_CACHE_MAX_GB: float = 50.0
+    MIRROR_CACHE_FETCH_TTL: int = 300
+
+    MIGRATION_CONCURRENCY: int = 1
+    GITEA_HOST_CONCURRENCY: int = 4
+    GITEA_DELETE_CONCURRENCY: int = 8
+    HTTP_POOL_MAXSIZE: int = 10
+    HTTP_RETRY_ATTEMPTS: int = 5
+    HTTP_RETRY_BACKOFF: float = 1.0
+    HTTP_RETRY_MAX_BACKOFF: float = 60.0
+    MIGRATION_STATE_DB: str = "migration_state.db"
+    MIGRATION_PLAN_FILE: str = "migration_plan.json"
+    MIGRATION_ASYNC: bool = False
+    MIGRATION_SUBMIT_TIMEOUT: float = 30.0
+    MIGRATION_POLL_INTERVAL: float = 10.0
+    MIGRATION_POLL_TIMEOUT: int = 7200
+    MIGRATION_MAX_IN_FLIGHT: int = 100
+    MIGRATION_SCHEDULE: str = "largest-first"
+    MIGRATION_HEAVY_SIZE_MB: int = 1024
+    MIGRATION_MAX_HEAVY: int = 2
+    WORK_QUEUE_BACKEND: str = "sqlite"
+    WORK_QUEUE_DB: str = "work_queue.db"
+    WORK_QUEUE_BATCH_SIZE: int = 10
+    WORK_QUEUE_LEASE_SECONDS: float = 300.0
+    WORK_QUEUE_MAX_ATTEMPTS: int = 3
+    WORK_QUEUE_RUNNER_ID: str = ""
+    SYNC_CONCURRENCY: int = 8
+    VERIFY_CONCURRENCY: int = 16
+    VERIFY_REPORT_FILE: str = "verify_report.json"
+    VERIFY_RESYNC_CSV: str = "verify_resync.csv"
+    LFS_TRANSFER_ENABLED: bool = False
+    LFS_TRANSFER_CONCURRENCY: int = 8
+    LFS_BATCH_SIZE: int = 100
+    SYNC_WEBHOOK_HOST: str = "0.0.0.0"
+    SYNC_WEBHOOK_PORT: int = 8080
+    SYNC_WEBHOOK_PATH: str = "/webhook"
+    SYNC_WEBHOOK_SECRET: str = ""
+    SYNC_DEBOUNCE_SECONDS: float = 5.0
+    SYNC_MAX_DELAY_SECONDS: float = 60.0
+    METRICS_REPORT_FILE: str = "run_report.json"
+    METRICS_PROMETHEUS_FILE: str = ""
+
     AZURE_DEVOPS_URL: str = ""
     AZURE_DEVOPS_ORGANIZATION: str = ""
     AZURE_DEVOPS_PROJECT: str = ""
     AZURE_DEVOPS_TOKEN: str = ""
+    AZURE_DEVOPS_CONCURRENCY: int = 4
+    AZURE_DEVOPS_POLL_INTERVAL: float = 10.0
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,278 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+@dataclass
+class FakeServerConfig:
+    """
+    Behaviour of the stand-in server. `latency` is added to every request, `migrate_latency`
+    on top of it to /repos/migrate. A fraction `error_rate` of the requests is answered
+    429 (with Retry-After: 0) before doing anything.
+    """
+
+    projects: int = 10
+    repos_per_project: int = 10
+    project_prefix: str = "PRJ"
+    bitbucket_page_limit: int = 1000  # the largest page Bitbucket hands out, whatever the client asks
+    gitea_page_limit: int = 50
+    latency: float = 0.0
+    migrate_latency: float = 0.0
+    error_rate: float = 0.0
+    lfs_ratio: float = 0.0
+    seed: int = 0
+
+
+@dataclass
+class FakeState:
+    config: FakeServerConfig
+    projects: list[dict] = field(default_factory=list)
+    repos: dict[str, list[dict]] = field(default_factory=dict)  # Bitbucket repositories by project key
+    gitea_orgs: set[str] = field(default_factory=set)
+    gitea_repos: set[str] = field(default_factory=set)  # "owner/name", lowercase
+    gitea_migrating: set[str] = field(default_factory=set)  # repositories still reported as being_migrated
+    calls: Counter[tuple[str, str]] = field(default_factory=Counter)  # (method, route) -> count
+    failures: Counter[tuple[str, str]] = field(default_factory=Counter)  # (method, route) -> next requests answered 503
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+
+def build_state(config: FakeServerConfig, base_url: str) -> FakeState:
+    """
+    Generate the Bitbucket inventory described by the config. Gitea starts empty.
+    """
+    rng = random.Random(config.seed)
+    state = FakeState(config=config)
+    repo_id = 0
+    for idx in range(config.projects):
+        key = f"{config.project_prefix}{idx:04d}"
+        state.projects.append({"key": key, "id": idx, "name": f"Project {idx}", "description": "", "links": {"self": [{"href": f"{base_url}/projects/{key}"}]}})
+        state.repos[key] = []
+        for number in range(config.repos_per_project):
+            repo_id += 1
+            slug = f"repo-{number:05d}"
+            state.repos[key].append(
+                {
+                    "id": repo_id,
+                    "slug": slug,
+                    "name": slug,
+                    "description": "",
+                    "links": {"clone": [{"name": "http", "href": f"{base_url}/scm/{key.lower()}/{slug}.git"}]},
+                    "size": rng.randint(1, 500) * 1024 * 1024,
+                    "lfs": rng.random() < config.lfs_ratio,
+                }
+            )
+    return state
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """
+    Just enough of the Bitbucket Server and Gitea REST APIs for the inventory and the migration.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body are written separately, avoid delayed-ACK stalls
+    server: "FakeServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, body=None, headers: dict[str, str] | None = None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, method: str):
+        state = self.server.state
+        config = state.config
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        body = self.read_body()  # always drain the body so the connection can be reused
+
+        if config.latency:
+            time.sleep(config.latency)
+        if config.error_rate and random.random() < config.error_rate:
+            self.count(method, "throttled")
+            return self.reply(429, {"message": "slow down"}, {"Retry-After": "0"})
+
+        for route_method, route, pattern, handler in COMPILED_ROUTES:
+            if route_method == method and (match := pattern.fullmatch(url.path)):
+                self.count(method, route)
+                with state.lock:
+                    failing = state.failures[(method, route)] > 0
+                    if failing:
+                        state.failures[(method, route)] -= 1
+                if failing:
+                    return self.reply(503, {"message": "unavailable"}, {"Retry-After": "0"})
+                return handler(self, state, query, body, *match.groups())
+        self.count(method, "unknown")
+        self.reply(404, {"message": f"no route for {method} {url.path}"})
+
+    def count(self, method: str, route: str):
+        with self.server.state.lock:
+            self.server.state.calls[(method, route)] += 1
+
+    # Bitbucket
+
+    def bitbucket_page(self, items: list, query: dict[str, str]):
+        start = int(query.get("start", 0))
+        limit = min(int(query.get("limit", 25)), self.server.state.config.bitbucket_page_limit)
+        page = items[start : start + limit]
+        is_last_page = start + limit >= len(items)
+        body = {"size": len(page), "limit": limit, "start": start, "isLastPage": is_last_page, "values": page}
+        if not is_last_page:
+            body["nextPageStart"] = start + limit
+        # Like Bitbucket, the validator only covers the page that was asked for
+        etag = f'"{hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self.reply(304, headers={"ETag": etag})
+        self.reply(200, body, headers={"ETag": etag})
+
+    def bitbucket_projects(self, state: FakeState, query, body):
+        self.bitbucket_page(state.projects, query)
+
+    def bitbucket_repos(self, state: FakeState, query, body, key):
+        if key not in state.repos:
+            return self.reply(404, {"errors": [{"message": f"Project {key} does not exist."}]})
+        self.bitbucket_page(state.repos[key], query)
+
+    def bitbucket_sizes(self, state: FakeState, query, body, key, slug):
+        repo = next((repo for repo in state.repos.get(key.upper(), []) if repo["slug"] == slug), None)
+        if repo is None:
+            return self.reply(404, {})
+        self.reply(200, {"repository": repo["size"], "attachments": 0})
+
+    def bitbucket_lfs(self, state: FakeState, query, body, key, slug):
+        repo = next((repo for repo in state.repos.get(key.upper(), []) if repo["slug"] == slug), None)
+        self.reply(204 if repo and repo["lfs"] else 404)
+
+    # Gitea
+
+    def gitea_page(self, items: list, query: dict[str, str], wrap: bool = False):
+        limit = min(int(query.get("limit", 50)), self.server.state.config.gitea_page_limit)
+        page = int(query.get("page", 1))
+        values = items[(page - 1) * limit : page * limit]
+        self.reply(200, {"ok": True, "data": values} if wrap else values, {"X-Total-Count": str(len(items))})
+
+    def gitea_orgs(self, state: FakeState, query, body):
+        with state.lock:
+            orgs = sorted(state.gitea_orgs)
+        self.gitea_page([{"username": org} for org in orgs], query)
+
+    def gitea_get_org(self, state: FakeState, query, body, org):
+        self.reply(200 if org.lower() in state.gitea_orgs else 404, {"username": org})
+
+    def gitea_create_org(self, state: FakeState, query, body):
+        with state.lock:
+            if body["username"].lower() in state.gitea_orgs:
+                return self.reply(422, {"message": "user already exists"})
+            state.gitea_orgs.add(body["username"].lower())
+        self.reply(201, body)
+
+    def gitea_search(self, state: FakeState, query, body):
+        with state.lock:
+            repos = sorted(state.gitea_repos)
+        self.gitea_page([{"owner": {"login": key.split("/")[0]}, "name": key.split("/")[1], "mirror": False, "empty": False} for key in repos], query, wrap=True)
+
+    def gitea_get_repo(self, state: FakeState, query, body, owner, name):
+        key = f"{owner}/{name}".lower()
+        if key not in state.gitea_repos:
+            return self.reply(404, {})
+        status = "being_migrated" if key in state.gitea_migrating else "ready"
+        self.reply(200, {"name": name, "empty": False, "status": status})
+
+    def gitea_delete_repo(self, state: FakeState, query, body, owner, name):
+        key = f"{owner}/{name}".lower()
+        with state.lock:
+            existed = key in state.gitea_repos
+            state.gitea_repos.discard(key)
+        self.reply(204 if existed else 404)
+
+    def gitea_create_repo(self, state: FakeState, query, body, owner):
+        self.add_gitea_repo(state, owner, body["name"])
+
+    def gitea_migrate(self, state: FakeState, query, body):
+        if state.config.migrate_latency:
+            time.sleep(state.config.migrate_latency)
+        self.add_gitea_repo(state, body["repo_owner"], body["repo_name"])
+
+    def add_gitea_repo(self, state: FakeState, owner: str, name: str):
+        key = f"{owner}/{name}".lower()
+        with state.lock:
+            if owner.lower() not in state.gitea_orgs:
+                return self.reply(422, {"message": "owner does not exist"})
+            if key in state.gitea_repos:
+                return self.reply(409, {"message": "repository already exists"})
+            state.gitea_repos.add(key)
+        self.reply(201, {"name": name, "owner": {"login": owner}})
+
+
+ROUTES = [
+    ("GET", "/rest/api/1.0/projects", FakeHandler.bitbucket_projects),
+    ("GET", "/rest/api/1.0/projects/{key}/repos", FakeHandler.bitbucket_repos),
+    ("GET", "/projects/{key}/repos/{slug}/sizes", FakeHandler.bitbucket_sizes),
+    ("GET", "/rest/git-lfs/admin/projects/{key}/repos/{slug}/enabled", FakeHandler.bitbucket_lfs),
+    ("GET", "/api/v1/orgs", FakeHandler.gitea_orgs),
+    ("POST", "/api/v1/orgs", FakeHandler.gitea_create_org),
+    ("GET", "/api/v1/orgs/{org}", FakeHandler.gitea_get_org),
+    ("POST", "/api/v1/orgs/{org}/repos", FakeHandler.gitea_create_repo),
+    ("GET", "/api/v1/repos/search", FakeHandler.gitea_search),
+    ("POST", "/api/v1/repos/migrate", FakeHandler.gitea_migrate),
+    ("GET", "/api/v1/repos/{owner}/{name}", FakeHandler.gitea_get_repo),
+    ("DELETE", "/api/v1/repos/{owner}/{name}", FakeHandler.gitea_delete_repo),
+]
+# The route templates double as the labels of the request counts
+COMPILED_ROUTES = [(method, route, re.compile(re.sub(r"\\\{\w+\\\}", "([^/]+)", re.escape(route))), handler) for method, route, handler in ROUTES]
+
+
+class FakeServer(ThreadingHTTPServer):
+    """
+    Local stand-in for Bitbucket and Gitea, served from a background thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, config: FakeServerConfig | None = None, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), FakeHandler)
+        self.state = build_state(config or FakeServerConfig(), self.url)
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-server", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reset(self, config: FakeServerConfig):
+        self.state = build_state(config, self.url)
+
+    def start(self) -> "FakeServer":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
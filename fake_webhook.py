@@ -0,0 +1,93 @@
+"""
+Send Bitbucket Server repo:refs_changed webhooks for repositories of the CSV, to exercise
+the sync daemon locally.
+
+    uv run fake_webhook.py http://localhost:8080/webhook --events 200 --repos 5 --rate 50
+
+Pushes are spread over a few repositories at the given rate, so the daemon should
+coalesce them into about one sync per repository.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+import niquests
+
+from config import settings
+from gitea_migrate import CSV_REPOSITORIES, read_repositories
+from log_config import logger
+from models import BitbucketRepo
+
+
+def refs_changed_event(repo: BitbucketRepo, ref: str = "refs/heads/master") -> dict:
+    """
+    A repo:refs_changed payload as Bitbucket Server sends it, trimmed to what matters.
+    """
+    return {
+        "eventKey": "repo:refs_changed",
+        "date": datetime.now(timezone.utc).isoformat(),
+        "actor": {"name": "fake", "displayName": "Fake Pusher"},
+        "repository": {
+            "slug": repo.slug,
+            "name": repo.name,
+            "project": {"key": repo.project_key.upper(), "name": repo.projectname},
+        },
+        "changes": [
+            {
+                "ref": {"id": ref, "displayId": ref.rsplit("/", 1)[-1], "type": "BRANCH"},
+                "refId": ref,
+                "fromHash": uuid.uuid4().hex + uuid.uuid4().hex[:8],
+                "toHash": uuid.uuid4().hex + uuid.uuid4().hex[:8],
+                "type": "UPDATE",
+            }
+        ],
+    }
+
+
+def send_event(session: niquests.Session, url: str, event: dict, secret: str = "") -> niquests.Response:
+    body = json.dumps(event).encode()
+    headers = {"Content-Type": "application/json", "X-Event-Key": event["eventKey"], "X-Request-Id": str(uuid.uuid4())}
+    if secret:
+        headers["X-Hub-Signature"] = f"sha256={hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()}"
+    return session.post(url, data=body, headers=headers)  # type: ignore
+
+
+def send_events(url: str, repos: list[BitbucketRepo], events: int, rate: float, secret: str = "", seed: int = 0) -> dict[str, int]:
+    """
+    Send `events` pushes to randomly chosen repositories, `rate` per second. Returns the pushes per repository.
+    """
+    rng = random.Random(seed)
+    pushes: dict[str, int] = {}
+    with niquests.Session() as session:
+        for _ in range(events):
+            repo = rng.choice(repos)
+            response = send_event(session, url, refs_changed_event(repo), secret)
+            response.raise_for_status()
+            pushes[f"{repo.project}/{repo.newname}"] = pushes.get(f"{repo.project}/{repo.newname}", 0) + 1
+            if rate:
+                time.sleep(1 / rate)
+    return pushes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("url", nargs="?", default=f"http://localhost:{settings.SYNC_WEBHOOK_PORT}{settings.SYNC_WEBHOOK_PATH}")
+    parser.add_argument("--csv", type=Path, default=CSV_REPOSITORIES)
+    parser.add_argument("--events", type=int, default=100)
+    parser.add_argument("--repos", type=int, default=5, help="number of distinct repositories pushed to")
+    parser.add_argument("--rate", type=float, default=50.0, help="events per second, 0 for as fast as possible")
+    args = parser.parse_args()
+
+    repos = read_repositories(args.csv)[: args.repos]
+    started_at = time.monotonic()
+    pushes = send_events(args.url, repos, args.events, args.rate, settings.SYNC_WEBHOOK_SECRET)
+    logger.info(f"Sent {args.events} webhooks to {len(pushes)} repositories in {time.monotonic() - started_at:.1f}s")
+    for key, count in sorted(pushes.items()):
+        logger.info(f"  {key}: {count} pushes")
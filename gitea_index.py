@@ -0,0 +1,131 @@
+import threading
+from dataclasses import dataclass, field
+
+import niquests
+
+from config import settings
+from http_client import get_session
+from log_config import logger
+from retry import RetryPolicy, request_with_retry
+
+
+@dataclass
+class GiteaRepo:
+    owner: str
+    name: str
+    mirror: bool = False
+    empty: bool = False
+    archived: bool = False
+    size: int = 0  # in KiB, as reported by Gitea
+
+
+@dataclass
+class GiteaIndex:
+    """
+    In-memory index of the organizations and repositories that exist in Gitea.
+
+    Gitea owner and repository names are case-insensitive, so lookups are too.
+    """
+
+    orgs: set[str] = field(default_factory=set)
+    repos: dict[str, GiteaRepo] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def has_org(self, org: str) -> bool:
+        return org.lower() in self.orgs
+
+    def has_repo(self, org: str, name: str) -> bool:
+        return f"{org}/{name}".lower() in self.repos
+
+    def get_repo(self, org: str, name: str) -> GiteaRepo | None:
+        return self.repos.get(f"{org}/{name}".lower())
+
+    def add_org(self, org: str):
+        with self._lock:
+            self.orgs.add(org.lower())
+
+    def add_repo(self, repo: GiteaRepo):
+        with self._lock:
+            self.repos[f"{repo.owner}/{repo.name}".lower()] = repo
+
+    def remove_repo(self, org: str, name: str):
+        with self._lock:
+            self.repos.pop(f"{org}/{name}".lower(), None)
+
+
+def list_all_pages(url: str, headers: dict[str, str], key: str | None = None) -> list[dict]:
+    """
+    Fetch every page of a paginated Gitea listing.
+
+    The first page tells us the total via X-Total-Count, then all remaining pages are
+    requested at once over a multiplexed connection. `key` selects the list inside a
+    wrapped response such as {"ok": true, "data": [...]} from /repos/search.
+
+    Gitea caps `limit` at its MAX_RESPONSE_ITEMS without saying so, so the page size is
+    the length of the first page. Should the listing still come up short (it changed
+    while paging), the following pages are fetched one by one until one is not full.
+    """
+    session = get_session(url, multiplexed=True)
+    limit = settings.GITEA_PAGE_LIMIT
+    separator = "&" if "?" in url else "?"
+
+    def page_url(page: int) -> str:
+        return f"{url}{separator}page={page}&limit={limit}"
+
+    def items(response: niquests.Response) -> list[dict]:
+        response.raise_for_status()
+        data = response.json()
+        return data[key] if key else data
+
+    first = request_with_retry(session, "GET", page_url(1), headers=headers, verify=False)
+    results = items(first)
+    total = int(first.headers.get("X-Total-Count", len(results)))
+    page_size = len(results) or limit
+    if page_size < limit and total > page_size:
+        logger.debug(f"Gitea returned {page_size} items per page for limit={limit}, it caps the page size")
+    pages = -(-total // page_size)
+
+    if pages > 1:
+        retry_statuses = RetryPolicy().statuses
+        responses = {page: session.get(page_url(page), headers=headers, verify=False) for page in range(2, pages + 1)}  # type: ignore
+        session.gather()
+        for page, response in responses.items():
+            if response.status_code in retry_statuses:
+                # Throttled pages are fetched again one by one, with backoff
+                response = request_with_retry(get_session(url), "GET", page_url(page), headers=headers, verify=False)
+            results.extend(items(response))
+
+    page = pages
+    last_page_full = len(results) == page * page_size
+    while last_page_full and len(results) < total:
+        page += 1
+        page_items = items(request_with_retry(get_session(url), "GET", page_url(page), headers=headers, verify=False))
+        results.extend(page_items)
+        last_page_full = len(page_items) >= page_size
+
+    return results
+
+
+def build_gitea_index(headers: dict[str, str]) -> GiteaIndex:
+    """
+    Page through Gitea's organization and repository listings once and index them.
+    """
+    index = GiteaIndex()
+
+    for org in list_all_pages(f"{settings.GITEA_API_URL}/orgs", headers):
+        index.add_org(org["username"])
+
+    for repo in list_all_pages(f"{settings.GITEA_API_URL}/repos/search", headers, key="data"):
+        index.add_repo(
+            GiteaRepo(
+                owner=repo["owner"]["login"],
+                name=repo["name"],
+                mirror=repo.get("mirror", False),
+                empty=repo.get("empty", False),
+                archived=repo.get("archived", False),
+                size=repo.get("size", 0),
+            )
+        )
+
+    logger.info(f"Indexed {len(index.orgs)} organizations and {len(index.repos)} repositories in Gitea")
+    return index
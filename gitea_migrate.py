@@ -1,14 +1,28 @@
+import base64
 import csv
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterable, Iterator
+from urllib.parse import urlparse
 
 import niquests
 from loguru import logger
-from niquests.auth import HTTPBasicAuth
 
-from bitbucket_repos import list_repositories
+import azure_devops
+from bitbucket_repos import has_branches, list_repositories
+from catalogue import Catalogue
 from config import settings
-from models import BitbucketRepo
+from gitea_index import GiteaIndex, GiteaRepo, build_gitea_index, list_all_pages
+from http_client import get_session
+from metrics import span
+from mirror_cache import MirrorCache, get_mirror_cache
+from models import BitbucketRepo, MigrationResult, MigrationStatus, TrackedMigration
+from retry import REJECTED_STATUSES, RETRY_STATUSES, AdaptiveLimiter, RetryPolicy, request_with_retry
+from scheduler import run_migration
+from state_store import MigrationStateStore
+from targets import LocalMirrorTarget, MigrationTarget
 
 # API endpoint for repository migrations
 GITEA_MIGRATE_API_URL = f"{settings.GITEA_API_URL}/repos/migrate"
@@ -27,7 +41,12 @@ HEADERS = {
     "accept": "application/json",
 }
 
-_existing_org: list[str] = []
+# Caps the number of in-flight migrate requests per Gitea host, shared by all workers
+_host_limiters: dict[str, AdaptiveLimiter] = {}
+_host_limiters_lock = threading.Lock()
+
+# The migrate POST is not idempotent, only retry it when Gitea certainly did not start the migration
+MIGRATE_RETRY_POLICY = RetryPolicy(statuses=REJECTED_STATUSES)
 
 
 # def delete_existing_repo(repo_name: str, session: niquests.Session):
@@ -112,9 +131,10 @@ _existing_org: list[str] = []
 #         logger.error(f"Failed to migrate {repo_name}: {response.status_code} - {response.json()}")
 
 
-def build_payload(repo: BitbucketRepo) -> dict[str, Any]:
+def build_payload(repo: BitbucketRepo, lfs: bool = True) -> dict[str, Any]:
     """
-    Build the payload to migrate or update a repository in Gitea.
+    Build the payload to migrate or update a repository in Gitea. Without `lfs`, Gitea
+    leaves the LFS objects to the LFS transfer stage.
     """
     auth_clone_url = repo.link.replace("https://", f"https://{settings.BITBUCKET_USERNAME}:{settings.BITBUCKET_PASSWORD}@")
     payload: dict[str, Any] = {
@@ -126,223 +146,487 @@ def build_payload(repo: BitbucketRepo) -> dict[str, Any]:
         "private": False,
         "releases": True,
         "pull_requests": True,
-        "lfs": True,
+        "lfs": lfs,
         # "issues": True,
     }
     return payload
 
 
-def process_repository(repo: BitbucketRepo, session: niquests.Session):
+def host_limiter(url: str) -> AdaptiveLimiter:
+    """
+    Return the limiter capping in-flight migrations on the host of the given URL.
+
+    It starts at GITEA_HOST_CONCURRENCY and adapts to the throttling the host reports.
     """
-    1. Check if the repo.project (organization) exists in Gitea. If not, create it.
+    host = urlparse(url).netloc
+    with _host_limiters_lock:
+        limiter = _host_limiters.get(host)
+        if limiter is None:
+            limiter = AdaptiveLimiter(f"Gitea {host}", settings.GITEA_HOST_CONCURRENCY)
+            _host_limiters[host] = limiter
+        return limiter
+
+
+def process_repository(
+    repo: BitbucketRepo,
+    session: niquests.Session,
+    organizations: frozenset[str],
+    replace_existing: bool = False,
+    index: GiteaIndex | None = None,
+    submit_timeout: float | None = None,
+    mirror_cache: MirrorCache | None = None,
+) -> MigrationResult:
+    """
+    1. Check that the repo.project (organization) was provisioned, see `provision_organizations`.
     2. Check if the repo.newname (repository) exists in the organization.
         - If not, create a mirror from Bitbucket.
-        - If it exists, update it from the original Bitbucket repo.
-    """
-    global _existing_org
-
-    # Step 1: Check if the organization exists
-    if repo.project not in _existing_org:
-        org_url = f"{settings.GITEA_API_URL}/orgs/{repo.project}"
-        org_response = session.get(org_url, headers=HEADERS)  # type: ignore
-
-        if org_response.status_code == 404:
-            logger.info(f"Organization '{repo.project}' not found in Gitea. Creating it...")
-            org_data = {
-                "username": repo.project,
-                "full_name": repo.projectname,
-                "description": repo.description,
-                "visibility": "public",
-            }
-            create_org_response = session.post(  # type: ignore
-                f"{settings.GITEA_API_URL}/orgs",
-                headers=HEADERS,
-                json=org_data,
-                verify=False,
-            )
-            if create_org_response.status_code == 201:
-                logger.success(f"Organization '{repo.project}' created successfully.")
-                # Write globally that this organization has been created for future faster checks
-                _existing_org.append(repo.project)
-            else:
-                logger.error(f"Failed to create organization '{repo.project}': {create_org_response.text}")
-                return
-        else:
-            logger.debug(f"Organization '{repo.project}' already exists in Gitea.")
+        - If it exists, skip it unless DELETE_EXISTING_REPOS or replace_existing is set,
+          in which case it is deleted and migrated again.
+
+    With a pre-built index the repository check is answered from memory instead of a GET.
+
+    With a submit_timeout, the migration is submitted without waiting for it to complete:
+    if Gitea has not answered by then it keeps migrating server-side, and the result is
+    IN_PROGRESS for the caller to poll. Nothing is deleted in that case.
+
+    With a mirror cache, an empty repository is created and pushed to from the local
+    mirror instead, except for LFS repositories which Gitea still migrates itself.
+
+    With LFS_TRANSFER_ENABLED, the LFS objects of a synchronous migration are copied
+    afterwards by `lfs_transfer.transfer_lfs_objects`, in parallel and skipping those
+    already in Gitea. Mirrors and asynchronous migrations keep Gitea's own LFS fetch.
+    """
+    # Step 1: Organizations are all created before the migration starts
+    if repo.project.lower() not in organizations:
+        logger.error(f"Organization '{repo.project}' does not exist in Gitea, skipping {repo.newname}")
+        return MigrationResult(MigrationStatus.FAILED, error="organization not provisioned")
 
     # Step 2: Check if the repository exists
-    repo_url = f"{settings.GITEA_API_URL}/repos/{repo.project}/{repo.newname}"
-    repo_response = session.get(repo_url, headers=HEADERS)  # type: ignore
+    if index is not None:
+        repo_exists = index.has_repo(repo.project, repo.newname)
+    else:
+        repo_url = f"{settings.GITEA_API_URL}/repos/{repo.project}/{repo.newname}"
+        with span("gitea.repo_check"):
+            repo_response = request_with_retry(session, "GET", repo_url, headers=HEADERS)
+        repo_exists = repo_response.status_code != 404
 
-    if not repo_response.status_code == 404 and not DELETE_EXISTING_REPOS:
+    replace = DELETE_EXISTING_REPOS or replace_existing
+    if repo_exists and not replace:
         logger.info(f"Repository '{repo.newname}' already exists in Gitea. Ignoring it...")
-        return
+        return MigrationResult(MigrationStatus.SKIPPED)
 
-    payload = build_payload(repo)
+    lfs_stage = settings.LFS_TRANSFER_ENABLED and repo.lfs and not settings.GITEA_SET_AS_MIRROR and not submit_timeout
+    payload = build_payload(repo, lfs=not lfs_stage)
 
     # Clone the repository from Bitbucketaa
     try:
-        if DELETE_EXISTING_REPOS:
+        if replace and repo_exists:
             logger.info(f"Deleting existing repository: {repo.newname}...")
             delete_repo(repo.project, repo.newname)
 
+        if mirror_cache is not None and (lfs_stage or not repo.lfs):
+            result = push_from_cache(repo, session, mirror_cache, index)
+            return transfer_lfs(repo, result, mirror_cache) if lfs_stage else result
+
         # Migrate the repository
         logger.info(f"Migrating repository: {repo.newname} from {repo.link}... {payload}")
-        response = session.post(GITEA_MIGRATE_API_URL, json=payload, headers=HEADERS, verify=False, timeout=1800)  # type: ignore
+        with span("gitea.migrate") as migrate_span:
+            response = request_with_retry(
+                session,
+                "POST",
+                GITEA_MIGRATE_API_URL,
+                policy=MIGRATE_RETRY_POLICY,
+                limiter=host_limiter(GITEA_MIGRATE_API_URL),
+                json=payload,
+                headers=HEADERS,
+                verify=False,
+                timeout=submit_timeout or 1800,
+            )
+            migrate_span.error = response.status_code != 201
 
+    except niquests.exceptions.ReadTimeout:
+        if submit_timeout:
+            logger.info(f"Migration of {repo.newname} submitted, Gitea is still working on it")
+            return MigrationResult(MigrationStatus.IN_PROGRESS)
+        logger.error(f"Timeout error while setting up repository: {repo.newname}")
+        try:
+            delete_repo(repo.project, repo.newname)
+        except niquests.exceptions.RequestException as e:
+            logger.error(f"Error while setting up repository: {repo.newname} - {e}")
+        return MigrationResult(MigrationStatus.FAILED, error="timeout")
     except niquests.exceptions.Timeout:
         logger.error(f"Timeout error while setting up repository: {repo.newname}")
         try:
             delete_repo(repo.project, repo.newname)
         except niquests.exceptions.RequestException as e:
             logger.error(f"Error while setting up repository: {repo.newname} - {e}")
-        return
+        return MigrationResult(MigrationStatus.FAILED, error="timeout")
     except niquests.exceptions.RequestException as e:
         logger.error(f"Error while setting up repository: {repo.newname} - {e}")
         try:
             delete_repo(repo.project, repo.newname)
         except niquests.exceptions.RequestException as e:
             logger.error(f"Error while setting up repository: {repo.newname} - {e}")
-        return
+        return MigrationResult(MigrationStatus.FAILED, error=str(e))
 
     if response.status_code == 201:
         logger.success(f"Successfully set up repository: {repo.newname}")
-    else:
-        logger.error(f"Error: {response.text}")
-        logger.error(f"Failed to migrate {repo.newname}: {response.status_code} - {response.json()}")
+        if index is not None:
+            index.add_repo(GiteaRepo(owner=repo.project, name=repo.newname, mirror=settings.GITEA_SET_AS_MIRROR))
+        result = MigrationResult(MigrationStatus.DONE, response.status_code)
+        return transfer_lfs(repo, result, mirror_cache) if lfs_stage else result
 
+    logger.error(f"Error: {response.text}")
+    logger.error(f"Failed to migrate {repo.newname}: {response.status_code} - {response.text}")
+    return MigrationResult(MigrationStatus.FAILED, response.status_code, response.text[:500])
 
-def migrate_repositories(csv_file: Path):
-    # Get the repositories from the CSV file
-    with open(csv_file, "r", newline="") as f:
-        data = list(csv.DictReader(f))
-        repositories = [BitbucketRepo(**row) for row in data]
 
-    total_repos = len(repositories)
-    for idx, repo in enumerate(repositories):
-        logger.info(f"{idx + 1}/{total_repos} Migrating: {repo.project} - {repo.name} - {repo.link}")
-        process_repository(repo, niquests.Session())
+def transfer_lfs(repo: BitbucketRepo, result: MigrationResult, mirror_cache: MirrorCache | None = None) -> MigrationResult:
+    """
+    Run the LFS transfer stage after a successful migration. The git data stays: when some
+    objects could not be copied, the repository is LFS_INCOMPLETE, and a rerun (or
+    lfs_transfer.py) only copies the missing objects.
+    """
+    from lfs_transfer import transfer_lfs_objects  # it imports this module
+
+    if result.status != MigrationStatus.DONE:
+        return result
+    lfs = transfer_lfs_objects(repo, mirror_cache)
+    if lfs.error:
+        return MigrationResult(MigrationStatus.LFS_INCOMPLETE, result.http_status, f"LFS objects not transferred: {lfs.error}")
+    if lfs.failed:
+        return MigrationResult(MigrationStatus.LFS_INCOMPLETE, result.http_status, f"{len(lfs.failed)} of {lfs.objects} LFS objects missing")
+    return result
+
+
+def gitea_git_auth_header() -> str:
+    # Gitea accepts an access token as the password of git HTTP basic auth
+    credentials = base64.b64encode(f"{settings.GITEA_USERNAME or 'oauth2'}:{settings.GITEA_TOKEN}".encode()).decode()
+    return f"Authorization: Basic {credentials}"
+
+
+def push_from_cache(repo: BitbucketRepo, session: niquests.Session, mirror_cache: MirrorCache, index: GiteaIndex | None = None) -> MigrationResult:
+    """
+    Create an empty repository in Gitea and push branches and tags to it from the mirror cache.
+    """
+    create_url = f"{settings.GITEA_API_URL}/orgs/{repo.project}/repos"
+    payload = {"name": repo.newname, "description": repo.description, "private": False}
+    with span("gitea.repo_create") as create_span:
+        response = request_with_retry(session, "POST", create_url, policy=MIGRATE_RETRY_POLICY, json=payload, headers=HEADERS, verify=False)
+        create_span.error = response.status_code != 201
+    if response.status_code != 201:
+        logger.error(f"Failed to create repository '{repo.project}/{repo.newname}': {response.status_code} - {response.text}")
+        return MigrationResult(MigrationStatus.FAILED, response.status_code, response.text[:500])
+
+    with span("gitea.push") as push_span:
+        error = mirror_cache.push(repo, f"{settings.GITEA_URL.rstrip('/')}/{repo.project}/{repo.newname}.git", gitea_git_auth_header())
+        push_span.error = error is not None
+    if error:
+        logger.error(f"Failed to push {repo.newname} to Gitea: {error}")
+        delete_repo(repo.project, repo.newname)
+        return MigrationResult(MigrationStatus.FAILED, error=error)
+
+    logger.success(f"Successfully pushed repository: {repo.newname}")
+    if index is not None:
+        index.add_repo(GiteaRepo(owner=repo.project, name=repo.newname))
+    return MigrationResult(MigrationStatus.DONE, response.status_code)
+
+
+def collect_organizations(repositories: Iterable[BitbucketRepo]) -> dict[str, str]:
+    """
+    Return the organizations the repositories go to, mapped to their full name (the Bitbucket project name).
+    """
+    organizations: dict[str, str] = {}
+    for repo in repositories:
+        organizations.setdefault(repo.project, repo.projectname)
+    return organizations
+
 
+def create_organization(org: str, full_name: str, session: niquests.Session) -> bool:
+    """
+    Create an organization in Gitea. One that already exists counts as created.
+    """
+    org_data = {"username": org, "full_name": full_name, "visibility": "public"}
+    with span("gitea.org_create") as org_span:
+        response = request_with_retry(session, "POST", f"{settings.GITEA_API_URL}/orgs", headers=HEADERS, json=org_data, verify=False)
+        org_span.error = response.status_code not in (201, 422)
 
-def import_to_azure_devops(repositories: list[BitbucketRepo]):
-    # Azure DevOps organization and project details
-    organization = settings.AZURE_DEVOPS_ORGANIZATION
-    project = settings.AZURE_DEVOPS_PROJECT
-    pat = settings.AZURE_DEVOPS_TOKEN
+    if response.status_code == 201:
+        logger.success(f"Organization '{org}' created successfully.")
+        return True
+    if response.status_code == 422 and "already exists" in response.text:
+        # Created since we checked (or by an earlier attempt whose response was lost)
+        logger.debug(f"Organization '{org}' already exists in Gitea.")
+        return True
+    logger.error(f"Failed to create organization '{org}': {response.status_code} - {response.text}")
+    return False
+
+
+def existing_orgs(orgs: Iterable[str]) -> set[str]:
+    """
+    Return which of the organizations exist in Gitea, checked in one multiplexed wave.
+    """
+    session = get_session(settings.GITEA_API_URL, multiplexed=True)
+    with span("gitea.org_check_wave"):
+        responses = [(org, session.get(f"{settings.GITEA_API_URL}/orgs/{org}", headers=HEADERS, verify=False)) for org in orgs]  # type: ignore
+        session.gather()
+    found: set[str] = set()
+    for org, response in responses:
+        if response.status_code in RETRY_STATUSES:
+            # Throttled checks are sent again one by one, with backoff
+            response = request_with_retry(get_session(settings.GITEA_API_URL), "GET", f"{settings.GITEA_API_URL}/orgs/{org}", headers=HEADERS, verify=False)
+        if response.status_code not in (200, 404):
+            response.raise_for_status()
+        if response.status_code == 200:
+            found.add(org)
+    return found
 
-    # Azure DevOps REST API base URL
-    base_url = f"https://dev.azure.com/{organization}/{project}/_apis/git/repositories"
 
-    # # Test if I can reach the DevAzure API endpoint with my token
-    # url = settings.AZURE_DEVOPS_URL
-    # Headers for the HTTP requests
-    headers = {"Content-Type": "application/json", "Accept": "application/json"}
+def provision_organizations(organizations: dict[str, str], index: GiteaIndex | None = None) -> frozenset[str]:
+    """
+    Make sure every organization exists in Gitea before any repository is migrated.
 
-    # TEST
-    response = niquests.get(base_url, headers=headers)  # type: ignore
-    if response.status_code == 203:
-        logger.success("Successfully connected to Azure DevOps")
+    The existing ones are answered by the index, or checked in one multiplexed wave without
+    it, and the missing ones are created concurrently (GITEA_HOST_CONCURRENCY at a time).
+    Returns the lowercase names of the organizations that exist, those that could not be
+    created are left out so their repositories fail without any request.
+    """
+    if index is not None:
+        missing = [org for org in organizations if not index.has_org(org)]
     else:
-        logger.error("Failed to connect to Azure DevOps")
+        found = existing_orgs(organizations)
+        missing = [org for org in organizations if org not in found]
+
+    existing = {org.lower() for org in organizations if org not in missing}
+    if missing:
+        logger.info(f"Creating {len(missing)} of {len(organizations)} organizations in Gitea")
+        session = get_session(settings.GITEA_API_URL)
+        with ThreadPoolExecutor(max_workers=max(1, settings.GITEA_HOST_CONCURRENCY), thread_name_prefix="provision") as executor:
+            created = list(executor.map(lambda org: create_organization(org, organizations[org], session), missing))
+        for org, ok in zip(missing, created):
+            if ok:
+                existing.add(org.lower())
+                if index is not None:
+                    index.add_org(org)
+
+    failed = len(organizations) - len(existing)
+    logger.info(f"Organizations ready: {len(existing)}" + (f", {failed} could not be created" if failed else ""))
+    return frozenset(existing)
+
+
+def iter_repositories(csv_file: Path) -> Iterator[BitbucketRepo]:
+    """
+    Read the repositories from the CSV file one row at a time.
+    """
+    with open(csv_file, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            yield BitbucketRepo(**row)
+
 
-    def create_repository(repo_name: str):
-        url = f"{base_url}?api-version=7.1"
+def read_repositories(csv_file: Path) -> list[BitbucketRepo]:
+    """
+    Get the repositories from the CSV file.
+    """
+    return list(iter_repositories(csv_file))
+
+
+class GiteaTarget(MigrationTarget):
+    """
+    Migrations through Gitea's /repos/migrate, optionally submitted without waiting
+    (MIGRATION_ASYNC) and polled: a repository whose status is no longer `being_migrated`
+    is a finished migration (Gitea copies releases, pull requests and LFS objects after
+    the git data, so a non-empty repository may still be in progress), one that
+    disappears after having been seen, or never shows up at all, failed in Gitea (which
+    creates the repository record before it starts cloning).
+    """
 
-        def get_project_id(project_name):
-            url = f"https://dev.azure.com/{organization}/_apis/projects/{project_name}?api-version=7.1"
-            response = niquests.get(url, headers=headers, auth=HTTPBasicAuth("", pat))
+    name = "gitea"
+
+    def __init__(self, asynchronous: bool | None = None, organizations: dict[str, str] | None = None):
+        self.asynchronous = settings.MIGRATION_ASYNC if asynchronous is None else asynchronous
+        self.poll_interval = settings.MIGRATION_POLL_INTERVAL
+        self.session = get_session(settings.GITEA_API_URL)
+        self.index: GiteaIndex | None = None
+        self.mirror_cache: MirrorCache | None = None
+        self.required_organizations = organizations or {}  # name -> full name, see `collect_organizations`
+        self.organizations: frozenset[str] = frozenset()
+
+    def prepare(self):
+        if settings.GITEA_PREFLIGHT_INDEX:
+            with span("gitea.index"):
+                self.index = build_gitea_index(HEADERS)
+        with span("gitea.provision"):
+            self.organizations = provision_organizations(self.required_organizations, self.index)
+        if settings.MIRROR_CACHE_ENABLED and settings.GITEA_SET_AS_MIRROR:
+            logger.warning("Gitea pull mirrors fetch from Bitbucket themselves, the mirror cache is not used")
+        elif settings.MIRROR_CACHE_ENABLED:
+            self.mirror_cache = get_mirror_cache()
+
+    def key(self, repo: BitbucketRepo) -> str:
+        return f"{repo.project}/{repo.newname}"
+
+    def plan(self, repo: BitbucketRepo) -> str:
+        if self.index is not None and self.index.has_repo(repo.project, repo.newname):
+            return "already in Gitea"
+        return "to migrate"
+
+    def migrate(self, repo: BitbucketRepo, replace_existing: bool = False) -> MigrationResult:
+        return process_repository(
+            repo,
+            self.session,
+            self.organizations,
+            replace_existing=replace_existing,
+            # A partial copy to replace may be newer than the index (e.g. left by another runner)
+            index=None if replace_existing else self.index,
+            submit_timeout=settings.MIGRATION_SUBMIT_TIMEOUT if self.asynchronous else None,
+            mirror_cache=self.mirror_cache,
+        )
+
+    def finish_lfs(self, repo: BitbucketRepo) -> MigrationResult:
+        logger.info(f"Copying the LFS objects still missing in {repo.project}/{repo.newname}")
+        return transfer_lfs(repo, MigrationResult(MigrationStatus.DONE), self.mirror_cache)
+
+    def source_is_empty(self, migration: TrackedMigration) -> bool:
+        """
+        Whether the Bitbucket repository has no branch, asked once per migration.
+        """
+        if migration.source_empty is None:
+            try:
+                migration.source_empty = not has_branches(migration.repo)
+            except (niquests.exceptions.RequestException, KeyError, ValueError) as e:
+                logger.warning(f"Could not check whether {migration.repo.project_key}/{migration.repo.slug} is empty: {e}")
+                return False
+        return migration.source_empty
+
+    def poll(self, tracked: list[TrackedMigration]) -> dict[str, MigrationResult]:
+        session = get_session(settings.GITEA_API_URL, multiplexed=True)
+        with span("gitea.poll_wave"):
+            responses = [(migration, session.get(f"{settings.GITEA_API_URL}/repos/{migration.key}", headers=HEADERS, verify=False)) for migration in tracked]  # type: ignore
+            session.gather()
+
+        now = time.monotonic()
+        results: dict[str, MigrationResult] = {}
+        for migration, response in responses:
             if response.status_code == 200:
-                return response.json()["id"]
-            else:
-                print(f"Failed to retrieve project ID for '{project_name}'. Status Code: {response.status_code}, Message: {response.text}")
-                return None
-
-        project_id = get_project_id(project)
-
-        payload = {"name": repo_name, "project": {"id": project_id}}  # type: ignore
-        response = niquests.post(url, json=payload, headers=headers, auth=HTTPBasicAuth("", pat))  # type: ignore
-        if response.status_code == 201:
-            print(f"Repository '{repo_name}' created successfully.")
-            return response.json()["id"]
-        elif response.status_code == 409:
-            print(f"Repository '{repo_name}' already exists.")
-            # Retrieve the existing repository ID
-            repo_id = get_repository_id(repo_name)
-            return repo_id
-        else:
-            print(f"Failed to create repository '{repo_name}'. Status Code: {response.status_code}, Message: {response.text}")
-            return None
-
-    # Function to get the repository ID by name
-    def get_repository_id(repo_name: str):
-        url = f"{base_url}/{repo_name}?api-version=7.1"
-        response = niquests.get(url, headers=headers, auth=HTTPBasicAuth("", pat))  # type: ignore
-        if response.status_code == 200:
-            return response.json()["id"]
-        else:
-            print(f"Failed to retrieve repository ID for '{repo_name}'. Status Code: {response.status_code}, Message: {response.text}")
-            return None
-
-    # Function to import a repository from an external Git source
-    def import_repository(repo_id: str, source_url: str, username: str, password: str):
-        url = f"https://dev.azure.com/{organization}/{project}/_apis/git/repositories/{repo_id}/importRequests?api-version=7.1"
-        payload = {"parameters": {"gitSource": {"url": source_url, "username": username, "password": password}}}
-        response = niquests.post(url, json=payload, headers=headers, auth=HTTPBasicAuth("", pat))  # type: ignore
-        if response.status_code == 201:
-            logger.success(f"Import request for repository ID '{repo_id}' created successfully.")
-        else:
-            logger.error(
-                f"Failed to create import request for repository ID '{repo_id}'. Status Code: {response.status_code}, Message: {response.text}"
-            )
+                migration.seen = True
+                data = response.json()
+                if "status" in data:
+                    finished = data["status"] != "being_migrated"
+                else:
+                    # Without a status, a non-empty repository is taken as migrated, and an empty
+                    # one if its source is empty too (there is nothing to wait for)
+                    finished = not data.get("empty", True) or self.source_is_empty(migration)
+                if finished:
+                    results[migration.key] = MigrationResult(MigrationStatus.DONE, 201)
+            elif response.status_code == 404 and migration.seen:
+                results[migration.key] = MigrationResult(MigrationStatus.FAILED, 404, "migration failed in Gitea")
+            elif response.status_code == 404 and now - migration.started_at > settings.MIGRATION_SUBMIT_TIMEOUT + 3 * self.poll_interval:
+                results[migration.key] = MigrationResult(MigrationStatus.FAILED, 404, "repository never appeared in Gitea")
+            elif response.status_code != 404:
+                logger.warning(f"Unexpected status while polling migration of {migration.key}: {response.status_code}")
+        return results
+
+
+# Backends selectable with MIGRATION_TARGET
+TARGETS: dict[str, type[MigrationTarget]] = {
+    "gitea": GiteaTarget,
+    "azure": azure_devops.AzureDevOpsTarget,
+    "local": LocalMirrorTarget,
+}
+
+
+def migrate_repositories(csv_file: Path, state: MigrationStateStore | None = None, target: MigrationTarget | None = None):
+    """
+    Migrate every repository listed in the CSV file to the target (MIGRATION_TARGET by default).
+    """
+    if target is None:
+        if settings.MIGRATION_TARGET not in TARGETS:
+            raise ValueError(f"Unknown MIGRATION_TARGET '{settings.MIGRATION_TARGET}', expected one of {', '.join(TARGETS)}")
+        target = TARGETS[settings.MIGRATION_TARGET]()
+    with Catalogue.open(csv_file) as catalogue:
+        if isinstance(target, GiteaTarget) and not target.required_organizations:
+            # From the catalogue index, one record per project: the organizations are provisioned before any repository
+            target.required_organizations = catalogue.organizations()
+        run_migration(target, catalogue, state or MigrationStateStore(settings.MIGRATION_STATE_DB))
+
+
+def import_to_azure_devops(repositories: list[BitbucketRepo] | None = None):
+    """
+    Import the repositories (by default those of the CSV file) into Azure DevOps.
+    """
+    return azure_devops.import_repositories(repositories if repositories is not None else read_repositories(CSV_REPOSITORIES))
+
 
-    # Read the CSV file and process each repository
-    with open(CSV_REPOSITORIES, mode="r") as file:
-        csv_reader = csv.DictReader(file)
-        for row in csv_reader:
-            repo_name = row["newname"]
-            source_url = row["link"]
-            # Step 1: Create the repository in Azure DevOps
-            logger.info(f"Processing repository: '{repo_name}' from '{source_url}'")
-
-            logger.info(f"Create repository: '{repo_name}'")
-            # repo_id = create_repository(repo_name)
-            repo_id = get_repository_id(repo_name)
-            logger.info(f"Repository ID: {repo_id}")
-            if repo_id:
-                # Step 2: Import the repository from the source URL
-                import_repository(repo_id, source_url, settings.BITBUCKET_USERNAME, settings.BITBUCKET_PASSWORD)
-
-
-def delete_orgs(orgs: list[str]):
-    for org in orgs:
-        delete_url = f"{GITEA_DELETE_ORG_API_URL}/{org}"
-        response = niquests.delete(delete_url, headers=HEADERS, verify=False)  # type: ignore
-        if response.status_code == 204:
-            logger.success(f"Successfully deleted existing org: {org}")
-        elif response.status_code == 404:
-            logger.info(f"Org '{org}' does not exist. Skipping deletion.")
-        else:
-            logger.error(f"Failed to delete org '{org}': {response.status_code} - {response.text}")
-
-
-def delete_repo(org: str, repo: str):
+def delete_org(org: str) -> bool:
+    """
+    Delete an organization, which Gitea only allows once it has no repositories left.
+    """
+    delete_url = f"{GITEA_DELETE_ORG_API_URL}/{org}"
+    response = request_with_retry(get_session(delete_url), "DELETE", delete_url, headers=HEADERS, verify=False)
+    if response.status_code == 204:
+        logger.success(f"Successfully deleted existing org: {org}")
+        return True
+    elif response.status_code == 404:
+        logger.info(f"Org '{org}' does not exist. Skipping deletion.")
+        return True
+    logger.error(f"Failed to delete org '{org}': {response.status_code} - {response.text}")
+    return False
+
+
+def delete_orgs(orgs: list[str]) -> list[str]:
+    """
+    Delete the organizations concurrently, returning those that could not be deleted.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, settings.GITEA_DELETE_CONCURRENCY), thread_name_prefix="delete") as executor:
+        deleted = list(executor.map(delete_org, orgs))
+    return [org for org, ok in zip(orgs, deleted) if not ok]
+
+
+def delete_repo(org: str, repo: str) -> bool:
     delete_url = f"{GITEA_DELETE_API_URL}/{org}/{repo}"
-    response = niquests.delete(delete_url, headers=HEADERS, verify=False)  # type: ignore
+    with span("gitea.repo_delete") as delete_span:
+        response = request_with_retry(get_session(delete_url), "DELETE", delete_url, headers=HEADERS, verify=False)
+        delete_span.error = response.status_code not in (204, 404)
     if response.status_code == 204:
         logger.success(f"Successfully deleted existing repository: {repo}")
+        return True
     elif response.status_code == 404:
         logger.info(f"Repository '{repo}' does not exist. Skipping deletion.")
-    else:
-        logger.error(f"Failed to delete repository '{repo}': {response.status_code} - {response.text}")
+        return True
+    logger.error(f"Failed to delete repository '{repo}': {response.status_code} - {response.text}")
+    return False
 
 
-def delete_all_repos_in_org(org: str):
-    repos = niquests.get(f"{GITEA_DELETE_ORG_API_URL}/{org}/repos", headers=HEADERS, verify=False)  # type: ignore
-    if repos.status_code == 200:
-        for repo in repos.json():
-            delete_repo(org, repo["name"])
-    else:
-        logger.error(f"Failed to list repositories: {repos.status_code} - {repos.text}")
+def archive_repo(org: str, repo: str) -> bool:
+    """
+    Mark a repository as archived (read-only) in Gitea.
+    """
+    repo_url = f"{settings.GITEA_API_URL}/repos/{org}/{repo}"
+    response = request_with_retry(get_session(repo_url), "PATCH", repo_url, headers=HEADERS, json={"archived": True}, verify=False)
+    if response.status_code == 200:
+        logger.success(f"Archived repository: {org}/{repo}")
+        return True
+    logger.error(f"Failed to archive repository '{org}/{repo}': {response.status_code} - {response.text}")
+    return False
+
+
+def list_org_repos(org: str) -> list[str]:
+    """
+    Names of all the repositories of an organization, every page of the listing.
+    """
+    return [repo["name"] for repo in list_all_pages(f"{GITEA_DELETE_ORG_API_URL}/{org}/repos", HEADERS)]
+
+
+def delete_all_repos_in_org(org: str) -> list[str]:
+    """
+    Delete every repository of the organization concurrently (GITEA_DELETE_CONCURRENCY at
+    a time), returning the names of those that could not be deleted.
+    """
+    repos = list_org_repos(org)
+    logger.info(f"Deleting {len(repos)} repositories of '{org}'")
+    with ThreadPoolExecutor(max_workers=max(1, settings.GITEA_DELETE_CONCURRENCY), thread_name_prefix="delete") as executor:
+        deleted = list(executor.map(lambda name: delete_repo(org, name), repos))
+    return [name for name, ok in zip(repos, deleted) if not ok]
 
 
 # Run the migration
@@ -0,0 +1,122 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import niquests
+from loguru import logger
+
+from bitbucket_repos import list_refs
+from config import settings
+from gitea_index import build_gitea_index
+from gitea_migrate import CSV_REPOSITORIES, HEADERS, read_repositories
+from http_client import get_session, log_pool_stats
+from models import BitbucketRepo
+from retry import request_with_retry
+
+
+@dataclass
+class RefComparison:
+    repo: BitbucketRepo
+    missing: list[str] = field(default_factory=list)  # in Bitbucket, not in Gitea
+    extra: list[str] = field(default_factory=list)  # in Gitea, no longer in Bitbucket
+    different: list[str] = field(default_factory=list)  # present in both, pointing elsewhere
+    error: str = ""
+
+    @property
+    def in_sync(self) -> bool:
+        return not (self.missing or self.extra or self.different or self.error)
+
+    def __str__(self) -> str:
+        if self.error:
+            return f"{self.repo.project}/{self.repo.newname}: {self.error}"
+        return f"{self.repo.project}/{self.repo.newname}: {len(self.missing)} missing, {len(self.extra)} extra, {len(self.different)} different refs"
+
+
+def list_gitea_refs(owner: str, name: str) -> dict[str, str]:
+    """
+    Return the branch and tag heads of a Gitea repository as {"refs/heads/main": sha, ...}.
+    """
+    url = f"{settings.GITEA_API_URL}/repos/{owner}/{name}/git/refs"
+    response = request_with_retry(get_session(url), "GET", url, headers=HEADERS, verify=False)
+    if response.status_code == 404:
+        # Gitea answers 404 for a repository without any refs yet
+        return {}
+    response.raise_for_status()
+    return {ref["ref"]: ref["object"]["sha"] for ref in response.json() if ref["ref"].startswith(("refs/heads/", "refs/tags/"))}
+
+
+def compare_refs(repo: BitbucketRepo) -> RefComparison:
+    """
+    Compare the Bitbucket branch/tag heads with the ones of the Gitea copy.
+    """
+    comparison = RefComparison(repo=repo)
+    try:
+        source = list_refs(repo)
+        target = list_gitea_refs(repo.project, repo.newname)
+    except niquests.exceptions.RequestException as e:
+        comparison.error = str(e)
+        return comparison
+
+    comparison.missing = sorted(source.keys() - target.keys())
+    comparison.extra = sorted(target.keys() - source.keys())
+    comparison.different = sorted(ref for ref in source.keys() & target.keys() if source[ref] != target[ref])
+    return comparison
+
+
+def mirror_sync(owner: str, name: str) -> bool:
+    """
+    Ask Gitea to fetch the latest updates of a mirrored repository.
+    """
+    sync_url = f"{settings.GITEA_API_URL}/repos/{owner}/{name}/mirror-sync"
+    response = request_with_retry(get_session(sync_url), "POST", sync_url, headers=HEADERS, verify=False)
+    if response.status_code == 200:
+        logger.success(f"Successfully triggered sync of repository: {owner}/{name}")
+        return True
+    elif response.status_code == 404:
+        logger.warning(f"Repository '{owner}/{name}' does not exist. Skipping sync.")
+    else:
+        logger.error(f"Failed to sync repository '{owner}/{name}': {response.status_code} - {response.text}")
+    return False
+
+
+def sync_repositories(csv_file: Path) -> list[RefComparison]:
+    """
+    Trigger mirror-sync only for the Gitea mirrors whose refs differ from Bitbucket.
+
+    Refs of all mirrors are compared concurrently first, then the changed ones are synced.
+    Returns the comparisons of the repositories that were out of date.
+    """
+    started_at = time.monotonic()
+    index = build_gitea_index(HEADERS)
+    repositories = []
+    for repo in read_repositories(csv_file):
+        gitea_repo = index.get_repo(repo.project, repo.newname)
+        if gitea_repo is None:
+            logger.debug(f"Repository '{repo.project}/{repo.newname}' is not in Gitea yet. Skipping it...")
+        elif not gitea_repo.mirror:
+            logger.debug(f"Repository '{repo.project}/{repo.newname}' is not a mirror. Skipping it...")
+        else:
+            repositories.append(repo)
+
+    logger.info(f"Comparing refs of {len(repositories)} mirrors with Bitbucket")
+    with ThreadPoolExecutor(max_workers=max(1, settings.SYNC_CONCURRENCY), thread_name_prefix="sync") as executor:
+        comparisons = list(executor.map(compare_refs, repositories))
+
+        changed = [comparison for comparison in comparisons if not comparison.in_sync and not comparison.error]
+        for comparison in comparisons:
+            if comparison.error:
+                logger.error(f"Failed to compare refs of {comparison}")
+            elif not comparison.in_sync:
+                logger.info(f"Out of date: {comparison}")
+
+        synced = sum(executor.map(lambda comparison: mirror_sync(comparison.repo.project, comparison.repo.newname), changed))
+
+    elapsed = time.monotonic() - started_at
+    logger.info(f"Checked {len(comparisons)} mirrors in {elapsed:.1f}s: {len(changed)} out of date, {synced} syncs triggered")
+    log_pool_stats()
+    return changed
+
+
+if __name__ == "__main__":
+    sync_repositories(CSV_REPOSITORIES)
@@ -0,0 +1,110 @@
+"""
+Delete every repository of the given Gitea organizations, then the organizations.
+
+    uv run gitea_teardown.py ORG [ORG ...] [--keep-orgs]
+    uv run gitea_teardown.py --all
+
+Meant for resetting a test Gitea: the listings are fully paginated, the repositories are
+deleted concurrently (GITEA_DELETE_CONCURRENCY at a time) and a final pass verifies that
+nothing is left.
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+
+from config import settings
+from gitea_index import list_all_pages
+from gitea_migrate import HEADERS, delete_orgs, delete_repo, existing_orgs, list_org_repos
+from http_client import log_pool_stats
+from log_config import logger
+from scheduler import log_progress
+
+
+@dataclass
+class TeardownResult:
+    deleted_repos: int = 0
+    failed_repos: list[str] = field(default_factory=list)
+    remaining_orgs: list[str] = field(default_factory=list)  # after the verification pass
+    remaining_repos: list[str] = field(default_factory=list)
+
+    @property
+    def clean(self) -> bool:
+        return not (self.failed_repos or self.remaining_orgs or self.remaining_repos)
+
+
+def delete_repositories(repos: list[tuple[str, str]]) -> list[str]:
+    """
+    Delete the (org, name) repositories concurrently with progress, returning the failed ones.
+    """
+    failed: list[str] = []
+    started_at = time.monotonic()
+    every = max(1, len(repos) // 20)
+    with ThreadPoolExecutor(max_workers=max(1, settings.GITEA_DELETE_CONCURRENCY), thread_name_prefix="delete") as executor:
+        futures = {executor.submit(delete_repo, org, name): f"{org}/{name}" for org, name in repos}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                ok = future.result()
+            except Exception as e:
+                logger.error(f"Failed to delete repository '{futures[future]}': {e}")
+                ok = False
+            if not ok:
+                failed.append(futures[future])
+            if done % every == 0 or done == len(repos):
+                log_progress(done, len(repos), started_at)
+    return failed
+
+
+def teardown(orgs: list[str], delete_organizations: bool = True) -> TeardownResult:
+    """
+    Delete all repositories of the organizations, then (unless told otherwise) the
+    organizations themselves, and verify that none of them is left.
+    """
+    started_at = time.monotonic()
+    result = TeardownResult()
+    orgs = sorted(existing_orgs(orgs))
+
+    repos = [(org, name) for org in orgs for name in list_org_repos(org)]
+    logger.info(f"Tearing down {len(repos)} repositories in {len(orgs)} organizations")
+    result.failed_repos = delete_repositories(repos)
+    result.deleted_repos = len(repos) - len(result.failed_repos)
+
+    if delete_organizations:
+        # Organizations that still hold a repository cannot be deleted
+        failed_orgs = {name.split("/")[0] for name in result.failed_repos}
+        delete_orgs([org for org in orgs if org not in failed_orgs])
+
+    # Verification pass, from fresh listings
+    result.remaining_orgs = sorted(existing_orgs(orgs)) if delete_organizations else []
+    for org in result.remaining_orgs if delete_organizations else orgs:
+        result.remaining_repos += [f"{org}/{name}" for name in list_org_repos(org)]
+
+    elapsed = time.monotonic() - started_at
+    logger.info(f"Deleted {result.deleted_repos} repositories in {elapsed:.1f}s ({result.deleted_repos / elapsed if elapsed else 0.0:.1f} repos/s)")
+    if result.clean:
+        logger.success(f"Teardown verified: nothing left of {len(orgs)} organizations")
+    else:
+        logger.error(f"Teardown incomplete: {len(result.remaining_orgs)} organizations and {len(result.remaining_repos)} repositories left")
+        for name in result.remaining_orgs + result.remaining_repos:
+            logger.error(f"Still in Gitea: {name}")
+    log_pool_stats()
+    return result
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("orgs", nargs="*", help="organizations to tear down")
+    parser.add_argument("--all", action="store_true", help="tear down every organization of the Gitea instance")
+    parser.add_argument("--keep-orgs", action="store_true", help="only delete the repositories")
+    args = parser.parse_args()
+    if bool(args.orgs) == args.all:
+        parser.error("give either organizations or --all")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    orgs = [org["username"] for org in list_all_pages(f"{settings.GITEA_API_URL}/orgs", HEADERS)] if args.all else args.orgs
+    result = teardown(orgs, delete_organizations=not args.keep_orgs)
+    exit(0 if result.clean else 1)
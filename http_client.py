@@ -0,0 +1,118 @@
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Callable
+from urllib.parse import urlparse
+
+import niquests
+
+from config import settings
+from log_config import logger
+
+
+@dataclass
+class PoolStats:
+    host: str
+    requests: int = 0
+    new_connections: int = 0
+    http_versions: Counter[str] = field(default_factory=Counter)
+
+    @property
+    def reused(self) -> int:
+        return self.requests - self.new_connections
+
+    @property
+    def reuse_ratio(self) -> float:
+        return self.reused / self.requests if self.requests else 0.0
+
+    def __str__(self) -> str:
+        versions = ", ".join(f"{version}: {count}" for version, count in sorted(self.http_versions.items()))
+        return (
+            f"{self.host} - {self.requests} requests over {self.new_connections} connections "
+            f"(reuse ratio {self.reuse_ratio:.1%}) [{versions}]"
+        )
+
+
+# One keep-alive session per (host, multiplexed) pair, shared by every module and thread
+_sessions: dict[tuple[str, bool], niquests.Session] = {}
+_stats: dict[str, PoolStats] = {}
+_extra_hooks: list[Callable[..., niquests.Response]] = []
+_lock = threading.Lock()
+
+
+def _host(url: str) -> str:
+    return urlparse(url).netloc or url
+
+
+def _record_response(response: niquests.Response, **kwargs) -> niquests.Response:
+    """
+    Response hook counting requests and freshly established connections per host.
+    """
+    host = _host(response.url or "")
+    conn_info = response.conn_info
+    # A non-zero establishment latency means this request paid for a new TCP (+TLS) handshake
+    is_new = conn_info is None or bool(conn_info.established_latency)
+
+    with _lock:
+        stats = _stats.setdefault(host, PoolStats(host=host))
+        stats.requests += 1
+        stats.new_connections += int(is_new)
+        stats.http_versions[f"HTTP/{response.http_version / 10:g}" if response.http_version else "unknown"] += 1
+
+    return response
+
+
+def get_session(url: str, multiplexed: bool = False) -> niquests.Session:
+    """
+    Return the shared session for the host of the given URL, creating it on first use.
+    HTTP/2 (and HTTP/3 where advertised) is negotiated automatically by niquests.
+    """
+    key = (_host(url), multiplexed)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            pool_size = max(settings.HTTP_POOL_MAXSIZE, settings.MIGRATION_CONCURRENCY, settings.GITEA_DELETE_CONCURRENCY, settings.VERIFY_CONCURRENCY, settings.LFS_TRANSFER_CONCURRENCY)
+            session = niquests.Session(multiplexed=multiplexed, pool_connections=pool_size, pool_maxsize=pool_size)
+            session.hooks["response"].append(_record_response)
+            session.hooks["response"].extend(_extra_hooks)
+            _sessions[key] = session
+            logger.debug(f"Opened shared HTTP session for {key[0]} (multiplexed={multiplexed}, pool size {pool_size})")
+        return session
+
+
+def add_response_hook(hook: Callable[..., niquests.Response]):
+    """
+    Register a response hook on every shared session, current and future (e.g. for benchmarks).
+    """
+    with _lock:
+        _extra_hooks.append(hook)
+        for session in _sessions.values():
+            session.hooks["response"].append(hook)
+
+
+def pool_stats() -> list[PoolStats]:
+    """
+    Return connection reuse statistics for every host contacted so far.
+    """
+    with _lock:
+        return [PoolStats(host=s.host, requests=s.requests, new_connections=s.new_connections, http_versions=Counter(s.http_versions)) for s in _stats.values()]
+
+
+def log_pool_stats():
+    for stats in pool_stats():
+        logger.info(f"HTTP pool: {stats}")
+
+
+def close_sessions():
+    """
+    Close every shared session and drop their keep-alive connections.
+    """
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def reset_pool_stats():
+    with _lock:
+        _stats.clear()
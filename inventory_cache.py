@@ -0,0 +1,134 @@
+import json
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+from log_config import logger
+from models import BitbucketRepo
+
+CACHE_FILENAME = "bitbucket_cache.json"
+DIFF_FILENAME = "bitbucket_inventory_diff.json"
+
+
+@dataclass
+class CachedProject:
+    key: str
+    fetched_at: float
+    etag: str = ""
+    last_modified: str = ""
+    # Listing pages the project took, 0 for entries written before this was recorded
+    pages: int = 0
+    # Bitbucket repository id -> repository, the id is what lets us detect renames
+    repos: dict[str, BitbucketRepo] = field(default_factory=dict)
+
+
+@dataclass
+class InventoryDiff:
+    added: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+    renamed: list[tuple[str, str]] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.renamed)
+
+    def __str__(self) -> str:
+        return f"{len(self.added)} added, {len(self.removed)} removed, {len(self.renamed)} renamed"
+
+
+class InventoryCache:
+    """
+    On-disk cache of the Bitbucket repository listing, one entry per project key.
+
+    Each entry keeps the conditional-request validators (ETag / Last-Modified) of the
+    project's first listing page, so unchanged projects cost a single 304 round trip,
+    or no request at all while the entry is younger than `ttl` seconds. Only projects
+    that fit on a single page are validated this way: a 304 on the first page says
+    nothing about the pages after it, so larger projects are always listed in full.
+    """
+
+    def __init__(self, path: Path | str = CACHE_FILENAME, ttl: int = 0):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.projects: dict[str, CachedProject] = {}
+        self.load()
+
+    def load(self):
+        if not self.path.exists():
+            return
+
+        with open(self.path, "r") as f:
+            data = json.load(f)
+
+        for key, entry in data.items():
+            repos = {repo_id: BitbucketRepo(**repo) for repo_id, repo in entry.pop("repos").items()}
+            self.projects[key] = CachedProject(**entry, repos=repos)
+        logger.debug(f"Loaded inventory cache with {len(self.projects)} projects from {self.path}")
+
+    def save(self):
+        data = {key: asdict(project) for key, project in sorted(self.projects.items())}
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=1)
+        tmp_path.replace(self.path)
+
+    def is_fresh(self, key: str) -> bool:
+        project = self.projects.get(key)
+        return project is not None and time.time() - project.fetched_at < self.ttl
+
+    def validators(self, key: str) -> dict[str, str]:
+        """
+        Conditional request headers for the first listing page of a project, empty
+        unless the cached listing was a single page.
+        """
+        project = self.projects.get(key)
+        headers: dict[str, str] = {}
+        if project and project.pages != 1:
+            return headers
+        if project and project.etag:
+            headers["If-None-Match"] = project.etag
+        if project and project.last_modified:
+            headers["If-Modified-Since"] = project.last_modified
+        return headers
+
+    def repositories(self, key: str) -> list[BitbucketRepo]:
+        return list(self.projects[key].repos.values())
+
+    def touch(self, key: str):
+        self.projects[key].fetched_at = time.time()
+
+    def store(self, key: str, repos: dict[str, BitbucketRepo], etag: str = "", last_modified: str = "", pages: int = 0):
+        self.projects[key] = CachedProject(
+            key=key, fetched_at=time.time(), etag=etag, last_modified=last_modified, pages=pages, repos=repos
+        )
+
+    def prune(self, keys: set[str]):
+        """
+        Drop projects that no longer exist in Bitbucket.
+        """
+        for key in set(self.projects) - keys:
+            logger.info(f"Project {key} no longer exists in Bitbucket, dropping it from the cache")
+            del self.projects[key]
+
+    def snapshot(self) -> dict[str, str]:
+        """
+        Map of repository id -> "project/name" over all cached projects.
+        """
+        return {repo_id: f"{repo.project}/{repo.name}" for project in self.projects.values() for repo_id, repo in project.repos.items()}
+
+
+def diff_inventories(old: dict[str, str], new: dict[str, str]) -> InventoryDiff:
+    """
+    Compare two cache snapshots by repository id.
+    """
+    diff = InventoryDiff(
+        added=sorted(new[repo_id] for repo_id in new.keys() - old.keys()),
+        removed=sorted(old[repo_id] for repo_id in old.keys() - new.keys()),
+        renamed=sorted((old[repo_id], new[repo_id]) for repo_id in old.keys() & new.keys() if old[repo_id] != new[repo_id]),
+    )
+    return diff
+
+
+def write_diff_report(diff: InventoryDiff, path: Path | str = DIFF_FILENAME):
+    with open(path, "w") as f:
+        json.dump({"generated_at": time.time(), **asdict(diff)}, f, indent=2)
+    logger.info(f"Inventory changes: {diff} (report written to {path})")
@@ -0,0 +1,338 @@
+"""
+Transfer the Git LFS objects of repositories from Bitbucket to Gitea.
+
+    uv run lfs_transfer.py [--csv bitbucket_repos.csv] [ORG/NEWNAME ...]
+
+With LFS_TRANSFER_ENABLED, the Gitea migration of an LFS repository only copies the git
+data and this stage copies the LFS objects afterwards: the pointers are read from a
+partial clone (only blobs small enough to be pointers are fetched, or the mirror cache
+is used), the Gitea LFS batch API tells which objects it is missing, and those are
+streamed from Bitbucket to Gitea LFS_TRANSFER_CONCURRENCY at a time. Objects already in
+Gitea are skipped, so rerunning it after a failure only transfers what is left.
+"""
+
+import argparse
+import hashlib
+import subprocess
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, Any
+
+import niquests
+from niquests.auth import HTTPBasicAuth
+
+from catalogue import Catalogue
+from config import settings
+from gitea_migrate import CSV_REPOSITORIES, gitea_git_auth_header
+from http_client import get_session, log_pool_stats
+from log_config import logger
+from metrics import export_metrics, span
+from mirror_cache import MirrorCache, get_mirror_cache, git_error, run_git
+from models import BitbucketRepo, MigrationStatus
+from retry import RetryPolicy, request_with_retry
+from state_store import MigrationStateStore
+
+LFS_MEDIA_TYPE = "application/vnd.git-lfs+json"
+POINTER_VERSIONS = (b"version https://git-lfs.github.com/spec/v1", b"version https://hawser.github.com/spec/v1")
+# Pointer files are well under this size, per the LFS specification
+MAX_POINTER_SIZE = 1024
+CHUNK_SIZE = 1024 * 1024
+SINGLE_ATTEMPT = RetryPolicy(attempts=1)
+
+
+@dataclass(frozen=True, slots=True)
+class LfsPointer:
+    oid: str  # sha256 of the content
+    size: int
+
+
+@dataclass
+class LfsTransferResult:
+    objects: int = 0
+    present: int = 0  # already in Gitea
+    transferred: int = 0
+    bytes: int = 0
+    elapsed: float = 0.0
+    failed: list[str] = field(default_factory=list)
+    error: str = ""  # the transfer could not run at all
+
+    @property
+    def complete(self) -> bool:
+        return not (self.failed or self.error)
+
+    @property
+    def rate(self) -> float:
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        if self.error:
+            return self.error
+        return (
+            f"{self.transferred} objects transferred ({self.bytes / 1024 / 1024:.1f} MB, {self.rate / 1024 / 1024:.1f} MB/s), "
+            f"{self.present} already in Gitea, {len(self.failed)} failed"
+        )
+
+
+def parse_pointer(content: bytes) -> LfsPointer | None:
+    if not content.startswith(POINTER_VERSIONS):
+        return None
+    values = dict(line.split(b" ", 1) for line in content.splitlines() if b" " in line)
+    oid = values.get(b"oid", b"").decode()
+    if not oid.startswith("sha256:") or not values.get(b"size", b"").isdigit():
+        return None
+    return LfsPointer(oid.removeprefix("sha256:"), int(values[b"size"]))
+
+
+def scan_pointers(path: Path) -> set[LfsPointer]:
+    """
+    Every LFS pointer among the blobs of the repository at `path`, across all history.
+    """
+    listing = run_git("cat-file", "--batch-all-objects", "--batch-check=%(objectname) %(objecttype) %(objectsize)", cwd=path)
+    if listing.returncode != 0:
+        raise RuntimeError(f"Failed to list the objects of {path}: {git_error(listing)}")
+    candidates = [line.split(" ", 1)[0] for line in listing.stdout.splitlines() if (parts := line.split(" ")) and parts[1] == "blob" and int(parts[2]) <= MAX_POINTER_SIZE]
+    if not candidates:
+        return set()
+
+    contents = subprocess.run(["git", "cat-file", "--batch"], cwd=path, input="\n".join(candidates).encode(), capture_output=True, timeout=settings.LOCAL_MIRROR_TIMEOUT)
+    if contents.returncode != 0:
+        raise RuntimeError(f"Failed to read the blobs of {path}: {contents.stderr.decode().strip()}")
+    pointers: set[LfsPointer] = set()
+    output = contents.stdout
+    position = 0
+    # Each object is "<sha> blob <size>\n<content>\n"
+    while position < len(output):
+        header_end = output.index(b"\n", position)
+        size = int(output[position:header_end].split(b" ")[2])
+        pointer = parse_pointer(output[header_end + 1 : header_end + 1 + size])
+        if pointer is not None:
+            pointers.add(pointer)
+        position = header_end + 1 + size + 1
+    return pointers
+
+
+def repository_pointers(repo: BitbucketRepo, mirror_cache: MirrorCache | None = None) -> set[LfsPointer]:
+    """
+    The LFS pointers of a Bitbucket repository, from the mirror cache or a partial clone
+    that leaves out every blob too large to be a pointer.
+    """
+    with span("lfs.scan"):
+        if mirror_cache is not None:
+            with mirror_cache.checkout(repo) as path:
+                return scan_pointers(path)
+        with tempfile.TemporaryDirectory(prefix="lfs-scan-") as tmpdir:
+            path = Path(tmpdir) / "repo.git"
+            process = run_git("clone", "--mirror", "--quiet", f"--filter=blob:limit={MAX_POINTER_SIZE}", repo.link, str(path))
+            if process.returncode != 0:
+                raise RuntimeError(f"Failed to clone {repo.link}: {git_error(process)}")
+            return scan_pointers(path)
+
+
+class LfsEndpoint:
+    """
+    The LFS server of one repository: its batch API and the credentials for it.
+    """
+
+    def __init__(self, url: str, auth: Any = None, headers: dict[str, str] | None = None):
+        self.url = url.rstrip("/")
+        self.auth = auth
+        self.headers = headers or {}
+
+    def batch(self, operation: str, pointers: list[LfsPointer]) -> dict[str, dict]:
+        """
+        Ask for the actions of the objects, returning the answer for each by oid.
+        """
+        url = f"{self.url}/objects/batch"
+        body = {"operation": operation, "transfers": ["basic"], "objects": [{"oid": pointer.oid, "size": pointer.size} for pointer in pointers]}
+        headers = {**self.headers, "Accept": LFS_MEDIA_TYPE, "Content-Type": LFS_MEDIA_TYPE}
+        with span(f"lfs.batch_{operation}"):
+            response = request_with_retry(get_session(url), "POST", url, json=body, headers=headers, auth=self.auth)
+        response.raise_for_status()
+        return {obj["oid"]: obj for obj in response.json().get("objects", [])}
+
+
+def bitbucket_endpoint(repo: BitbucketRepo) -> LfsEndpoint:
+    return LfsEndpoint(f"{repo.link.rstrip('/')}/info/lfs", auth=HTTPBasicAuth(settings.BITBUCKET_USERNAME, settings.BITBUCKET_PASSWORD))
+
+
+def gitea_endpoint(repo: BitbucketRepo) -> LfsEndpoint:
+    name, value = gitea_git_auth_header().split(": ", 1)
+    return LfsEndpoint(f"{settings.GITEA_URL.rstrip('/')}/{repo.project}/{repo.newname}.git/info/lfs", headers={name: value})
+
+
+def _action_request(method: str, action: dict, **kwargs) -> niquests.Response:
+    """
+    Follow a transfer action of a batch answer, once: transfer_object retries the whole object.
+    """
+    url = action["href"]
+    headers = {**action.get("header", {}), **kwargs.pop("headers", {})}
+    response = request_with_retry(get_session(url), method, url, policy=SINGLE_ATTEMPT, headers=headers, **kwargs)
+    response.raise_for_status()
+    return response
+
+
+def _download(pointer: LfsPointer, action: dict, f: IO[bytes]):
+    f.seek(0)
+    f.truncate()
+    digest = hashlib.sha256()
+    with _action_request("GET", action, stream=True) as response:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            digest.update(chunk)
+            f.write(chunk)
+    if f.tell() != pointer.size:
+        raise ValueError(f"got {f.tell()} bytes of {pointer.size}")
+    if digest.hexdigest() != pointer.oid:
+        raise ValueError("content does not match its sha256")
+
+
+def transfer_object(pointer: LfsPointer, download: dict, upload: dict, verify: dict | None = None, policy: RetryPolicy | None = None):
+    """
+    Stream one object from the download action to the upload action through a spooled
+    temporary file, checking its size and hash on the way. Raises on the last failed attempt.
+    """
+    policy = policy or RetryPolicy()
+    attempts = max(1, policy.attempts)
+    with span("lfs.object"), tempfile.SpooledTemporaryFile(max_size=8 * CHUNK_SIZE) as f:
+        downloaded = False
+        for attempt in range(attempts):
+            try:
+                if not downloaded:
+                    _download(pointer, download, f)
+                    downloaded = True
+                f.seek(0)
+                _action_request("PUT", upload, data=f, headers={"Content-Type": "application/octet-stream", "Content-Length": str(pointer.size)})
+                break
+            except (niquests.exceptions.RequestException, ValueError) as e:
+                if attempt == attempts - 1:
+                    raise
+                delay = policy.delay(attempt)
+                logger.warning(f"Transfer of LFS object {pointer.oid} failed ({e}), retrying in {delay:.1f}s ({attempt + 1}/{attempts})")
+                time.sleep(delay)
+    if verify is not None:
+        _action_request("POST", verify, json={"oid": pointer.oid, "size": pointer.size}, headers={"Accept": LFS_MEDIA_TYPE, "Content-Type": LFS_MEDIA_TYPE})
+
+
+def transfer_lfs_objects(repo: BitbucketRepo, mirror_cache: MirrorCache | None = None) -> LfsTransferResult:
+    """
+    Copy the LFS objects of the repository that Gitea does not have yet.
+
+    Objects are asked for in batches of LFS_BATCH_SIZE. At most two batches are in flight,
+    so the transfer links are used well before they expire.
+    """
+    result = LfsTransferResult()
+    started_at = time.monotonic()
+    try:
+        pointers = sorted(repository_pointers(repo, mirror_cache), key=lambda pointer: pointer.oid)
+    except (RuntimeError, subprocess.TimeoutExpired) as e:
+        result.error = f"Failed to scan the LFS pointers: {e}"
+        return result
+    result.objects = len(pointers)
+    if not pointers:
+        return result
+
+    source, target = bitbucket_endpoint(repo), gitea_endpoint(repo)
+    batch_size = max(1, settings.LFS_BATCH_SIZE)
+    logger.info(f"{repo.project}/{repo.newname}: {len(pointers)} LFS objects ({sum(pointer.size for pointer in pointers) / 1024 / 1024:.1f} MB)")
+
+    in_flight: deque[list[tuple[LfsPointer, Future]]] = deque()
+
+    def collect(batch: list[tuple[LfsPointer, Future]]):
+        wait([future for _, future in batch])
+        for pointer, future in batch:
+            if future.exception() is None:
+                result.transferred += 1
+                result.bytes += pointer.size
+            else:
+                logger.error(f"Failed to transfer LFS object {pointer.oid} of {repo.project}/{repo.newname}: {future.exception()}")
+                result.failed.append(pointer.oid)
+
+    with ThreadPoolExecutor(max_workers=max(1, settings.LFS_TRANSFER_CONCURRENCY), thread_name_prefix="lfs") as executor:
+        for start in range(0, len(pointers), batch_size):
+            batch = pointers[start : start + batch_size]
+            try:
+                uploads = target.batch("upload", batch)
+            except (niquests.exceptions.RequestException, ValueError) as e:
+                logger.error(f"LFS batch request to Gitea for {repo.project}/{repo.newname} failed: {e}")
+                result.failed += [pointer.oid for pointer in batch]
+                continue
+            missing: list[LfsPointer] = []
+            for pointer in batch:
+                upload = uploads.get(pointer.oid)
+                if upload is None or "error" in upload:
+                    logger.error(f"Gitea refused LFS object {pointer.oid} of {repo.project}/{repo.newname}: {(upload or {}).get('error', 'no answer')}")
+                    result.failed.append(pointer.oid)
+                elif "upload" in upload.get("actions", {}):
+                    missing.append(pointer)
+                else:
+                    result.present += 1  # no upload action: Gitea already has it
+            try:
+                downloads = source.batch("download", missing) if missing else {}
+            except (niquests.exceptions.RequestException, ValueError) as e:
+                logger.error(f"LFS batch request to Bitbucket for {repo.project}/{repo.newname} failed: {e}")
+                result.failed += [pointer.oid for pointer in missing]
+                continue
+
+            submitted: list[tuple[LfsPointer, Future]] = []
+            for pointer in missing:
+                download = downloads.get(pointer.oid, {})
+                if "download" not in download.get("actions", {}):
+                    logger.error(f"Cannot download LFS object {pointer.oid} of {repo.project}/{repo.newname}: {download.get('error', 'not in Bitbucket')}")
+                    result.failed.append(pointer.oid)
+                    continue
+                actions = uploads[pointer.oid]["actions"]
+                submitted.append((pointer, executor.submit(transfer_object, pointer, download["actions"]["download"], actions["upload"], actions.get("verify"))))
+
+            in_flight.append(submitted)
+            if len(in_flight) > 1:
+                collect(in_flight.popleft())
+        while in_flight:
+            collect(in_flight.popleft())
+
+    result.elapsed = time.monotonic() - started_at
+    log = logger.info if result.complete else logger.error
+    log(f"{repo.project}/{repo.newname} LFS: {result}")
+    return result
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--csv", type=Path, default=CSV_REPOSITORIES)
+    parser.add_argument("repos", nargs="*", help="ORG/NEWNAME of the repositories, all LFS repositories of the CSV by default")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with Catalogue.open(args.csv) as catalogue:
+        if args.repos:
+            repos = [repo for name in args.repos if (repo := catalogue.get(*name.split("/", 1))) is not None]
+        else:
+            repos = [repo for repo in catalogue if repo.lfs]
+
+    mirror_cache = get_mirror_cache()
+    state = MigrationStateStore(settings.MIGRATION_STATE_DB)
+    started_at = time.monotonic()
+    total = LfsTransferResult()
+    incomplete = 0
+    for repo in repos:
+        result = transfer_lfs_objects(repo, mirror_cache)
+        total.objects += result.objects
+        total.present += result.present
+        total.transferred += result.transferred
+        total.bytes += result.bytes
+        total.failed += result.failed
+        incomplete += int(not result.complete)
+        key = f"{repo.project}/{repo.newname}"  # GiteaTarget.key
+        record = state.get(key)
+        if result.complete and record is not None and record.status == MigrationStatus.LFS_INCOMPLETE:
+            # The migration no longer needs to be resumed
+            state.finish(key, MigrationStatus.DONE, record.duration or 0.0, record.http_status)
+    total.elapsed = time.monotonic() - started_at
+    logger.info(f"LFS transfer of {len(repos)} repositories: {total}, {incomplete} repositories incomplete")
+    log_pool_stats()
+    export_metrics()
+    exit(0 if not incomplete else 1)
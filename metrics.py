@@ -0,0 +1,192 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator
+
+from config import settings
+from log_config import logger
+
+# Upper bounds (seconds) of the histogram buckets, from a fast API call to a large clone
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, math.inf)
+
+PROMETHEUS_PREFIX = "bitbucket_gitea"
+
+
+@dataclass
+class Histogram:
+    """
+    Durations of one phase in fixed buckets, so a run of any length costs constant memory.
+    """
+
+    count: int = 0
+    errors: int = 0
+    total: float = 0.0
+    min: float = math.inf
+    max: float = 0.0
+    buckets: list[int] = field(default_factory=lambda: [0] * len(BUCKETS))
+
+    def observe(self, seconds: float, error: bool = False):
+        self.count += 1
+        self.errors += int(error)
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        for idx, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[idx] += 1
+                break
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile by linear interpolation inside its bucket.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for idx, bucket_count in enumerate(self.buckets):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = max(BUCKETS[idx - 1] if idx else 0.0, self.min)
+                upper = min(BUCKETS[idx], self.max)
+                return lower + (upper - lower) * (rank - seen) / bucket_count if upper > lower else upper
+            seen += bucket_count
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total_s": round(self.total, 3),
+            "mean_ms": round(self.total / self.count * 1000, 2) if self.count else 0.0,
+            "p50_ms": round(self.quantile(0.50) * 1000, 2),
+            "p95_ms": round(self.quantile(0.95) * 1000, 2),
+            "p99_ms": round(self.quantile(0.99) * 1000, 2),
+            "max_ms": round(self.max * 1000, 2),
+        }
+
+
+@dataclass
+class Span:
+    """
+    A timed phase. Exceptions mark it failed, the caller may also set `error` itself
+    (e.g. for an unexpected HTTP status).
+    """
+
+    name: str
+    error: bool = False
+
+
+class Metrics:
+    """
+    Phase timings of the current process, aggregated into one histogram per phase name
+    ("gitea.migrate", "bitbucket.repos_wave", ...). Safe to use from any thread.
+    """
+
+    def __init__(self):
+        self._histograms: dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def observe(self, name: str, seconds: float, error: bool = False):
+        with self._lock:
+            self._histograms.setdefault(name, Histogram()).observe(seconds, error)
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[Span]:
+        span = Span(name)
+        started_at = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            span.error = True
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started_at, span.error)
+
+    def histograms(self) -> dict[str, Histogram]:
+        with self._lock:
+            return {name: Histogram(h.count, h.errors, h.total, h.min, h.max, list(h.buckets)) for name, h in self._histograms.items()}
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self.started_at = time.time()
+
+    def report(self) -> dict:
+        """
+        The run report: every phase summarized, the most time-consuming first.
+        """
+        histograms = sorted(self.histograms().items(), key=lambda item: item[1].total, reverse=True)
+        return {
+            "started_at": datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(),
+            "elapsed_s": round(time.time() - self.started_at, 3),
+            "phases": {name: histogram.summary() for name, histogram in histograms},
+        }
+
+    def prometheus(self) -> str:
+        """
+        The histograms in the Prometheus text exposition format.
+        """
+        name = f"{PROMETHEUS_PREFIX}_phase_duration_seconds"
+        lines = [
+            f"# HELP {name} Duration of the migration phases.",
+            f"# TYPE {name} histogram",
+        ]
+        errors: list[str] = []
+        for phase, histogram in sorted(self.histograms().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, histogram.buckets):
+                cumulative += bucket_count
+                le = "+Inf" if math.isinf(bound) else f"{bound:g}"
+                lines.append(f'{name}_bucket{{phase="{phase}",le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{phase="{phase}"}} {histogram.total:.6f}')
+            lines.append(f'{name}_count{{phase="{phase}"}} {histogram.count}')
+            errors.append(f'{PROMETHEUS_PREFIX}_phase_errors_total{{phase="{phase}"}} {histogram.errors}')
+        lines += [f"# HELP {PROMETHEUS_PREFIX}_phase_errors_total Failed phases.", f"# TYPE {PROMETHEUS_PREFIX}_phase_errors_total counter", *errors]
+        return "\n".join(lines) + "\n"
+
+
+# Shared by every module, like `settings`
+metrics = Metrics()
+span = metrics.span
+
+
+def _write_atomically(path: Path, content: str):
+    # The Prometheus textfile collector may read at any time, never let it see a partial file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text(content)
+    os.replace(tmp_path, path)
+
+
+def log_phase_summary(limit: int = 5):
+    """
+    Log the phases that took the most time in total.
+    """
+    for name, summary in list(metrics.report()["phases"].items())[:limit]:
+        logger.info(
+            f"Phase {name}: {summary['count']} x, {summary['total_s']:.1f}s total, "
+            f"p50 {summary['p50_ms']:.0f} ms, p99 {summary['p99_ms']:.0f} ms, {summary['errors']} errors"
+        )
+
+
+def export_metrics(report_file: str | None = None, prometheus_file: str | None = None):
+    """
+    Write the JSON run report (METRICS_REPORT_FILE) and, when configured, the Prometheus
+    textfile (METRICS_PROMETHEUS_FILE). An empty path disables either export.
+    """
+    report_file = settings.METRICS_REPORT_FILE if report_file is None else report_file
+    prometheus_file = settings.METRICS_PROMETHEUS_FILE if prometheus_file is None else prometheus_file
+    log_phase_summary()
+    if report_file:
+        _write_atomically(Path(report_file), json.dumps(metrics.report(), indent=2))
+        logger.info(f"Wrote the run report to {report_file}")
+    if prometheus_file:
+        _write_atomically(Path(prometheus_file), metrics.prometheus())
+        logger.info(f"Wrote the Prometheus metrics to {prometheus_file}")
@@ -0,0 +1,100 @@
+import threading
+import time
+from typing import Callable
+
+from config import settings
+from log_config import logger
+from models import BitbucketRepo, MigrationResult, MigrationStatus, TrackedMigration
+from targets import MigrationTarget
+
+
+class MigrationPoller:
+    """
+    Track migrations that were submitted to an asynchronous target but not waited for.
+
+    A single background thread hands every tracked repository to `target.poll` once per
+    interval, which reports the ones that finished. Nothing is ever deleted here, a
+    migration that outlives `timeout` is reported as failed but left alone.
+    """
+
+    def __init__(
+        self,
+        target: MigrationTarget,
+        on_finished: Callable[[BitbucketRepo, MigrationResult, float], None],
+        timeout: float | None = None,
+        max_in_flight: int | None = None,
+    ):
+        self.target = target
+        self.on_finished = on_finished
+        self.interval = target.poll_interval
+        self.timeout = timeout or settings.MIGRATION_POLL_TIMEOUT
+        self._slots = threading.BoundedSemaphore(max(1, max_in_flight or settings.MIGRATION_MAX_IN_FLIGHT))
+        self._tracked: dict[str, TrackedMigration] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="migration-poller", daemon=True)
+        self._thread.start()
+
+    def acquire(self):
+        """
+        Wait for a free in-flight slot before submitting a migration.
+        """
+        self._slots.acquire()
+
+    def release(self):
+        """
+        Give the slot back for a migration that finished (or failed) synchronously.
+        """
+        self._slots.release()
+
+    def track(self, repo: BitbucketRepo, started_at: float):
+        key = self.target.key(repo)
+        with self._lock:
+            self._tracked[key] = TrackedMigration(repo=repo, key=key, started_at=started_at)
+
+    @property
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._tracked)
+
+    def join(self):
+        """
+        Block until every tracked migration has finished, then stop polling.
+        """
+        if self.in_flight:
+            logger.info(f"Waiting for {self.in_flight} migrations still running in {self.target.name}")
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not (self._stop.is_set() and not self.in_flight):
+            time.sleep(self.interval)
+            with self._lock:
+                tracked = list(self._tracked.values())
+            if tracked:
+                try:
+                    self._poll(tracked)
+                except Exception:
+                    # The poller thread must survive anything, or the tracked migrations are never reported
+                    logger.exception(f"Failed to poll migration status, retrying in {self.interval:.0f}s")
+
+    def _poll(self, tracked: list[TrackedMigration]):
+        results = self.target.poll(tracked)
+        now = time.monotonic()
+        for migration in tracked:
+            duration = now - migration.started_at
+            if migration.key in results:
+                self._finish(migration.key, results[migration.key], duration)
+            elif duration > self.timeout:
+                logger.warning(f"Gave up waiting for the migration of {migration.key} after {duration:.0f}s, it is left untouched in {self.target.name}")
+                self._finish(migration.key, MigrationResult(MigrationStatus.FAILED, error="gave up polling"), duration)
+
+    def _finish(self, key: str, result: MigrationResult, duration: float):
+        with self._lock:
+            migration = self._tracked.pop(key)
+        self._slots.release()
+        if result.status == MigrationStatus.DONE:
+            logger.success(f"Migration of {key} finished in {self.target.name} after {duration:.0f}s")
+        else:
+            logger.error(f"Migration of {key} failed: {result.error}")
+        self.on_finished(migration.repo, result, duration)
@@ -0,0 +1,232 @@
+import base64
+import hashlib
+import os
+import shutil
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator
+
+from config import settings
+from log_config import logger
+from metrics import span
+from models import BitbucketRepo
+
+# Marker files inside each cached mirror, their mtimes survive restarts
+USED_MARKER = "cache-used"
+FETCHED_MARKER = "cache-fetched"
+
+
+def git_auth_env(auth_header: str | None = None) -> dict[str, str]:
+    """
+    Environment passing credentials to git as an HTTP header (the Bitbucket ones unless
+    another header is given), so they are neither stored in the repository config nor
+    visible in the process list.
+    """
+    env = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+    if auth_header is None and settings.BITBUCKET_USERNAME:
+        credentials = base64.b64encode(f"{settings.BITBUCKET_USERNAME}:{settings.BITBUCKET_PASSWORD}".encode()).decode()
+        auth_header = f"Authorization: Basic {credentials}"
+    if auth_header:
+        env |= {"GIT_CONFIG_COUNT": "1", "GIT_CONFIG_KEY_0": "http.extraHeader", "GIT_CONFIG_VALUE_0": auth_header}
+    return env
+
+
+def run_git(*args: str, cwd: Path | None = None, auth_header: str | None = None) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        ["git", *args],
+        cwd=cwd,
+        env=git_auth_env(auth_header),
+        capture_output=True,
+        text=True,
+        timeout=settings.LOCAL_MIRROR_TIMEOUT,
+    )
+
+
+def git_error(process: subprocess.CompletedProcess) -> str:
+    stderr = process.stderr.strip()
+    return stderr.splitlines()[-1] if stderr else f"git exited with {process.returncode}"
+
+
+def mirror_repository(link: str, path: Path) -> str | None:
+    """
+    Bring the bare mirror at `path` up to date with `link`: `git fetch --prune` when it
+    exists, `git clone --mirror` otherwise. Returns the error, or None on success.
+    """
+    try:
+        if (path / "HEAD").exists():
+            logger.info(f"Fetching {link} into {path}")
+            process = run_git("fetch", "--prune", "origin", cwd=path)
+        else:
+            # Clone next to the final path and rename it, so an interrupted clone never looks like a mirror
+            tmp_path = path.with_name(f"{path.name}.tmp")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            logger.info(f"Cloning {link} into {path}")
+            process = run_git("clone", "--mirror", "--quiet", link, str(tmp_path))
+            if process.returncode == 0:
+                tmp_path.rename(path)
+            else:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+    except subprocess.TimeoutExpired:
+        return f"git timed out after {settings.LOCAL_MIRROR_TIMEOUT}s"
+
+    return git_error(process) if process.returncode != 0 else None
+
+
+def push_mirror(path: Path, remote_url: str, auth_header: str | None = None) -> str | None:
+    """
+    Push all branches and tags of the mirror at `path`, pruning the ones that no longer
+    exist. Other refs (e.g. Bitbucket's pull request refs) are not pushed. Returns the
+    error, or None on success.
+    """
+    try:
+        process = run_git("push", "--prune", remote_url, "+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*", cwd=path, auth_header=auth_header)
+    except subprocess.TimeoutExpired:
+        return f"git push timed out after {settings.LOCAL_MIRROR_TIMEOUT}s"
+    return git_error(process) if process.returncode != 0 else None
+
+
+def directory_size(path: Path) -> int:
+    return sum(entry.stat().st_size for entry in path.rglob("*") if entry.is_file())
+
+
+@dataclass
+class CacheEntry:
+    path: Path
+    size: int = 0
+    used_at: float = 0.0
+    fetched_at: float = 0.0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+
+class MirrorCache:
+    """
+    Bare mirrors of the Bitbucket repositories on local disk, keyed by a hash of the
+    clone link, that the targets push from instead of each cloning from Bitbucket.
+
+    A mirror is fetched incrementally at most once per `fetch_ttl` seconds, so several
+    targets in one cycle cost Bitbucket a single fetch of the new objects. When the cache
+    grows over `max_bytes`, the least recently used mirrors not in use are deleted.
+    """
+
+    def __init__(self, root: str | Path | None = None, max_bytes: int | None = None, fetch_ttl: float | None = None):
+        self.root = Path(root or settings.MIRROR_CACHE_DIR)
+        self.max_bytes = max_bytes if max_bytes is not None else int(settings.MIRROR_CACHE_MAX_GB * 1024**3)
+        self.fetch_ttl = fetch_ttl if fetch_ttl is not None else settings.MIRROR_CACHE_FETCH_TTL
+        self._entries: dict[Path, CacheEntry] = {}
+        self._lock = threading.Lock()
+        self._scan()
+
+    def _scan(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        for path in self.root.glob("*.git"):
+            if not (path / "HEAD").exists():
+                continue
+            self._entries[path] = CacheEntry(
+                path=path,
+                size=directory_size(path),
+                used_at=_mtime(path / USED_MARKER),
+                fetched_at=_mtime(path / FETCHED_MARKER),
+            )
+        logger.info(f"Mirror cache {self.root}: {len(self._entries)} mirrors, {self.size / 1024**3:.1f} GB")
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return sum(entry.size for entry in self._entries.values())
+
+    def path(self, repo: BitbucketRepo) -> Path:
+        return self.root / f"{hashlib.sha256(repo.link.encode()).hexdigest()[:24]}.git"
+
+    @contextmanager
+    def checkout(self, repo: BitbucketRepo) -> Iterator[Path]:
+        """
+        Lock the repository's mirror, fetch it if it is stale, and yield its path.
+
+        Raises RuntimeError when the mirror could not be cloned or fetched.
+        """
+        path = self.path(repo)
+        with self._lock:
+            entry = self._entries.setdefault(path, CacheEntry(path=path))
+
+        with entry.lock:
+            now = time.time()
+            if not (path / "HEAD").exists() or now - entry.fetched_at > self.fetch_ttl:
+                with span("mirror_cache.fetch") as fetch_span:
+                    error = mirror_repository(repo.link, path)
+                    fetch_span.error = error is not None
+                if error:
+                    raise RuntimeError(f"Failed to mirror {repo.link}: {error}")
+                entry.fetched_at = now
+                entry.size = directory_size(path)
+                (path / FETCHED_MARKER).touch()
+            with self._lock:
+                self._entries[path] = entry  # in case it was evicted while we waited for the lock
+            entry.used_at = now
+            (path / USED_MARKER).touch()
+            yield path
+
+        self.evict()
+
+    def push(self, repo: BitbucketRepo, remote_url: str, auth_header: str | None = None) -> str | None:
+        """
+        Push the repository from the cache to `remote_url`, returning the error or None on success.
+        """
+        try:
+            with self.checkout(repo) as path:
+                logger.info(f"Pushing {repo.name} from the mirror cache to {remote_url}")
+                return push_mirror(path, remote_url, auth_header)
+        except RuntimeError as e:
+            return str(e)
+
+    def evict(self):
+        """
+        Delete the least recently used mirrors until the cache fits in `max_bytes`.
+        """
+        with self._lock:
+            total = sum(entry.size for entry in self._entries.values())
+            if total <= self.max_bytes:
+                return
+            candidates = sorted(self._entries.values(), key=lambda entry: entry.used_at)
+
+        for entry in candidates:
+            if total <= self.max_bytes:
+                break
+            if not entry.lock.acquire(blocking=False):
+                continue  # in use
+            try:
+                logger.info(f"Evicting {entry.path} ({entry.size / 1024**2:.0f} MB) from the mirror cache")
+                shutil.rmtree(entry.path, ignore_errors=True)
+                total -= entry.size
+                with self._lock:
+                    self._entries.pop(entry.path, None)
+            finally:
+                entry.lock.release()
+
+
+_shared_cache: MirrorCache | None = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_mirror_cache() -> MirrorCache | None:
+    """
+    Return the mirror cache shared by all targets, or None when MIRROR_CACHE_ENABLED is off.
+    """
+    global _shared_cache
+    if not settings.MIRROR_CACHE_ENABLED:
+        return None
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = MirrorCache()
+        return _shared_cache
+
+
+def _mtime(path: Path) -> float:
+    try:
+        return path.stat().st_mtime
+    except FileNotFoundError:
+        return 0.0
@@ -1,7 +1,8 @@
 from dataclasses import dataclass
+from enum import StrEnum
 
 
-@dataclass
+@dataclass(slots=True)
 class BitbucketRepo:
     project: str
     projectname: str
@@ -10,9 +11,28 @@ class BitbucketRepo:
     link: str
     description: str
     action: str
+    size: int = 0  # bytes, as reported by Bitbucket
+    lfs: bool = False
 
+    def __post_init__(self):
+        # Values read back from the CSV are all strings
+        self.size = int(self.size or 0)
+        if isinstance(self.lfs, str):
+            self.lfs = self.lfs.lower() in ("true", "1", "yes")
 
-@dataclass
+    @property
+    def project_key(self) -> str:
+        """
+        Bitbucket project key, taken from the clone link (.../scm/{key}/{slug}.git).
+        """
+        return self.link.rstrip("/").split("/")[-2]
+
+    @property
+    def slug(self) -> str:
+        return self.link.rstrip("/").split("/")[-1].removesuffix(".git")
+
+
+@dataclass(slots=True)
 class BitbucketProject:
     key: str
     id: int
@@ -24,3 +44,27 @@ class BitbucketProject:
         if self.description:
             return f"{self.key} - {self.name} - {self.description}"
         return f"{self.key} - {self.name}"
+
+
+class MigrationStatus(StrEnum):
+    IN_PROGRESS = "in_progress"
+    DONE = "done"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+    LFS_INCOMPLETE = "lfs_incomplete"  # migrated, but some LFS objects are still missing
+
+
+@dataclass
+class MigrationResult:
+    status: MigrationStatus
+    http_status: int | None = None
+    error: str = ""
+
+
+@dataclass
+class TrackedMigration:
+    repo: BitbucketRepo
+    key: str
+    started_at: float
+    seen: bool = False  # the repository showed up in the target at least once
+    source_empty: bool | None = None  # the source has no branches, None until checked
@@ -0,0 +1,274 @@
+"""
+Compute the full change plan of a migration without writing anything, and apply it later.
+
+    uv run planner.py plan [--csv bitbucket_repos.csv] [--output migration_plan.json] [--refresh-bitbucket] [--prune]
+    uv run planner.py apply [migration_plan.json]
+
+Planning only uses bulk listings: the CSV, one paginated listing of the Gitea
+organizations and repositories, the migration state DB and, with --refresh-bitbucket,
+the Bitbucket repository listing (conditional requests through the inventory cache).
+"""
+
+import argparse
+import hashlib
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from enum import StrEnum
+from pathlib import Path
+from typing import Callable, Iterable
+
+from catalogue import Catalogue
+from config import settings
+from gitea_index import GiteaIndex, build_gitea_index
+from gitea_migrate import CSV_REPOSITORIES, HEADERS, GiteaTarget, archive_repo, delete_repo
+from gitea_sync import mirror_sync
+from http_client import log_pool_stats
+from log_config import logger
+from models import BitbucketRepo, MigrationStatus
+from scheduler import run_migration
+from state_store import FINISHED_STATUSES, MigrationStateStore
+
+PLAN_VERSION = 1
+
+
+class PlanAction(StrEnum):
+    CREATE_ORG = "create_org"
+    DELETE = "delete"
+    MIGRATE = "migrate"
+    SYNC = "sync"
+    ARCHIVE = "archive"
+    SKIP = "skip"
+
+
+# Order in which the actions are listed and applied
+ACTION_ORDER = list(PlanAction)
+
+
+@dataclass
+class PlanEntry:
+    action: PlanAction
+    org: str
+    name: str = ""  # empty for organization entries
+    bytes: int = 0  # estimated data volume the action transfers (or frees, for deletes)
+    reason: str = ""
+    replace: bool = False  # a partial copy from an earlier run is deleted first
+    archive: bool = False  # archive the repository once migrated
+    full_name: str = ""  # organization full name
+    repo: dict | None = None  # the CSV row, for migrations
+
+    @property
+    def key(self) -> str:
+        return f"{self.org}/{self.name}" if self.name else self.org
+
+
+@dataclass
+class MigrationPlan:
+    created_at: str
+    gitea_url: str
+    csv_file: str
+    csv_sha256: str
+    entries: list[PlanEntry] = field(default_factory=list)
+
+    def summary(self) -> dict[str, dict[str, int]]:
+        summary = {action.value: {"count": 0, "bytes": 0} for action in ACTION_ORDER}
+        for entry in self.entries:
+            summary[entry.action]["count"] += 1
+            summary[entry.action]["bytes"] += entry.bytes
+        return summary
+
+    def of(self, action: PlanAction) -> list[PlanEntry]:
+        return [entry for entry in self.entries if entry.action == action]
+
+    def save(self, path: Path):
+        data = {"version": PLAN_VERSION, **asdict(self), "summary": self.summary()}
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        tmp_path.write_text(json.dumps(data, indent=2))
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "MigrationPlan":
+        data = json.loads(path.read_text())
+        if data.get("version") != PLAN_VERSION:
+            raise ValueError(f"Unsupported plan version {data.get('version')} in {path}, expected {PLAN_VERSION}")
+        entries = [PlanEntry(**{**entry, "action": PlanAction(entry["action"])}) for entry in data["entries"]]
+        return cls(data["created_at"], data["gitea_url"], data["csv_file"], data["csv_sha256"], entries)
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def live_bitbucket_links() -> set[str]:
+    """
+    Clone links of every repository currently in Bitbucket, listed in bulk. The
+    inventory cache is read for its validators but not saved.
+    """
+    from bitbucket_repos import iter_all_repositories, list_projects
+    from inventory_cache import InventoryCache
+
+    cache = InventoryCache(ttl=settings.BITBUCKET_CACHE_TTL)
+    return {repo.link for _, repos in iter_all_repositories(list_projects(), cache) for repo in repos}
+
+
+def plan_repository(repo: BitbucketRepo, index: GiteaIndex, previous: dict[str, MigrationStatus], live_links: set[str] | None) -> PlanEntry:
+    """
+    Decide what applying the plan will do to one CSV row.
+    """
+    key = f"{repo.project}/{repo.newname}"
+    entry = PlanEntry(PlanAction.SKIP, repo.project, repo.newname)
+    gitea_repo = index.get_repo(repo.project, repo.newname)
+    status = previous.get(key)
+
+    if live_links is not None and repo.link not in live_links:
+        entry.reason = "no longer in Bitbucket"
+    elif gitea_repo is None or (status is not None and status not in FINISHED_STATUSES):
+        entry.action = PlanAction.MIGRATE
+        entry.bytes = repo.size
+        entry.replace = gitea_repo is not None
+        entry.archive = repo.action == "Archive"
+        entry.repo = asdict(repo)
+        entry.reason = f"left {status} by an earlier run" if entry.replace else "not in Gitea"
+    elif gitea_repo.mirror:
+        entry.action = PlanAction.SYNC
+        entry.bytes = max(0, repo.size - gitea_repo.size * 1024)
+        entry.reason = "pull mirror"
+    elif repo.action == "Archive" and not gitea_repo.archived:
+        entry.action = PlanAction.ARCHIVE
+        entry.reason = "marked Archive in the CSV"
+    else:
+        entry.reason = "already in Gitea"
+    return entry
+
+
+def build_plan(csv_file: Path, state: MigrationStateStore | None = None, refresh_bitbucket: bool = False, prune: bool = False) -> MigrationPlan:
+    """
+    Combine the CSV, the Gitea index, the migration state and (optionally) the live
+    Bitbucket listing into a plan. Nothing is written anywhere.
+
+    With `prune`, Gitea repositories in the planned organizations that no longer match
+    a CSV row are planned for deletion.
+    """
+    started_at = time.monotonic()
+    if state is None and Path(settings.MIGRATION_STATE_DB).exists():
+        state = MigrationStateStore(settings.MIGRATION_STATE_DB, read_only=True)
+    previous = state.statuses() if state else {}
+    index = build_gitea_index(HEADERS)
+    live_links = live_bitbucket_links() if refresh_bitbucket else None
+
+    plan = MigrationPlan(
+        created_at=datetime.now(timezone.utc).isoformat(),
+        gitea_url=settings.GITEA_URL,
+        csv_file=str(csv_file),
+        csv_sha256=file_sha256(csv_file),
+    )
+    with Catalogue.open(csv_file) as catalogue:
+        organizations = catalogue.organizations()
+        plan.entries += [PlanEntry(PlanAction.CREATE_ORG, org, full_name=full_name, reason="not in Gitea") for org, full_name in organizations.items() if not index.has_org(org)]
+
+        planned: set[str] = set()
+        for repo in catalogue:
+            planned.add(f"{repo.project}/{repo.newname}".lower())
+            plan.entries.append(plan_repository(repo, index, previous, live_links))
+
+    if prune:
+        wanted_orgs = {org.lower() for org in organizations}
+        for key, gitea_repo in sorted(index.repos.items()):
+            if gitea_repo.owner.lower() in wanted_orgs and key not in planned:
+                plan.entries.append(PlanEntry(PlanAction.DELETE, gitea_repo.owner, gitea_repo.name, gitea_repo.size * 1024, "not in the CSV"))
+
+    plan.entries.sort(key=lambda entry: ACTION_ORDER.index(entry.action))
+    logger.info(f"Planned {len(plan.entries)} actions in {time.monotonic() - started_at:.1f}s")
+    return plan
+
+
+def log_plan(plan: MigrationPlan):
+    for action, totals in plan.summary().items():
+        if totals["count"]:
+            logger.info(f"Plan: {totals['count']:>6} {action:<10} {totals['bytes'] / 1024**3:10.2f} GB")
+    reasons = Counter((entry.action, entry.reason) for entry in plan.entries)
+    for (action, reason), count in sorted(reasons.items()):
+        logger.debug(f"Plan: {count} {action} ({reason})")
+
+
+def _run_concurrently(entries: Iterable[PlanEntry], action: Callable[[PlanEntry], object]):
+    with ThreadPoolExecutor(max_workers=max(1, settings.GITEA_HOST_CONCURRENCY), thread_name_prefix="apply") as executor:
+        list(executor.map(action, entries))
+
+
+def apply_plan(plan: MigrationPlan, state: MigrationStateStore | None = None):
+    """
+    Execute the plan as written: create the organizations, delete, migrate (through the
+    scheduler, so the state DB and resume logic apply), sync and archive. Skips are not
+    revisited. A repository that appeared in Gitea since planning is skipped rather than
+    overwritten. A plan whose CSV changed since planning is refused.
+    """
+    age = datetime.now(timezone.utc) - datetime.fromisoformat(plan.created_at)
+    logger.info(f"Applying the plan of {plan.created_at} ({age.total_seconds() / 3600:.1f}h old) to {plan.gitea_url}")
+    if plan.gitea_url != settings.GITEA_URL:
+        raise ValueError(f"The plan was made for {plan.gitea_url}, not {settings.GITEA_URL}")
+    if file_sha256(Path(plan.csv_file)) != plan.csv_sha256:
+        raise ValueError(f"{plan.csv_file} changed since the plan was made, plan again")
+    log_plan(plan)
+    state = state or MigrationStateStore(settings.MIGRATION_STATE_DB)
+
+    deletes = plan.of(PlanAction.DELETE)
+    if deletes:
+        logger.info(f"Deleting {len(deletes)} repositories")
+        _run_concurrently(deletes, lambda entry: delete_repo(entry.org, entry.name))
+
+    migrations = [BitbucketRepo(**entry.repo) for entry in plan.of(PlanAction.MIGRATE) if entry.repo]
+    # Finished in an earlier run but gone from Gitea since: forget them, or the scheduler would skip them
+    statuses = state.statuses()
+    state.forget([entry.key for entry in plan.of(PlanAction.MIGRATE) if statuses.get(entry.key) in FINISHED_STATUSES])
+    organizations = {entry.org: entry.full_name for entry in plan.of(PlanAction.CREATE_ORG)}
+    organizations |= {repo.project: repo.projectname for repo in migrations if repo.project not in organizations}
+    if migrations or organizations:
+        # Provisioning creates exactly the planned organizations, unless Gitea changed meanwhile
+        run_migration(GiteaTarget(organizations=organizations), migrations, state)
+
+    syncs = plan.of(PlanAction.SYNC)
+    if syncs:
+        logger.info(f"Syncing {len(syncs)} mirrors")
+        _run_concurrently(syncs, lambda entry: mirror_sync(entry.org, entry.name))
+
+    statuses = state.statuses()
+    archives = plan.of(PlanAction.ARCHIVE) + [
+        entry for entry in plan.of(PlanAction.MIGRATE) if entry.archive and statuses.get(entry.key) == MigrationStatus.DONE
+    ]
+    if archives:
+        logger.info(f"Archiving {len(archives)} repositories")
+        _run_concurrently(archives, lambda entry: archive_repo(entry.org, entry.name))
+
+    log_pool_stats()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    plan_parser = commands.add_parser("plan", help="compute the plan, without any write")
+    plan_parser.add_argument("--csv", type=Path, default=CSV_REPOSITORIES)
+    plan_parser.add_argument("--output", type=Path, default=Path(settings.MIGRATION_PLAN_FILE))
+    plan_parser.add_argument("--refresh-bitbucket", action="store_true", help="skip rows whose repository is gone from Bitbucket")
+    plan_parser.add_argument("--prune", action="store_true", help="plan the deletion of Gitea repositories that are not in the CSV")
+    apply_parser = commands.add_parser("apply", help="apply a plan file")
+    apply_parser.add_argument("plan", type=Path, nargs="?", default=Path(settings.MIGRATION_PLAN_FILE))
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "plan":
+        plan = build_plan(args.csv, refresh_bitbucket=args.refresh_bitbucket, prune=args.prune)
+        plan.save(args.output)
+        log_plan(plan)
+        logger.info(f"Wrote the plan to {args.output}, apply it with: planner.py apply {args.output}")
+    else:
+        apply_plan(MigrationPlan.load(args.plan))
@@ -0,0 +1,139 @@
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import niquests
+
+from config import settings
+from log_config import logger
+
+# Statuses meaning "try again later": rate limited, or the server / a proxy in front of it is struggling
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+# Statuses guaranteeing the server did not act on the request, safe to retry for non-idempotent calls
+REJECTED_STATUSES = frozenset({429, 503})
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    attempts: int = field(default_factory=lambda: settings.HTTP_RETRY_ATTEMPTS)
+    backoff: float = field(default_factory=lambda: settings.HTTP_RETRY_BACKOFF)
+    max_backoff: float = field(default_factory=lambda: settings.HTTP_RETRY_MAX_BACKOFF)
+    statuses: frozenset[int] = RETRY_STATUSES
+
+    def delay(self, attempt: int, response: niquests.Response | None = None) -> float:
+        """
+        Seconds to wait before the next attempt: the server's Retry-After when given,
+        otherwise exponential backoff with full jitter.
+        """
+        retry_after = parse_retry_after(response.headers.get("Retry-After")) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limiter: every success grows the limit by 1/limit (about +1 per
+    round of requests), every throttling response halves it, at most once per
+    `cooldown` seconds so a burst of 429s counts as a single congestion event.
+    """
+
+    def __init__(self, name: str, max_limit: int, min_limit: int = 1, cooldown: float = 5.0):
+        self.name = name
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.cooldown = cooldown
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        with self._condition:
+            if self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self._condition.notify_all()
+
+    def on_throttle(self):
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.limit = max(self.min_limit, self.limit / 2)
+        logger.warning(f"{self.name}: server is throttling, concurrency reduced to {int(self.limit)}")
+
+
+def request_with_retry(
+    session: niquests.Session,
+    method: str,
+    url: str,
+    policy: RetryPolicy | None = None,
+    limiter: AdaptiveLimiter | None = None,
+    **kwargs,
+) -> niquests.Response:
+    """
+    Send a request, retrying throttled or failed attempts according to the policy.
+
+    Connection errors are retried, read timeouts are not: the server may still be
+    working on the request. The last response (or exception) is passed through.
+    """
+    policy = policy or RetryPolicy()
+    attempts = max(1, policy.attempts)
+    for attempt in range(attempts):
+        is_last = attempt == attempts - 1
+        try:
+            if limiter is not None:
+                with limiter:
+                    response = session.request(method, url, **kwargs)
+            else:
+                response = session.request(method, url, **kwargs)
+        except niquests.exceptions.ConnectionError as e:
+            if is_last:
+                raise
+            if limiter is not None:
+                limiter.on_throttle()
+            delay = policy.delay(attempt)
+            logger.warning(f"{method} {url} failed ({e}), retrying in {delay:.1f}s ({attempt + 1}/{attempts})")
+            time.sleep(delay)
+            continue
+
+        if response.status_code in policy.statuses and not is_last:
+            if limiter is not None:
+                limiter.on_throttle()
+            delay = policy.delay(attempt, response)
+            logger.warning(f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s ({attempt + 1}/{attempts})")
+            time.sleep(delay)
+            continue
+
+        if limiter is not None and response.status_code not in policy.statuses:
+            limiter.on_success()
+        return response
+
+    raise AssertionError("unreachable")  # the last attempt always returns or raises
@@ -0,0 +1,221 @@
+import fnmatch
+import re
+import tomllib
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from config import settings
+from log_config import logger
+from models import BitbucketRepo
+
+ACTIONS = ("Move", "Archive", "Ignore")
+
+# The rules used when no rules file exists, same as the former hard-coded behaviour
+DEFAULT_RULES: dict[str, Any] = {
+    "default_action": "Move",
+    "naming": {
+        "prefix": "",
+        "lowercase": True,
+        "replace": {"aiis": "ais", "_": "-"},
+        "cleanup": {" ": "-", "_": "-", ".": "-", "(": "", ")": ""},
+    },
+    "actions": {
+        "Archive": {
+            "names": ["my-repo1", "my-repo2"],
+            "template": "zArchive-ais-{name}",
+            "remove": ["ais-"],
+        },
+        "Ignore": {
+            "names": ["my-ignored-repo1", "my-ignored-repo2"],
+        },
+        "Move": {
+            "names": ["my-moved-repo1", "my-moved-repo2"],
+        },
+    },
+}
+
+
+def _check_action(action: str) -> str:
+    if action not in ACTIONS:
+        raise ValueError(f"Unknown action '{action}' in repository rules, expected one of {', '.join(ACTIONS)}")
+    return action
+
+
+@dataclass
+class Matcher:
+    """
+    Exact repository names in a dict and all globs/regexes folded into one regex with a
+    named group per rule, so matching a name costs one lookup plus one regex match.
+    """
+
+    names: dict[str, str] = field(default_factory=dict)
+    pattern: re.Pattern | None = None
+    group_actions: dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def compile(cls, actions: dict[str, dict]) -> "Matcher":
+        matcher = cls()
+        alternatives = []
+        for action, rule in actions.items():
+            _check_action(action)
+            for name in rule.get("names", []):
+                matcher.names.setdefault(name, action)
+            patterns = [fnmatch.translate(glob) for glob in rule.get("globs", [])] + list(rule.get("regexes", []))
+            for pattern in patterns:
+                re.compile(pattern)  # report an invalid pattern on its own rather than in the combined one
+                group = f"r{len(alternatives)}"
+                matcher.group_actions[group] = action
+                alternatives.append(f"(?P<{group}>{pattern})")
+        if alternatives:
+            matcher.pattern = re.compile("|".join(alternatives))
+        return matcher
+
+    def match(self, name: str) -> str | None:
+        if name in self.names:
+            return self.names[name]
+        if self.pattern is not None and (match := self.pattern.fullmatch(name)):
+            return self.group_actions[match.lastgroup]  # type: ignore
+        return None
+
+
+@dataclass
+class Naming:
+    """
+    How a new repository name is built: `replace` is applied to the original name,
+    then the action's template, then `lowercase` and the single-character `cleanup`.
+    """
+
+    prefix: str = ""
+    lowercase: bool = True
+    replace: dict[str, str] = field(default_factory=dict)
+    cleanup: dict[str, str] = field(default_factory=dict)
+    templates: dict[str, str] = field(default_factory=dict)
+    removes: dict[str, list[str]] = field(default_factory=dict)
+    _replace_pattern: re.Pattern | None = field(default=None, repr=False)
+    _cleanup_table: dict[int, str] = field(default_factory=dict, repr=False)
+
+    def __post_init__(self):
+        if self.replace:
+            # Longest first, so overlapping keys prefer the most specific one
+            keys = sorted(self.replace, key=len, reverse=True)
+            self._replace_pattern = re.compile("|".join(re.escape(key) for key in keys))
+        for char in self.cleanup:
+            if len(char) != 1:
+                raise ValueError(f"Naming cleanup keys must be single characters, got '{char}'")
+        self._cleanup_table = str.maketrans(self.cleanup)
+
+    @classmethod
+    def compile(cls, naming: dict, actions: dict[str, dict]) -> "Naming":
+        return cls(
+            prefix=naming.get("prefix", ""),
+            lowercase=naming.get("lowercase", True),
+            replace=dict(naming.get("replace", {})),
+            cleanup=dict(naming.get("cleanup", {})),
+            templates={action: rule["template"] for action, rule in actions.items() if "template" in rule},
+            removes={action: list(rule["remove"]) for action, rule in actions.items() if "remove" in rule},
+        )
+
+    def new_name(self, name: str, action: str, prefix: str = "") -> str:
+        if self._replace_pattern is not None:
+            name = self._replace_pattern.sub(lambda match: self.replace[match.group()], name)
+        for text in self.removes.get(action, []):
+            name = name.replace(text, "")
+
+        prefix = prefix or self.prefix
+        if "-" not in prefix and prefix:
+            prefix = f"{prefix}-"
+        name = self.templates.get(action, "{prefix}{name}").format(prefix=prefix, name=name)
+
+        if self.lowercase:
+            name = name.lower()
+        return name.translate(self._cleanup_table)
+
+
+@dataclass
+class RuleSet:
+    matcher: Matcher
+    naming: Naming
+    default_action: str = "Move"
+
+    @classmethod
+    def compile(cls, rules: dict, parent: "RuleSet | None" = None) -> "RuleSet":
+        """
+        Compile one rules table. A project override starts from its parent's naming and
+        default action and only changes what it defines.
+        """
+        actions = rules.get("actions", {})
+        naming = rules.get("naming", {})
+        if parent is not None:
+            base = parent.naming
+            naming = {
+                "prefix": base.prefix,
+                "lowercase": base.lowercase,
+                "replace": base.replace,
+                "cleanup": base.cleanup,
+                **naming,
+            }
+            naming_actions: dict[str, dict] = {action: {"template": template} for action, template in base.templates.items()}
+            for action, remove in base.removes.items():
+                naming_actions.setdefault(action, {})["remove"] = remove
+            for action, rule in actions.items():
+                naming_actions.setdefault(action, {}).update({key: rule[key] for key in ("template", "remove") if key in rule})
+        else:
+            naming_actions = actions
+
+        return cls(
+            matcher=Matcher.compile(actions),
+            naming=Naming.compile(naming, naming_actions),
+            default_action=_check_action(rules.get("default_action", parent.default_action if parent else "Move")),
+        )
+
+
+@dataclass
+class RepositoryRules:
+    """
+    Decides the action (Move, Archive or Ignore) and the new name of every repository.
+
+    Rules of the repository's Bitbucket project, when there are any, are tried before
+    the global ones; within a rule set exact names win over globs and regexes.
+    """
+
+    default: RuleSet
+    projects: dict[str, RuleSet] = field(default_factory=dict)
+
+    @classmethod
+    def compile(cls, rules: dict) -> "RepositoryRules":
+        default = RuleSet.compile(rules)
+        projects = {key.upper(): RuleSet.compile(project_rules, parent=default) for key, project_rules in rules.get("projects", {}).items()}
+        return cls(default=default, projects=projects)
+
+    def classify(self, repo: BitbucketRepo, prefix: str = "") -> tuple[str, str]:
+        """
+        Return the action and the new name of the repository (empty when ignored).
+        """
+        project_rules = self.projects.get(repo.project_key.upper())
+        action = None
+        if project_rules is not None:
+            action = project_rules.matcher.match(repo.name)
+        ruleset = project_rules or self.default
+        if action is None:
+            action = self.default.matcher.match(repo.name) or ruleset.default_action
+
+        if action == "Ignore":
+            return action, ""
+        return action, ruleset.naming.new_name(repo.name, action, prefix)
+
+
+def load_rules(path: str | Path | None = None) -> RepositoryRules:
+    """
+    Load and compile the repository rules file, falling back to the built-in rules when it does not exist.
+    """
+    path = Path(path or settings.REPOSITORY_RULES_FILE)
+    if not path.exists():
+        logger.debug(f"No rules file at {path}, using the built-in repository rules")
+        return RepositoryRules.compile(DEFAULT_RULES)
+
+    with open(path, "rb") as f:
+        rules = tomllib.load(f)
+    compiled = RepositoryRules.compile(rules)
+    logger.info(f"Loaded repository rules from {path} ({len(compiled.projects)} project overrides)")
+    return compiled
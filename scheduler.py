@@ -0,0 +1,215 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import Counter
+from typing import Callable, Iterable
+
+from config import settings
+from http_client import log_pool_stats
+from log_config import logger
+from metrics import export_metrics, metrics
+from migration_poller import MigrationPoller
+from models import BitbucketRepo, MigrationResult, MigrationStatus
+from state_store import FINISHED_STATUSES, MigrationStateStore
+from targets import MigrationTarget
+
+
+class SizeAwareQueue:
+    """
+    Work queue handing out repositories with a size-aware policy.
+
+    With the "largest-first" policy (longest processing time first, which keeps the
+    makespan close to optimal) the biggest repositories start as early as possible,
+    while at most `max_heavy` heavy ones (large or LFS-enabled) run at the same time
+    and the small ones fill the remaining workers. The "csv" policy keeps file order
+    but still enforces the heavy cap.
+
+    Repositories can be put while workers are already consuming; `close()` tells the
+    workers that nothing more is coming.
+    """
+
+    def __init__(
+        self,
+        policy: str | None = None,
+        heavy_threshold: int | None = None,
+        max_heavy: int | None = None,
+    ):
+        self.policy = policy or settings.MIGRATION_SCHEDULE
+        self.heavy_threshold = heavy_threshold if heavy_threshold is not None else settings.MIGRATION_HEAVY_SIZE_MB * 1024 * 1024
+        self.max_heavy = max(1, max_heavy or settings.MIGRATION_MAX_HEAVY)
+        self.heavy_running = 0
+        self._heavy: list[tuple[int, int, BitbucketRepo]] = []
+        self._light: list[tuple[int, int, BitbucketRepo]] = []
+        self._counter = itertools.count()
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def is_heavy(self, repo: BitbucketRepo) -> bool:
+        return repo.lfs or repo.size >= self.heavy_threshold
+
+    def put(self, repo: BitbucketRepo):
+        priority = -repo.size if self.policy == "largest-first" else 0
+        with self._condition:
+            heapq.heappush(self._heavy if self.is_heavy(repo) else self._light, (priority, next(self._counter), repo))
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._heavy) + len(self._light)
+
+    def get(self) -> BitbucketRepo | None:
+        """
+        Block until a repository may start, or return None once the queue is closed and drained.
+        """
+        with self._condition:
+            while True:
+                heavy_allowed = self._heavy and self.heavy_running < self.max_heavy
+                if heavy_allowed and (not self._light or self._heavy[0][:2] <= self._light[0][:2]):
+                    self.heavy_running += 1
+                    return heapq.heappop(self._heavy)[2]
+                if self._light:
+                    return heapq.heappop(self._light)[2]
+                if self._closed and not self._heavy:
+                    return None
+                self._condition.wait()
+
+    def task_done(self, repo: BitbucketRepo):
+        if self.is_heavy(repo):
+            with self._condition:
+                self.heavy_running -= 1
+                self._condition.notify_all()
+
+
+def run_workers(queue: SizeAwareQueue, workers: int, process: Callable[[BitbucketRepo], None]):
+    """
+    Run `process` on every repository of the queue with the given number of worker threads.
+
+    `process` is responsible for calling `queue.task_done(repo)` once the repository is
+    finished, which may happen later than its return (e.g. for polled migrations).
+    """
+
+    def worker():
+        while (repo := queue.get()) is not None:
+            try:
+                process(repo)
+            except Exception as e:
+                logger.exception(f"Unexpected error while processing {repo.project}/{repo.name}: {e}")
+
+    threads = [threading.Thread(target=worker, name=f"worker-{idx}", daemon=True) for idx in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_migration(target: MigrationTarget, repositories: Iterable[BitbucketRepo], state: MigrationStateStore):
+    """
+    Migrate the repositories to the target, recording each outcome in the state store.
+
+    Repositories already finished in a previous run are skipped without any call to the
+    target, those left in progress or failed are migrated again with `replace_existing`.
+    `repositories` is consumed by a feeder thread while the workers are already
+    migrating, so a lazily read CSV file starts migrating before it is fully parsed.
+    """
+    previous = state.statuses()
+    with metrics.span(f"{target.name}.prepare"):
+        target.prepare()
+
+    total_repos = 0
+    workers = max(1, target.concurrency)
+    queue = SizeAwareQueue()
+    feed_errors: list[Exception] = []
+
+    def feed():
+        nonlocal total_repos
+        finished = 0
+        plan: Counter[str] = Counter()
+        try:
+            for repo in repositories:
+                if previous.get(target.key(repo)) in FINISHED_STATUSES:
+                    finished += 1
+                    continue
+                plan[target.plan(repo)] += 1
+                total_repos += 1
+                queue.put(repo)
+        except Exception as e:
+            # Let the workers drain what was queued, the error is raised once they are done
+            logger.error(f"Failed to read the repositories to migrate: {e}")
+            feed_errors.append(e)
+            return
+        finally:
+            queue.close()
+
+        if finished:
+            logger.info(f"Resuming: {finished} repositories already finished in a previous run")
+        logger.info(f"Plan: {', '.join(f'{count} {what}' for what, count in plan.items()) or 'nothing to do'}")
+
+    started_at = time.monotonic()
+    counter = itertools.count(1)
+    done_counter = itertools.count(1)
+
+    def record(repo: BitbucketRepo, result: MigrationResult, duration: float):
+        state.finish(target.key(repo), result.status, duration, result.http_status, result.error)
+        metrics.observe(f"{target.name}.repository", duration, error=result.status not in FINISHED_STATUSES)
+        queue.task_done(repo)
+        log_progress(next(done_counter), total_repos, started_at)
+
+    poller = MigrationPoller(target, on_finished=record) if target.asynchronous else None
+
+    def migrate_one(repo: BitbucketRepo):
+        key = target.key(repo)
+        logger.info(f"{next(counter)}/{total_repos} Migrating: {repo.project} - {repo.name} - {repo.link} ({repo.size / 1024 / 1024:.0f} MB)")
+        if poller:
+            poller.acquire()
+        state.start(key)
+        repo_started_at = time.monotonic()
+        try:
+            if previous.get(key) == MigrationStatus.LFS_INCOMPLETE:
+                result = target.finish_lfs(repo)
+            else:
+                result = target.migrate(repo, replace_existing=key in previous)
+        except Exception as e:
+            if poller:
+                poller.release()
+            record(repo, MigrationResult(MigrationStatus.FAILED, error=str(e)), time.monotonic() - repo_started_at)
+            raise
+
+        if poller and result.status == MigrationStatus.IN_PROGRESS:
+            poller.track(repo, repo_started_at)
+            return
+        if poller:
+            poller.release()
+        record(repo, result, time.monotonic() - repo_started_at)
+
+    logger.info(f"Migrating to {target.name} with {workers} workers ({queue.policy} schedule, at most {queue.max_heavy} heavy at once)")
+    feeder = threading.Thread(target=feed, name="feeder", daemon=True)
+    feeder.start()
+    run_workers(queue, workers, migrate_one)
+    feeder.join()
+    if poller:
+        poller.join()
+    if feed_errors:
+        raise feed_errors[0]
+
+    elapsed = time.monotonic() - started_at
+    rate = total_repos / elapsed if elapsed else 0.0
+    logger.info(f"Processed {total_repos} repositories in {elapsed:.1f}s ({rate * 60:.1f} repos/min, {workers} workers)")
+    logger.info(f"Migration state: {state.summary()}")
+    log_pool_stats()
+    export_metrics()
+
+
+def log_progress(done: int, total: int, started_at: float):
+    """
+    Log the throughput so far and the estimated time until all repositories are processed.
+    """
+    elapsed = time.monotonic() - started_at
+    rate = done / elapsed if elapsed else 0.0
+    eta = (total - done) / rate if rate else 0.0
+    logger.info(f"Progress: {done}/{total} done, {rate * 60:.1f} repos/min, ETA {eta / 60:.1f} min")
@@ -0,0 +1,115 @@
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from log_config import logger
+from models import MigrationStatus
+
+# Repositories in these states need no further work on a rerun
+FINISHED_STATUSES = {MigrationStatus.DONE, MigrationStatus.SKIPPED}
+
+
+@dataclass
+class MigrationRecord:
+    key: str
+    status: MigrationStatus
+    attempts: int
+    duration: float
+    http_status: int | None
+    error: str
+    updated_at: float
+
+
+class MigrationStateStore:
+    """
+    SQLite database recording the outcome of every repository migration.
+
+    Keys are "{org}/{repo}" as created in the target. A row left `in_progress`
+    means the process died mid-migration, so the target may hold a partial copy.
+    """
+
+    def __init__(self, path: Path | str, read_only: bool = False):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        if read_only:
+            # For inspection only: no journal mode switch, no schema, any write fails
+            self._conn = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False, isolation_level=None)
+            return
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS migrations (
+                key TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                duration REAL NOT NULL DEFAULT 0,
+                http_status INTEGER,
+                error TEXT NOT NULL DEFAULT '',
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+
+    def get(self, key: str) -> MigrationRecord | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT key, status, attempts, duration, http_status, error, updated_at FROM migrations WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return MigrationRecord(row[0], MigrationStatus(row[1]), *row[2:])
+
+    def statuses(self) -> dict[str, MigrationStatus]:
+        with self._lock:
+            rows = self._conn.execute("SELECT key, status FROM migrations").fetchall()
+        return {key: MigrationStatus(status) for key, status in rows}
+
+    def start(self, key: str):
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO migrations (key, status, attempts, updated_at) VALUES (?, ?, 1, ?)
+                ON CONFLICT(key) DO UPDATE SET status = excluded.status, attempts = attempts + 1, updated_at = excluded.updated_at
+                """,
+                (key, MigrationStatus.IN_PROGRESS, time.time()),
+            )
+
+    def finish(self, key: str, status: MigrationStatus, duration: float, http_status: int | None = None, error: str = ""):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE migrations SET status = ?, duration = ?, http_status = ?, error = ?, updated_at = ? WHERE key = ?",
+                (status, duration, http_status, error, time.time(), key),
+            )
+
+    def invalidate(self, keys: list[str], error: str):
+        """
+        Mark these repositories failed, so the next run migrates them again over their current copy.
+        """
+        with self._lock:
+            self._conn.executemany(
+                """
+                INSERT INTO migrations (key, status, error, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET status = excluded.status, error = excluded.error, updated_at = excluded.updated_at
+                """,
+                [(key, MigrationStatus.FAILED, error, time.time()) for key in keys],
+            )
+
+    def forget(self, keys: list[str]):
+        """
+        Drop the records of these repositories, so the next run migrates them as new.
+        """
+        with self._lock:
+            self._conn.executemany("DELETE FROM migrations WHERE key = ?", [(key,) for key in keys])
+
+    def summary(self) -> dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM migrations GROUP BY status").fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        logger.debug(f"Closed migration state store {self.path}")
@@ -0,0 +1,303 @@
+"""
+Keep the Gitea copies up to date from Bitbucket Server push webhooks.
+
+    uv run sync_daemon.py
+
+Add a webhook to the Bitbucket projects (or repositories) pointing at
+http://<host>:SYNC_WEBHOOK_PORT/webhook with the "Repository: Push" event
+(repo:refs_changed), and the same secret as SYNC_WEBHOOK_SECRET. Only the pushed
+repositories are synced, a burst of pushes to one repository results in a single sync.
+"""
+
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import signal
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from catalogue import Catalogue
+from config import settings
+from gitea_migrate import CSV_REPOSITORIES, gitea_git_auth_header
+from gitea_sync import mirror_sync
+from log_config import logger
+from metrics import export_metrics, metrics, span
+from mirror_cache import MirrorCache, get_mirror_cache
+from models import BitbucketRepo
+
+REFS_CHANGED_EVENT = "repo:refs_changed"
+PING_EVENT = "diagnostics:ping"
+
+
+@dataclass
+class PendingSync:
+    repo: BitbucketRepo
+    first_seen: float
+    due: float
+    events: int = 1
+
+
+class CoalescingQueue:
+    """
+    Debounced queue of repositories to sync, at most one entry per repository.
+
+    A repository becomes due `debounce` seconds after its last event, but never later
+    than `max_delay` seconds after its first one, so a repository pushed to continuously
+    is still synced regularly. An event for a repository that is being synced queues it
+    again once that sync is done, so the last push is never missed.
+    """
+
+    def __init__(self, debounce: float | None = None, max_delay: float | None = None):
+        self.debounce = settings.SYNC_DEBOUNCE_SECONDS if debounce is None else debounce
+        self.max_delay = max(self.debounce, settings.SYNC_MAX_DELAY_SECONDS if max_delay is None else max_delay)
+        self.received = 0
+        self.coalesced = 0
+        self._pending: dict[str, PendingSync] = {}
+        self._running: set[str] = set()
+        self._deferred: dict[str, PendingSync] = {}  # events received while running
+        self._heap: list[tuple[float, int, str]] = []
+        self._counter = itertools.count()
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def put(self, key: str, repo: BitbucketRepo):
+        now = time.monotonic()
+        with self._condition:
+            self.received += 1
+            pending = self._deferred if key in self._running else self._pending
+            entry = pending.get(key)
+            if entry is None:
+                pending[key] = entry = PendingSync(repo, first_seen=now, due=now + self.debounce)
+            else:
+                self.coalesced += 1
+                entry.events += 1
+                entry.due = min(now + self.debounce, entry.first_seen + self.max_delay)
+            if pending is self._pending:
+                heapq.heappush(self._heap, (entry.due, next(self._counter), key))
+                self._condition.notify()
+
+    def get(self) -> tuple[str, PendingSync] | None:
+        """
+        Block until a repository is due, or return None once the queue is closed.
+        """
+        with self._condition:
+            while not self._closed:
+                # Drop heap entries superseded by a later event
+                while self._heap and (self._heap[0][2] not in self._pending or self._pending[self._heap[0][2]].due != self._heap[0][0]):
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                wait = self._heap[0][0] - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                _, _, key = heapq.heappop(self._heap)
+                self._running.add(key)
+                return key, self._pending.pop(key)
+            return None
+
+    def done(self, key: str):
+        with self._condition:
+            self._running.discard(key)
+            if (entry := self._deferred.pop(key, None)) is not None:
+                self._pending[key] = entry
+                heapq.heappush(self._heap, (entry.due, next(self._counter), key))
+                self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def stats(self) -> dict[str, int]:
+        with self._condition:
+            return {
+                "received": self.received,
+                "coalesced": self.coalesced,
+                "pending": len(self._pending) + len(self._deferred),
+                "running": len(self._running),
+            }
+
+
+class RepositoryLookup:
+    """
+    The CSV rows by Bitbucket project key and slug, through the catalogue, reopened when
+    the file changes.
+    """
+
+    def __init__(self, csv_file: Path):
+        self.csv_file = csv_file
+        self._mtime = 0.0
+        self._catalogue: Catalogue | None = None
+        self._lock = threading.Lock()
+
+    def get(self, project_key: str, slug: str) -> BitbucketRepo | None:
+        with self._lock:
+            mtime = self.csv_file.stat().st_mtime
+            if self._catalogue is None or mtime != self._mtime:
+                if self._catalogue is not None:
+                    self._catalogue.close()
+                self._catalogue = Catalogue.open(self.csv_file)
+                self._mtime = mtime
+                logger.info(f"Loaded {len(self._catalogue)} repositories from {self.csv_file}")
+            return self._catalogue.by_slug(project_key, slug)
+
+
+def verify_signature(secret: str, body: bytes, signature: str | None) -> bool:
+    """
+    Check Bitbucket's X-Hub-Signature header ("sha256=<hex HMAC of the body>").
+    """
+    if not signature or not signature.startswith("sha256="):
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature.removeprefix("sha256="))
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    server: "WebhookServer"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+    def reply(self, status: int, body: dict | None = None):
+        data = json.dumps(body or {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self.reply(404)
+        self.reply(200, self.server.sync_daemon.queue.stats())
+
+    def do_POST(self):
+        if self.path != settings.SYNC_WEBHOOK_PATH:
+            return self.reply(404)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if settings.SYNC_WEBHOOK_SECRET and not verify_signature(settings.SYNC_WEBHOOK_SECRET, body, self.headers.get("X-Hub-Signature")):
+            logger.warning(f"Rejected a webhook with an invalid signature from {self.address_string()}")
+            return self.reply(401, {"error": "invalid signature"})
+        try:
+            event = json.loads(body)
+        except json.JSONDecodeError:
+            return self.reply(400, {"error": "invalid JSON"})
+
+        event_key = self.headers.get("X-Event-Key") or event.get("eventKey", "")
+        if event_key == PING_EVENT:
+            return self.reply(200)
+        if event_key != REFS_CHANGED_EVENT:
+            return self.reply(202, {"ignored": event_key})
+        self.reply(202, {"queued": self.server.sync_daemon.enqueue(event)})
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, sync_daemon: "SyncDaemon", host: str, port: int):
+        super().__init__((host, port), WebhookHandler)
+        self.sync_daemon = sync_daemon
+
+
+class SyncDaemon:
+    """
+    Webhook receiver feeding a coalescing queue, drained by SYNC_CONCURRENCY workers.
+
+    Pull mirrors are synced through Gitea's mirror-sync. Plain repositories are pushed
+    to from the mirror cache, so without GITEA_SET_AS_MIRROR the cache must be enabled.
+    """
+
+    def __init__(self, csv_file: Path = CSV_REPOSITORIES, host: str | None = None, port: int | None = None, mirror_cache: MirrorCache | None = None):
+        self.mirror_cache = None if settings.GITEA_SET_AS_MIRROR else (mirror_cache or get_mirror_cache())
+        if not settings.GITEA_SET_AS_MIRROR and self.mirror_cache is None:
+            # mirror-sync would fail on every repository, they are not pull mirrors
+            raise ValueError("Nothing can sync the Gitea repositories: enable MIRROR_CACHE_ENABLED, or GITEA_SET_AS_MIRROR if they are pull mirrors")
+        self.lookup = RepositoryLookup(csv_file)
+        self.queue = CoalescingQueue()
+        self.server = WebhookServer(self, host or settings.SYNC_WEBHOOK_HOST, settings.SYNC_WEBHOOK_PORT if port is None else port)
+        self.synced = 0
+        self.failed = 0
+        self._stats_lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def enqueue(self, event: dict) -> bool:
+        """
+        Queue the repository of a refs_changed event, returning whether it is one we migrated.
+        """
+        repository = event.get("repository") or {}
+        project_key = (repository.get("project") or {}).get("key", "")
+        repo = self.lookup.get(project_key, repository.get("slug", ""))
+        if repo is None:
+            logger.debug(f"Ignoring a push to {project_key}/{repository.get('slug')}, it is not in {self.lookup.csv_file}")
+            return False
+        logger.debug(f"Push to {repo.project}/{repo.newname} ({len(event.get('changes', []))} refs changed)")
+        self.queue.put(f"{repo.project}/{repo.newname}", repo)
+        return True
+
+    def sync(self, repo: BitbucketRepo) -> bool:
+        if self.mirror_cache is not None:
+            error = self.mirror_cache.push(repo, f"{settings.GITEA_URL.rstrip('/')}/{repo.project}/{repo.newname}.git", gitea_git_auth_header())
+            if error:
+                logger.error(f"Failed to push {repo.project}/{repo.newname} to Gitea: {error}")
+            return error is None
+        return mirror_sync(repo.project, repo.newname)
+
+    def _work(self):
+        while (item := self.queue.get()) is not None:
+            key, pending = item
+            try:
+                with span("sync.repository") as sync_span:
+                    sync_span.error = not self.sync(pending.repo)
+            except Exception as e:
+                logger.exception(f"Unexpected error while syncing {key}: {e}")
+                sync_span.error = True
+            finally:
+                self.queue.done(key)
+            # Time from the first push to the end of the sync
+            metrics.observe("sync.propagation", time.monotonic() - pending.first_seen, sync_span.error)
+            with self._stats_lock:
+                self.synced += int(not sync_span.error)
+                self.failed += int(sync_span.error)
+            logger.info(f"Synced {key} ({pending.events} pushes coalesced)" if not sync_span.error else f"Sync of {key} failed")
+
+    def start(self) -> "SyncDaemon":
+        workers = [threading.Thread(target=self._work, name=f"sync-{idx}", daemon=True) for idx in range(max(1, settings.SYNC_CONCURRENCY))]
+        server = threading.Thread(target=self.server.serve_forever, name="webhook-server", daemon=True)
+        self._threads = [*workers, server]
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"Listening for Bitbucket webhooks on {self.url}{settings.SYNC_WEBHOOK_PATH} ({len(workers)} sync workers)")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        stats = self.queue.stats()
+        self.queue.close()
+        for thread in self._threads:
+            thread.join()
+        if stats["pending"]:
+            logger.warning(f"Stopped with {stats['pending']} repositories still waiting to be synced")
+        logger.info(f"Synced {self.synced} repositories ({self.failed} failed) for {stats['received']} webhooks, {stats['coalesced']} coalesced")
+
+
+if __name__ == "__main__":
+    daemon = SyncDaemon().start()
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopping.set())
+    stopping.wait()
+    daemon.stop()
+    export_metrics()
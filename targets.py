@@ -0,0 +1,85 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+from config import settings
+from log_config import logger
+from metrics import span
+from mirror_cache import mirror_repository
+from models import BitbucketRepo, MigrationResult, MigrationStatus, TrackedMigration
+
+
+class MigrationTarget(ABC):
+    """
+    A destination repositories are migrated to, driven by `scheduler.run_migration`.
+
+    `migrate` handles one repository. An asynchronous target may return IN_PROGRESS, the
+    repository is then tracked and handed to `poll` until it reports a final result.
+    """
+
+    name: str = ""
+    asynchronous: bool = False
+    poll_interval: float = 10.0
+
+    @property
+    def concurrency(self) -> int:
+        return settings.MIGRATION_CONCURRENCY
+
+    def key(self, repo: BitbucketRepo) -> str:
+        """
+        Key of the repository in the migration state store.
+        """
+        return f"{self.name}:{repo.project}/{repo.newname}"
+
+    def prepare(self):
+        """
+        Fetch whatever the target needs once before the first repository is migrated.
+        """
+
+    def plan(self, repo: BitbucketRepo) -> str:
+        """
+        Short description of what will happen to the repository, counted for the plan log.
+        """
+        return "to migrate"
+
+    @abstractmethod
+    def migrate(self, repo: BitbucketRepo, replace_existing: bool = False) -> MigrationResult: ...
+
+    def finish_lfs(self, repo: BitbucketRepo) -> MigrationResult:
+        """
+        Copy the LFS objects a previous run left missing (LFS_INCOMPLETE). Targets without
+        an LFS stage migrate the repository again over its copy.
+        """
+        return self.migrate(repo, replace_existing=True)
+
+    def poll(self, tracked: list[TrackedMigration]) -> dict[str, MigrationResult]:
+        """
+        Check the tracked migrations, returning the results of those that finished by key.
+        """
+        return {}
+
+
+class LocalMirrorTarget(MigrationTarget):
+    """
+    Bare mirrors on local disk (LOCAL_MIRROR_DIR/{project}/{newname}.git): a first run
+    does `git clone --mirror`, later runs `git fetch --prune` the existing mirror.
+    """
+
+    name = "local"
+
+    def __init__(self, root: str | Path | None = None):
+        self.root = Path(root or settings.LOCAL_MIRROR_DIR)
+
+    def path(self, repo: BitbucketRepo) -> Path:
+        return self.root / repo.project / f"{repo.newname}.git"
+
+    def migrate(self, repo: BitbucketRepo, replace_existing: bool = False) -> MigrationResult:
+        path = self.path(repo)
+        with span("local.mirror") as mirror_span:
+            error = mirror_repository(repo.link, path)
+            mirror_span.error = error is not None
+        if error:
+            logger.error(f"Failed to mirror {repo.link}: {error}")
+            return MigrationResult(MigrationStatus.FAILED, error=error)
+
+        logger.success(f"Local mirror of {repo.name} is up to date: {path}")
+        return MigrationResult(MigrationStatus.DONE)
@@ -0,0 +1,82 @@
+"""
+Cached repository listings against the fake server, whose listing pages carry their own ETag.
+"""
+
+import pytest
+
+import bitbucket_repos
+from config import settings
+from fake_server import FakeServer, FakeServerConfig
+from inventory_cache import InventoryCache
+from models import BitbucketProject
+
+
+@pytest.fixture
+def bitbucket(monkeypatch):
+    server = FakeServer(FakeServerConfig(projects=2, repos_per_project=0, bitbucket_page_limit=10)).start()
+    monkeypatch.setattr(settings, "BITBUCKET_URL", server.url)
+    monkeypatch.setattr(settings, "BITBUCKET_PAGE_LIMIT", 10)
+    monkeypatch.setattr(bitbucket_repos, "BITBUCKET_PROJECTS_API_URL", f"{server.url}/rest/api/1.0/projects")
+    yield server
+    server.stop()
+
+
+def add_repos(server: FakeServer, key: str, count: int):
+    repos = server.state.repos[key]
+    for _ in range(count):
+        repo_id = sum(len(project_repos) for project_repos in server.state.repos.values()) + 1000
+        slug = f"repo-{repo_id:05d}"
+        repos.append({"id": repo_id, "slug": slug, "name": slug, "description": "", "links": {"clone": [{"name": "http", "href": f"{server.url}/scm/{key.lower()}/{slug}.git"}]}})
+
+
+def list_slugs(server: FakeServer, cache: InventoryCache) -> dict[str, list[str]]:
+    projects = [BitbucketProject(key=project["key"], id=project["id"], name=project["name"], link="") for project in server.state.projects]
+    return {key: sorted(repo.slug for repo in repos) for key, repos in bitbucket_repos.iter_all_repositories(projects, cache)}
+
+
+def expected_slugs(server: FakeServer) -> dict[str, list[str]]:
+    return {key: sorted(repo["slug"] for repo in repos) for key, repos in server.state.repos.items()}
+
+
+def test_repositories_added_past_the_first_page_are_listed(bitbucket, tmp_path):
+    small, large = (project["key"] for project in bitbucket.state.projects)
+    add_repos(bitbucket, small, 4)
+    add_repos(bitbucket, large, 25)
+    cache = InventoryCache(tmp_path / "cache.json")
+    assert list_slugs(bitbucket, cache) == expected_slugs(bitbucket)
+
+    # The large project's first page is unchanged, only its last page grows
+    add_repos(bitbucket, large, 1)
+    assert list_slugs(bitbucket, cache) == expected_slugs(bitbucket)
+    assert len(cache.repositories(large)) == 26
+
+
+def test_single_page_projects_are_served_from_the_cache_on_304(bitbucket, tmp_path):
+    small, large = (project["key"] for project in bitbucket.state.projects)
+    add_repos(bitbucket, small, 4)
+    add_repos(bitbucket, large, 25)
+    cache = InventoryCache(tmp_path / "cache.json")
+    list_slugs(bitbucket, cache)
+    assert cache.validators(small) and not cache.validators(large)
+
+    bitbucket.state.calls.clear()
+    assert list_slugs(bitbucket, cache) == expected_slugs(bitbucket)
+    # One 304 for the small project, three full pages for the large one
+    assert bitbucket.state.calls[("GET", "/rest/api/1.0/projects/{key}/repos")] == 4
+
+
+def test_failed_size_requests_are_retried(bitbucket):
+    key = bitbucket.state.projects[0]["key"]
+    add_repos(bitbucket, key, 2)
+    for repo in bitbucket.state.repos[key]:
+        repo.update(size=(repo["id"] + 1) * 1024, lfs=True)
+    repos = [bitbucket_repos.parse_repository(BitbucketProject(key=key, id=0, name="Project 0", link=""), repo) for repo in bitbucket.state.repos[key]]
+    # Both answers of the first wave and the first retry are 503
+    bitbucket.state.failures[("GET", "/projects/{key}/repos/{slug}/sizes")] = 3
+    bitbucket.state.failures[("GET", "/rest/git-lfs/admin/projects/{key}/repos/{slug}/enabled")] = 1
+
+    bitbucket_repos.fetch_repository_sizes(repos)
+
+    assert [repo.size for repo in repos] == [repo["size"] for repo in bitbucket.state.repos[key]]
+    assert all(repo.lfs for repo in repos)
+    assert bitbucket.state.calls[("GET", "/projects/{key}/repos/{slug}/sizes")] == 5
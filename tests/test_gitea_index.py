@@ -0,0 +1,35 @@
+"""
+Paginated Gitea listings against the fake server, which caps the page size like Gitea's MAX_RESPONSE_ITEMS.
+"""
+
+import pytest
+
+from config import settings
+from fake_server import FakeServer, FakeServerConfig
+from gitea_index import list_all_pages
+
+
+@pytest.fixture
+def gitea():
+    server = FakeServer(FakeServerConfig(gitea_page_limit=10)).start()
+    yield server
+    server.stop()
+
+
+@pytest.mark.parametrize("orgs", [0, 7, 10, 35, 50])
+def test_pages_past_a_server_side_cap_are_all_fetched(gitea, monkeypatch, orgs):
+    # Asking for more per page than the server hands out
+    monkeypatch.setattr(settings, "GITEA_PAGE_LIMIT", 50)
+    gitea.state.gitea_orgs.update(f"org-{idx:03d}" for idx in range(orgs))
+
+    listed = [org["username"] for org in list_all_pages(f"{gitea.url}/api/v1/orgs", {})]
+
+    assert sorted(listed) == sorted(gitea.state.gitea_orgs)
+
+
+def test_page_limit_below_the_cap_is_used_as_is(gitea, monkeypatch):
+    monkeypatch.setattr(settings, "GITEA_PAGE_LIMIT", 4)
+    gitea.state.gitea_orgs.update(f"org-{idx:03d}" for idx in range(9))
+
+    assert len(list_all_pages(f"{gitea.url}/api/v1/orgs", {})) == 9
+    assert gitea.state.calls[("GET", "/api/v1/orgs")] == 3
@@ -0,0 +1,51 @@
+"""
+Polling of asynchronous Gitea migrations against the fake server.
+"""
+
+import time
+
+import pytest
+
+import gitea_migrate
+from config import settings
+from fake_server import FakeServer, FakeServerConfig
+from models import BitbucketRepo, MigrationStatus, TrackedMigration
+
+
+@pytest.fixture
+def gitea(monkeypatch):
+    server = FakeServer(FakeServerConfig(projects=0)).start()
+    monkeypatch.setattr(settings, "GITEA_API_URL", f"{server.url}/api/v1")
+    monkeypatch.setitem(gitea_migrate.HEADERS, "Authorization", "token fake")
+    yield server
+    server.stop()
+
+
+def tracked(name: str) -> TrackedMigration:
+    repo = BitbucketRepo("org", "Org", name, name, f"https://bitbucket.example/scm/org/{name}.git", "", "Migrate")
+    return TrackedMigration(repo=repo, key=f"org/{name}", started_at=time.monotonic())
+
+
+def test_migration_is_done_once_gitea_stops_reporting_it_as_being_migrated(gitea):
+    target = gitea_migrate.GiteaTarget(asynchronous=True)
+    migration = tracked("repo")
+    gitea.state.gitea_repos.add("org/repo")
+    gitea.state.gitea_migrating.add("org/repo")
+
+    # Git data is in, releases and LFS objects are still being copied
+    assert target.poll([migration]) == {}
+    assert migration.seen
+
+    gitea.state.gitea_migrating.clear()
+    assert target.poll([migration])["org/repo"].status == MigrationStatus.DONE
+
+
+def test_migration_deleted_by_gitea_after_being_seen_failed(gitea):
+    target = gitea_migrate.GiteaTarget(asynchronous=True)
+    migration = tracked("repo")
+    gitea.state.gitea_repos.add("org/repo")
+    gitea.state.gitea_migrating.add("org/repo")
+    assert target.poll([migration]) == {}
+
+    gitea.state.gitea_repos.clear()
+    assert target.poll([migration])["org/repo"].status == MigrationStatus.FAILED
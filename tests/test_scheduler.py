@@ -0,0 +1,51 @@
+"""
+Dequeue order of the size-aware queue.
+"""
+
+from models import BitbucketRepo
+from scheduler import SizeAwareQueue
+
+MB = 1024 * 1024
+
+
+def repo(name: str, size_mb: int, lfs: bool = False) -> BitbucketRepo:
+    return BitbucketRepo("org", "Org", name, name, f"https://bitbucket.example/scm/org/{name}.git", "", "Migrate", size=size_mb * MB, lfs=lfs)
+
+
+def drain(queue: SizeAwareQueue) -> list[str]:
+    queue.close()
+    names = []
+    while (item := queue.get()) is not None:
+        names.append(item.name)
+        queue.task_done(item)
+    return names
+
+
+def test_largest_first_hands_out_the_biggest_repositories_first():
+    queue = SizeAwareQueue("largest-first", heavy_threshold=100 * MB, max_heavy=2)
+    for name, size in [("small", 1), ("huge", 900), ("medium", 50), ("large", 300), ("tiny", 0), ("big", 90)]:
+        queue.put(repo(name, size))
+
+    assert drain(queue) == ["huge", "large", "big", "medium", "small", "tiny"]
+
+
+def test_csv_policy_keeps_file_order():
+    queue = SizeAwareQueue("csv", heavy_threshold=100 * MB, max_heavy=2)
+    for name, size in [("small", 1), ("huge", 900), ("medium", 50)]:
+        queue.put(repo(name, size))
+
+    assert drain(queue) == ["small", "huge", "medium"]
+
+
+def test_heavy_repositories_wait_for_a_slot_while_light_ones_fill_the_workers():
+    queue = SizeAwareQueue("largest-first", heavy_threshold=100 * MB, max_heavy=1)
+    for item in [repo("huge", 900), repo("large", 300), repo("lfs", 1, lfs=True), repo("small", 1)]:
+        queue.put(item)
+
+    first = queue.get()
+    assert first.name == "huge"
+    # The only heavy slot is taken: the light repository goes next, then nothing until it frees up
+    assert queue.get().name == "small"
+    assert len(queue) == 2
+    queue.task_done(first)
+    assert queue.get().name == "large"
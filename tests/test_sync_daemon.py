@@ -0,0 +1,123 @@
+"""
+The webhook daemon driven end to end by fake_webhook.py, with the syncs recorded instead of sent to Gitea.
+"""
+
+import csv
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+import sync_daemon
+from bitbucket_repos import CSV_FIELDNAMES
+from config import settings
+from fake_webhook import refs_changed_event, send_event, send_events
+from gitea_migrate import read_repositories
+from http_client import get_session
+from sync_daemon import SyncDaemon
+
+SECRET = "webhook-secret"
+
+
+class RecordingCache:
+    """
+    Stands in for the mirror cache: records the pushes instead of running git.
+    """
+
+    def __init__(self):
+        self.pushes: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    def push(self, repo, remote_url: str, auth_header: str | None = None) -> str | None:
+        with self._lock:
+            self.pushes[f"{repo.project}/{repo.newname}"] += 1
+        return None
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    path = tmp_path / "bitbucket_repos.csv"
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_FIELDNAMES)
+        for idx in range(5):
+            writer.writerow(["org", "Org", f"repo-{idx}", f"new-{idx}", f"https://bitbucket.example.com/scm/prj/repo-{idx}.git", "", "Move", 0, False])
+    return path
+
+
+@pytest.fixture(autouse=True)
+def fast_settings(monkeypatch):
+    monkeypatch.setattr(settings, "SYNC_DEBOUNCE_SECONDS", 0.3)
+    monkeypatch.setattr(settings, "SYNC_MAX_DELAY_SECONDS", 5.0)
+    monkeypatch.setattr(settings, "SYNC_CONCURRENCY", 2)
+    monkeypatch.setattr(settings, "SYNC_WEBHOOK_SECRET", SECRET)
+    monkeypatch.setattr(settings, "GITEA_SET_AS_MIRROR", False)
+    monkeypatch.setattr(settings, "MIRROR_CACHE_ENABLED", False)
+
+
+def wait_until_idle(daemon: SyncDaemon, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = daemon.queue.stats()
+        if not stats["pending"] and not stats["running"]:
+            return
+        time.sleep(0.05)
+    raise AssertionError(f"The daemon did not go idle: {daemon.queue.stats()}")
+
+
+def test_pushes_are_coalesced_into_one_sync_per_repository(csv_file):
+    cache = RecordingCache()
+    daemon = SyncDaemon(csv_file, host="127.0.0.1", port=0, mirror_cache=cache).start()  # type: ignore[arg-type]
+    try:
+        repos = read_repositories(csv_file)[:3]
+        pushes = send_events(f"{daemon.url}{settings.SYNC_WEBHOOK_PATH}", repos, events=60, rate=0, secret=SECRET)
+        wait_until_idle(daemon)
+    finally:
+        daemon.stop()
+
+    assert set(cache.pushes) == set(pushes)
+    # A burst sent within the debounce window becomes one sync (two if a sync started mid-burst)
+    assert all(count <= 2 for count in cache.pushes.values()), cache.pushes
+    assert daemon.queue.received == 60
+    assert daemon.failed == 0
+
+
+def test_unknown_repositories_and_bad_signatures_are_not_synced(csv_file):
+    cache = RecordingCache()
+    daemon = SyncDaemon(csv_file, host="127.0.0.1", port=0, mirror_cache=cache).start()  # type: ignore[arg-type]
+    url = f"{daemon.url}{settings.SYNC_WEBHOOK_PATH}"
+    try:
+        session = get_session(url)
+        repo = read_repositories(csv_file)[0]
+        assert send_event(session, url, refs_changed_event(repo), secret="wrong").status_code == 401
+
+        unknown = refs_changed_event(repo)
+        unknown["repository"]["slug"] = "not-in-the-csv"
+        response = send_event(session, url, unknown, SECRET)
+        assert response.status_code == 202
+        assert response.json() == {"queued": False}
+        wait_until_idle(daemon)
+    finally:
+        daemon.stop()
+
+    assert not cache.pushes
+
+
+def test_mirrors_are_synced_through_gitea(csv_file, monkeypatch):
+    monkeypatch.setattr(settings, "GITEA_SET_AS_MIRROR", True)
+    synced: list[str] = []
+    monkeypatch.setattr(sync_daemon, "mirror_sync", lambda owner, name: synced.append(f"{owner}/{name}") or True)
+    daemon = SyncDaemon(csv_file, host="127.0.0.1", port=0).start()
+    try:
+        send_events(f"{daemon.url}{settings.SYNC_WEBHOOK_PATH}", read_repositories(csv_file)[:1], events=5, rate=0, secret=SECRET)
+        wait_until_idle(daemon)
+    finally:
+        daemon.stop()
+
+    assert synced == ["org/new-0"]
+
+
+def test_refuses_to_start_without_mirrors_or_mirror_cache(csv_file):
+    with pytest.raises(ValueError, match="MIRROR_CACHE_ENABLED"):
+        SyncDaemon(csv_file, host="127.0.0.1", port=0)
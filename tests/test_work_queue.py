@@ -0,0 +1,104 @@
+"""
+Several runners sharing one SQLite work queue, each through its own connection like separate processes.
+"""
+
+import threading
+import time
+
+import pytest
+
+from config import settings
+from models import BitbucketRepo, MigrationResult, MigrationStatus
+from targets import MigrationTarget
+from work_queue import QueueRunner, SQLiteWorkQueue
+
+
+def make_repos(count: int) -> list[BitbucketRepo]:
+    return [BitbucketRepo("org", "Org", f"repo-{idx:03d}", f"repo-{idx:03d}", f"https://bitbucket.example/scm/org/repo-{idx:03d}.git", "", "Migrate", size=idx) for idx in range(count)]
+
+
+class RecordingTarget(MigrationTarget):
+    name = "test"
+
+    def __init__(self):
+        self.migrated: list[tuple[str, bool]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def concurrency(self) -> int:
+        return 2
+
+    def migrate(self, repo: BitbucketRepo, replace_existing: bool = False) -> MigrationResult:
+        with self._lock:
+            self.migrated.append((repo.newname, replace_existing))
+        return MigrationResult(MigrationStatus.DONE)
+
+
+@pytest.fixture
+def queue_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "MIGRATION_SCHEDULE", "fifo")
+    path = tmp_path / "work_queue.db"
+    SQLiteWorkQueue(path).add(make_repos(3))
+    return path
+
+
+def test_expired_lease_is_reclaimed_by_another_runner(queue_path):
+    first, second = SQLiteWorkQueue(queue_path, lease_seconds=0.2), SQLiteWorkQueue(queue_path, lease_seconds=60)
+    claimed = first.claim("first", 1)
+    assert [item.attempts for item in claimed] == [1]
+    # Still leased: the other runner gets the remaining repositories only
+    assert [item.key for item in second.claim("second", 3)] == ["org/repo-001", "org/repo-002"]
+
+    time.sleep(0.3)
+    reclaimed = second.claim("second", 3)
+    assert [(item.key, item.attempts) for item in reclaimed] == [(claimed[0].key, 2)]
+
+    # The first runner finds out it lost the lease and cannot complete it any more
+    assert first.heartbeat("first", [claimed[0].key]) == [claimed[0].key]
+    assert not first.complete("first", claimed[0].key, MigrationStatus.DONE)
+    assert second.complete("second", claimed[0].key, MigrationStatus.DONE)
+
+
+def test_repository_whose_every_lease_expired_fails(queue_path):
+    queue = SQLiteWorkQueue(queue_path, lease_seconds=0.05, max_attempts=2)
+    for _ in range(2):
+        assert queue.claim("runner", 1)[0].key == "org/repo-000"
+        time.sleep(0.1)
+
+    assert "org/repo-000" not in [item.key for item in queue.claim("runner", 3)]
+    assert queue.failures() == [("org/repo-000", "lease expired 2 times")]
+
+
+def test_racing_runners_never_claim_the_same_repository(tmp_path):
+    path = tmp_path / "work_queue.db"
+    SQLiteWorkQueue(path).add(make_repos(200))
+    queues = [SQLiteWorkQueue(path), SQLiteWorkQueue(path)]
+    claims: list[list[str]] = [[], []]
+    start = threading.Barrier(2)
+
+    def claim_all(idx: int):
+        start.wait()
+        while items := queues[idx].claim(f"runner-{idx}", 3):
+            claims[idx] += [item.key for item in items]
+            time.sleep(0.001)  # give the other runner a chance at the lock
+
+    threads = [threading.Thread(target=claim_all, args=(idx,)) for idx in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert claims[0] and claims[1]
+    assert sorted(claims[0] + claims[1]) == sorted(f"org/repo-{idx:03d}" for idx in range(200))
+
+
+def test_restarted_runner_releases_the_leases_of_its_previous_run(queue_path, tmp_path):
+    # A run that died holding a lease nobody renews, under a lease far longer than the test
+    crashed = SQLiteWorkQueue(queue_path, lease_seconds=3600)
+    stale = crashed.claim("runner", 1)[0]
+
+    target = RecordingTarget()
+    QueueRunner(SQLiteWorkQueue(queue_path, lease_seconds=3600), target, runner_id="runner", state_db=str(tmp_path / "state.db")).run()
+
+    assert crashed.stats()["done"] == 3
+    assert stale.repo.newname in [name for name, _ in target.migrated]
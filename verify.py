@@ -0,0 +1,221 @@
+"""
+Verify that every migrated repository has the same branch and tag heads in Gitea as in Bitbucket.
+
+    uv run verify.py [--csv bitbucket_repos.csv] [--resync]
+
+The Gitea index (one paginated listing) tells which repositories exist, the refs of those
+are then compared VERIFY_CONCURRENCY repositories at a time over the shared HTTP pools.
+Writes a report with the status of every repository (VERIFY_REPORT_FILE) and the CSV rows
+of those that do not match (VERIFY_RESYNC_CSV), in the bitbucket_repos.csv format.
+"""
+
+import argparse
+import csv
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from enum import StrEnum
+from pathlib import Path
+
+from bitbucket_repos import CSV_FIELDNAMES
+from config import settings
+from gitea_index import GiteaIndex, build_gitea_index
+from gitea_migrate import CSV_REPOSITORIES, HEADERS, GiteaTarget, iter_repositories
+from gitea_sync import RefComparison, compare_refs, mirror_sync
+from http_client import log_pool_stats
+from log_config import logger
+from metrics import export_metrics, span
+from models import BitbucketRepo
+from scheduler import log_progress, run_migration
+from state_store import MigrationStateStore
+
+
+class VerifyStatus(StrEnum):
+    OK = "ok"
+    MISMATCH = "mismatch"
+    MISSING = "missing"  # not in Gitea at all
+    ERROR = "error"  # the refs could not be listed
+
+
+@dataclass
+class Verification:
+    repo: BitbucketRepo
+    status: VerifyStatus
+    mirror: bool = False
+    comparison: RefComparison | None = None
+
+    @property
+    def key(self) -> str:
+        return f"{self.repo.project}/{self.repo.newname}"
+
+    @property
+    def gitea_ahead(self) -> bool:
+        """
+        Gitea only has refs that Bitbucket does not, e.g. work pushed to Gitea after the cutover.
+        """
+        comparison = self.comparison
+        return self.status == VerifyStatus.MISMATCH and comparison is not None and not (comparison.missing or comparison.different)
+
+    def as_dict(self) -> dict:
+        entry: dict = {"key": self.key, "status": self.status}
+        if self.gitea_ahead:
+            entry["gitea_ahead"] = True
+        if self.comparison is not None and self.status != VerifyStatus.OK:
+            entry |= {
+                "missing": self.comparison.missing,
+                "extra": self.comparison.extra,
+                "different": self.comparison.different,
+                "error": self.comparison.error,
+            }
+        return entry
+
+
+@dataclass
+class VerifyReport:
+    created_at: str
+    gitea_url: str
+    elapsed_s: float = 0.0
+    verifications: list[Verification] = field(default_factory=list)
+
+    def summary(self) -> dict[str, int]:
+        counts = Counter(verification.status for verification in self.verifications)
+        return {status.value: counts[status] for status in VerifyStatus}
+
+    def failed(self) -> list[Verification]:
+        return [verification for verification in self.verifications if verification.status != VerifyStatus.OK]
+
+    def save(self, path: Path):
+        data = {
+            "created_at": self.created_at,
+            "gitea_url": self.gitea_url,
+            "elapsed_s": round(self.elapsed_s, 3),
+            "summary": self.summary(),
+            "repositories": [verification.as_dict() for verification in self.verifications],
+        }
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        tmp_path.write_text(json.dumps(data, indent=2))
+        tmp_path.replace(path)
+
+    def save_resync_csv(self, path: Path) -> int:
+        """
+        Write the rows that do not match, to be fed back to the migration or the planner.
+        """
+        failed = self.failed()
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_FIELDNAMES)
+            for verification in failed:
+                repo = verification.repo
+                writer.writerow([repo.project, repo.projectname, repo.name, repo.newname, repo.link, repo.description, repo.action, repo.size, repo.lfs])
+        os.replace(tmp_path, path)
+        return len(failed)
+
+
+def verify_repository(repo: BitbucketRepo, index: GiteaIndex) -> Verification:
+    gitea_repo = index.get_repo(repo.project, repo.newname)
+    if gitea_repo is None:
+        return Verification(repo, VerifyStatus.MISSING)
+    with span("verify.repository") as verify_span:
+        comparison = compare_refs(repo)
+        verify_span.error = bool(comparison.error)
+    if comparison.error:
+        status = VerifyStatus.ERROR
+    else:
+        status = VerifyStatus.OK if comparison.in_sync else VerifyStatus.MISMATCH
+    return Verification(repo, status, gitea_repo.mirror, comparison)
+
+
+def verify_repositories(csv_file: Path) -> VerifyReport:
+    """
+    Compare the refs of every CSV row with its Gitea copy, in one concurrent pass.
+    """
+    started_at = time.monotonic()
+    report = VerifyReport(created_at=datetime.now(timezone.utc).isoformat(), gitea_url=settings.GITEA_URL)
+    index = build_gitea_index(HEADERS)
+    repositories = list(iter_repositories(csv_file))
+    logger.info(f"Verifying the refs of {len(repositories)} repositories, {settings.VERIFY_CONCURRENCY} at a time")
+
+    every = max(1, len(repositories) // 20)
+    with ThreadPoolExecutor(max_workers=max(1, settings.VERIFY_CONCURRENCY), thread_name_prefix="verify") as executor:
+        futures = [executor.submit(verify_repository, repo, index) for repo in repositories]
+        for done, future in enumerate(as_completed(futures), 1):
+            verification = future.result()
+            report.verifications.append(verification)
+            if verification.status == VerifyStatus.MISSING:
+                logger.warning(f"Missing in Gitea: {verification.key}")
+            elif verification.status != VerifyStatus.OK:
+                logger.warning(f"{verification.status.capitalize()}: {verification.comparison}")
+            if done % every == 0 or done == len(repositories):
+                log_progress(done, len(repositories), started_at)
+
+    report.verifications.sort(key=lambda verification: verification.key)
+    report.elapsed_s = time.monotonic() - started_at
+    rate = len(repositories) / report.elapsed_s if report.elapsed_s else 0.0
+    logger.info(f"Verified {len(repositories)} repositories in {report.elapsed_s:.1f}s ({rate:.1f} repos/s): {report.summary()}")
+    log_pool_stats()
+    return report
+
+
+def resync(report: VerifyReport, state: MigrationStateStore | None = None):
+    """
+    Bring the repositories that do not match up to date: mismatched mirrors get a
+    mirror-sync, missing repositories are migrated, and those behind Bitbucket are
+    migrated again (replacing the Gitea copy) through the scheduler. Repositories only
+    ahead in Gitea are left alone, replacing them would lose the refs pushed there.
+    """
+    mirrors: list[BitbucketRepo] = []
+    missing: list[BitbucketRepo] = []
+    replacements: list[BitbucketRepo] = []
+    for verification in report.failed():
+        if verification.status == VerifyStatus.ERROR:
+            continue  # unknown state, verify again rather than replace
+        if verification.status == VerifyStatus.MISSING:
+            missing.append(verification.repo)
+        elif verification.mirror:
+            mirrors.append(verification.repo)
+        elif verification.gitea_ahead:
+            logger.warning(f"Not replacing {verification.key}, it only has refs that are not in Bitbucket: {', '.join(verification.comparison.extra)}")  # type: ignore
+        else:
+            replacements.append(verification.repo)
+
+    if mirrors:
+        logger.info(f"Syncing {len(mirrors)} mirrors")
+        with ThreadPoolExecutor(max_workers=max(1, settings.SYNC_CONCURRENCY), thread_name_prefix="sync") as executor:
+            list(executor.map(lambda repo: mirror_sync(repo.project, repo.newname), mirrors))
+    if missing or replacements:
+        state = state or MigrationStateStore(settings.MIGRATION_STATE_DB)
+        target = GiteaTarget()
+        target.required_organizations = {repo.project: repo.projectname for repo in missing + replacements}
+        # Missing ones are migrated as new, even if a previous run recorded them as done
+        state.forget([target.key(repo) for repo in missing])
+        # Marked failed, so the scheduler replaces the existing copies instead of skipping them
+        state.invalidate([target.key(repo) for repo in replacements], "refs differ from Bitbucket")
+        logger.info(f"Migrating {len(missing)} missing repositories and replacing {len(replacements)} behind Bitbucket")
+        run_migration(target, missing + replacements, state)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--csv", type=Path, default=CSV_REPOSITORIES)
+    parser.add_argument("--report", type=Path, default=Path(settings.VERIFY_REPORT_FILE))
+    parser.add_argument("--resync-csv", type=Path, default=Path(settings.VERIFY_RESYNC_CSV))
+    parser.add_argument("--resync", action="store_true", help="sync or migrate again the repositories that do not match")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = verify_repositories(args.csv)
+    report.save(args.report)
+    resync_rows = report.save_resync_csv(args.resync_csv)
+    logger.info(f"Wrote the verification report to {args.report} and {resync_rows} rows to re-sync to {args.resync_csv}")
+    if args.resync and resync_rows:
+        resync(report)
+    else:
+        export_metrics()
+    exit(0 if not resync_rows else 1)
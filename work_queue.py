@@ -0,0 +1,475 @@
+"""
+Spread one migration over several runner processes or machines through a shared work queue.
+
+    uv run work_queue.py load [--csv bitbucket_repos.csv]
+    uv run work_queue.py run [--runner-id ID]
+    uv run work_queue.py status
+    uv run work_queue.py requeue-failed
+
+`load` fills the queue from the CSV once (rows already queued are left alone). Every
+`run` then claims batches of repositories under an expiring lease, renews the leases of
+the repositories it is migrating and marks them done or failed. The leases of a runner
+that dies expire after WORK_QUEUE_LEASE_SECONDS and its repositories are claimed again by
+the others, which replace whatever partial copy it left.
+
+The SQLite backend (WORK_QUEUE_DB) needs a file all runners can lock: a local disk for
+several runners on one machine, or a shared file system with working POSIX locks.
+Leases are compared to the wall clock, so keep the lease well above the clock skew
+between machines.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from enum import StrEnum
+from pathlib import Path
+from typing import Callable
+
+from config import settings
+from gitea_migrate import CSV_REPOSITORIES, TARGETS, GiteaTarget, collect_organizations, iter_repositories
+from log_config import logger
+from models import BitbucketRepo, MigrationResult, MigrationStatus
+from scheduler import run_migration
+from state_store import FINISHED_STATUSES, MigrationStateStore
+from targets import MigrationTarget, TrackedMigration
+
+
+class WorkStatus(StrEnum):
+    PENDING = "pending"
+    LEASED = "leased"
+    DONE = "done"
+    FAILED = "failed"
+
+
+@dataclass
+class WorkItem:
+    key: str  # "{org}/{repo}" as created in the target
+    repo: BitbucketRepo
+    attempts: int  # claims so far, including this one
+
+
+def work_key(repo: BitbucketRepo) -> str:
+    return f"{repo.project}/{repo.newname}"
+
+
+class WorkQueue(ABC):
+    """
+    Repositories shared between runners. A claimed repository is leased to one runner
+    until it completes it, or until its lease expires without a heartbeat and any runner
+    may claim it again.
+    """
+
+    def __init__(self, lease_seconds: float | None = None, max_attempts: int | None = None):
+        self.lease_seconds = lease_seconds or settings.WORK_QUEUE_LEASE_SECONDS
+        self.max_attempts = max(1, max_attempts or settings.WORK_QUEUE_MAX_ATTEMPTS)
+
+    @abstractmethod
+    def add(self, repos: Iterable[BitbucketRepo]) -> int:
+        """
+        Queue the repositories that are not queued yet, returning how many were added.
+        """
+
+    @abstractmethod
+    def claim(self, runner: str, limit: int) -> list[WorkItem]:
+        """
+        Lease up to `limit` pending (or abandoned) repositories to the runner, largest
+        first with the "largest-first" schedule.
+        """
+
+    @abstractmethod
+    def heartbeat(self, runner: str, keys: list[str]) -> list[str]:
+        """
+        Extend the runner's leases, returning the keys it no longer holds.
+        """
+
+    @abstractmethod
+    def complete(self, runner: str, key: str, status: MigrationStatus, error: str = "") -> bool:
+        """
+        Record the outcome of a leased repository. False when the runner lost the lease.
+        """
+
+    @abstractmethod
+    def release(self, runner: str, keys: list[str]):
+        """
+        Hand leased repositories back to the queue, e.g. when a runner is stopped.
+        """
+
+    @abstractmethod
+    def leased_to(self, runner: str) -> list[str]:
+        """
+        Keys of the repositories currently leased to the runner.
+        """
+
+    @abstractmethod
+    def has_work(self, runner: str) -> bool:
+        """
+        Whether anything may still be claimed: pending repositories, or leases of other
+        runners that could expire.
+        """
+
+    @abstractmethod
+    def requeue_failed(self) -> int: ...
+
+    @abstractmethod
+    def repositories(self) -> Iterator[BitbucketRepo]: ...
+
+    @abstractmethod
+    def failures(self) -> list[tuple[str, str]]:
+        """
+        Key and error of every failed repository.
+        """
+
+    @abstractmethod
+    def stats(self) -> dict[str, int]: ...
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """
+    Work queue in a SQLite database. Claims run in `BEGIN IMMEDIATE` transactions, so
+    the database lock serializes them between processes and no repository is leased
+    twice.
+    """
+
+    def __init__(self, path: Path | str, lease_seconds: float | None = None, max_attempts: int | None = None):
+        super().__init__(lease_seconds, max_attempts)
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS work_items (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL UNIQUE,
+                repo TEXT NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL,
+                runner TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT NOT NULL DEFAULT '',
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS work_items_status ON work_items (status, lease_expires)")
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def add(self, repos: Iterable[BitbucketRepo]) -> int:
+        now = time.time()
+        rows = [(work_key(repo), json.dumps(asdict(repo)), repo.size, WorkStatus.PENDING, now) for repo in repos]
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO work_items (key, repo, size, status, updated_at) VALUES (?, ?, ?, ?, ?)", rows)
+            return conn.total_changes - before
+
+    def claim(self, runner: str, limit: int) -> list[WorkItem]:
+        now = time.time()
+        order = "size DESC, seq" if settings.MIGRATION_SCHEDULE == "largest-first" else "seq"
+        with self._transaction() as conn:
+            # Repositories whose every lease expired are not handed out forever
+            conn.execute(
+                "UPDATE work_items SET status = ?, runner = NULL, lease_expires = NULL, error = ?, updated_at = ? "
+                "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (WorkStatus.FAILED, f"lease expired {self.max_attempts} times", now, WorkStatus.LEASED, now, self.max_attempts),
+            )
+            rows = conn.execute(
+                f"SELECT seq, key, repo, attempts, runner FROM work_items "
+                f"WHERE status = ? OR (status = ? AND lease_expires < ?) ORDER BY {order} LIMIT ?",
+                (WorkStatus.PENDING, WorkStatus.LEASED, now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE work_items SET status = ?, runner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? WHERE seq = ?",
+                [(WorkStatus.LEASED, runner, now + self.lease_seconds, now, row[0]) for row in rows],
+            )
+        for _, key, _, _, previous_runner in rows:
+            if previous_runner and previous_runner != runner:
+                logger.warning(f"Reclaimed {key} from runner {previous_runner}, its lease expired")
+        return [WorkItem(key, BitbucketRepo(**json.loads(repo)), attempts + 1) for _, key, repo, attempts, _ in rows]
+
+    def heartbeat(self, runner: str, keys: list[str]) -> list[str]:
+        now = time.time()
+        lost: list[str] = []
+        with self._transaction() as conn:
+            for key in keys:
+                cursor = conn.execute(
+                    "UPDATE work_items SET lease_expires = ?, updated_at = ? WHERE key = ? AND runner = ? AND status = ?",
+                    (now + self.lease_seconds, now, key, runner, WorkStatus.LEASED),
+                )
+                if not cursor.rowcount:
+                    lost.append(key)
+        return lost
+
+    def complete(self, runner: str, key: str, status: MigrationStatus, error: str = "") -> bool:
+        work_status = WorkStatus.DONE if status in FINISHED_STATUSES else WorkStatus.FAILED
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE work_items SET status = ?, lease_expires = NULL, error = ?, updated_at = ? WHERE key = ? AND runner = ? AND status = ?",
+                (work_status, error, time.time(), key, runner, WorkStatus.LEASED),
+            )
+            return cursor.rowcount == 1
+
+    def release(self, runner: str, keys: list[str]):
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE work_items SET status = ?, runner = NULL, lease_expires = NULL, updated_at = ? WHERE key = ? AND runner = ? AND status = ?",
+                [(WorkStatus.PENDING, time.time(), key, runner, WorkStatus.LEASED) for key in keys],
+            )
+
+    def leased_to(self, runner: str) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT key FROM work_items WHERE status = ? AND runner = ? ORDER BY seq", (WorkStatus.LEASED, runner)).fetchall()
+        return [key for (key,) in rows]
+
+    def has_work(self, runner: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM work_items WHERE status = ? OR (status = ? AND runner != ?) LIMIT 1",
+                (WorkStatus.PENDING, WorkStatus.LEASED, runner),
+            ).fetchone()
+        return row is not None
+
+    def requeue_failed(self) -> int:
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE work_items SET status = ?, runner = NULL, attempts = 0, error = '', updated_at = ? WHERE status = ?",
+                (WorkStatus.PENDING, time.time(), WorkStatus.FAILED),
+            )
+            return cursor.rowcount
+
+    def repositories(self) -> Iterator[BitbucketRepo]:
+        with self._lock:
+            rows = self._conn.execute("SELECT repo FROM work_items ORDER BY seq").fetchall()
+        return (BitbucketRepo(**json.loads(repo)) for (repo,) in rows)
+
+    def failures(self) -> list[tuple[str, str]]:
+        with self._lock:
+            return self._conn.execute("SELECT key, error FROM work_items WHERE status = ? ORDER BY seq", (WorkStatus.FAILED,)).fetchall()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM work_items GROUP BY status").fetchall()
+        return {status.value: 0 for status in WorkStatus} | dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        logger.debug(f"Closed work queue {self.path}")
+
+
+WORK_QUEUE_BACKENDS: dict[str, Callable[[], WorkQueue]] = {
+    "sqlite": lambda: SQLiteWorkQueue(settings.WORK_QUEUE_DB),
+}
+
+
+def get_work_queue() -> WorkQueue:
+    if settings.WORK_QUEUE_BACKEND not in WORK_QUEUE_BACKENDS:
+        raise ValueError(f"Unknown WORK_QUEUE_BACKEND '{settings.WORK_QUEUE_BACKEND}', expected one of {', '.join(WORK_QUEUE_BACKENDS)}")
+    return WORK_QUEUE_BACKENDS[settings.WORK_QUEUE_BACKEND]()
+
+
+class LeasedStateStore(MigrationStateStore):
+    """
+    The runner's local state store, also reporting every finished repository so its
+    lease is completed in the shared queue.
+    """
+
+    def __init__(self, path: Path | str, on_finished: Callable[[str, MigrationStatus, str], None]):
+        super().__init__(path)
+        self.on_finished = on_finished
+
+    def finish(self, key: str, status: MigrationStatus, duration: float, http_status: int | None = None, error: str = ""):
+        super().finish(key, status, duration, http_status, error)
+        self.on_finished(key, status, error)
+
+
+class LeasedTarget(MigrationTarget):
+    """
+    The target as a runner sees it: a repository claimed for the second time was
+    abandoned by a runner that may have left a partial copy, so it is replaced.
+    """
+
+    def __init__(self, target: MigrationTarget, reclaimed: Callable[[str], bool]):
+        self.target = target
+        self.reclaimed = reclaimed
+        self.name = target.name
+        self.asynchronous = target.asynchronous
+        self.poll_interval = target.poll_interval
+
+    @property
+    def concurrency(self) -> int:
+        return self.target.concurrency
+
+    def key(self, repo: BitbucketRepo) -> str:
+        return self.target.key(repo)
+
+    def prepare(self):
+        self.target.prepare()
+
+    def plan(self, repo: BitbucketRepo) -> str:
+        return self.target.plan(repo)
+
+    def migrate(self, repo: BitbucketRepo, replace_existing: bool = False) -> MigrationResult:
+        return self.target.migrate(repo, replace_existing or self.reclaimed(self.key(repo)))
+
+    def finish_lfs(self, repo: BitbucketRepo) -> MigrationResult:
+        return self.target.finish_lfs(repo)
+
+    def poll(self, tracked: list[TrackedMigration]) -> dict[str, MigrationResult]:
+        return self.target.poll(tracked)
+
+
+class QueueRunner:
+    """
+    Feeds the scheduler with repositories claimed from the queue until it is drained.
+
+    Only about as many repositories as the runner can work on are leased at a time
+    (its workers and in-flight migrations, plus one batch ahead), so the queue stays
+    available to the other runners and throughput grows with their number.
+    """
+
+    def __init__(self, queue: WorkQueue, target: MigrationTarget, runner_id: str | None = None, state_db: str | None = None, batch_size: int | None = None):
+        self.queue = queue
+        self.target = target
+        self.runner_id = runner_id or settings.WORK_QUEUE_RUNNER_ID or f"{socket.gethostname()}-{os.getpid()}"
+        self.state = LeasedStateStore(state_db or settings.MIGRATION_STATE_DB, self.finished)
+        self.batch_size = max(1, batch_size or settings.WORK_QUEUE_BATCH_SIZE)
+        capacity = target.concurrency + (settings.MIGRATION_MAX_IN_FLIGHT if target.asynchronous else 0)
+        self.prefetch = capacity + self.batch_size
+        self.completed = 0
+        self._leased: dict[str, WorkItem] = {}  # by state key
+        self._condition = threading.Condition()
+        self._stopping = threading.Event()
+
+    def reclaimed(self, key: str) -> bool:
+        with self._condition:
+            item = self._leased.get(key)
+        return item is not None and item.attempts > 1
+
+    def claimed(self) -> Iterator[BitbucketRepo]:
+        """
+        The repositories leased to this runner, claimed in batches as workers free up.
+        """
+        while not self._stopping.is_set():
+            with self._condition:
+                while len(self._leased) + self.batch_size > self.prefetch:
+                    self._condition.wait()
+            items = self.queue.claim(self.runner_id, self.batch_size)
+            if not items:
+                if not self.queue.has_work(self.runner_id):
+                    return
+                # Other runners still hold leases, one of them may expire
+                self._stopping.wait(min(30.0, self.queue.lease_seconds / 3))
+                continue
+
+            logger.debug(f"Claimed {len(items)} repositories")
+            for item in items:
+                key = self.target.key(item.repo)
+                record = self.state.get(key)
+                if record is not None and record.status in FINISHED_STATUSES:
+                    # Finished here before the runner could complete its lease; the scheduler would skip it
+                    self.queue.complete(self.runner_id, item.key, record.status, record.error)
+                    continue
+                with self._condition:
+                    self._leased[key] = item
+                yield item.repo
+
+    def finished(self, key: str, status: MigrationStatus, error: str):
+        with self._condition:
+            item = self._leased.pop(key, None)
+            self._condition.notify_all()
+        if item is None:
+            return
+        self.completed += 1
+        if not self.queue.complete(self.runner_id, item.key, status, error):
+            logger.warning(f"Lost the lease on {item.key} before it finished, another runner may have migrated it again")
+
+    def _heartbeat(self):
+        while not self._stopping.wait(self.queue.lease_seconds / 3):
+            with self._condition:
+                keys = [item.key for item in self._leased.values()]
+            if not keys:
+                continue
+            try:
+                lost = self.queue.heartbeat(self.runner_id, keys)
+            except Exception as e:
+                logger.error(f"Failed to renew {len(keys)} leases: {e}")
+                continue
+            for key in lost:
+                logger.warning(f"Lost the lease on {key}, it expired and may have been claimed by another runner")
+
+    def run(self):
+        logger.info(f"Runner {self.runner_id}: claiming batches of {self.batch_size}, at most {self.prefetch} leased at a time")
+        # Leases a previous run under the same runner id held when it died: nobody renews them
+        # and this runner would neither claim them nor wait for them
+        with self._condition:
+            held = {item.key for item in self._leased.values()}
+        stale = [key for key in self.queue.leased_to(self.runner_id) if key not in held]
+        if stale:
+            logger.warning(f"Releasing {len(stale)} repositories still leased to {self.runner_id} by a previous run")
+            self.queue.release(self.runner_id, stale)
+        heartbeat = threading.Thread(target=self._heartbeat, name="heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            run_migration(LeasedTarget(self.target, self.reclaimed), self.claimed(), self.state)
+        finally:
+            self._stopping.set()
+            with self._condition:
+                leftover = [item.key for item in self._leased.values()]
+            if leftover:
+                logger.warning(f"Releasing {len(leftover)} unfinished repositories back to the queue")
+                self.queue.release(self.runner_id, leftover)
+            heartbeat.join()
+        logger.info(f"Runner {self.runner_id} finished {self.completed} repositories, queue: {self.queue.stats()}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    load_parser = commands.add_parser("load", help="queue the repositories of the CSV")
+    load_parser.add_argument("--csv", type=Path, default=CSV_REPOSITORIES)
+    run_parser = commands.add_parser("run", help="migrate repositories from the queue until it is drained")
+    run_parser.add_argument("--runner-id", help="defaults to WORK_QUEUE_RUNNER_ID, or {hostname}-{pid}")
+    commands.add_parser("status", help="count the repositories per status")
+    commands.add_parser("requeue-failed", help="make the failed repositories pending again")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    queue = get_work_queue()
+    if args.command == "load":
+        added = queue.add(iter_repositories(args.csv))
+        logger.info(f"Queued {added} new repositories from {args.csv}: {queue.stats()}")
+    elif args.command == "run":
+        if settings.MIGRATION_TARGET not in TARGETS:
+            raise ValueError(f"Unknown MIGRATION_TARGET '{settings.MIGRATION_TARGET}', expected one of {', '.join(TARGETS)}")
+        target = TARGETS[settings.MIGRATION_TARGET]()
+        if isinstance(target, GiteaTarget):
+            # Every runner provisions all organizations, creating one that another runner just created is harmless
+            target.required_organizations = collect_organizations(queue.repositories())
+        QueueRunner(queue, target, args.runner_id).run()
+    elif args.command == "requeue-failed":
+        logger.info(f"Requeued {queue.requeue_failed()} failed repositories")
+    else:
+        logger.info(f"Work queue: {queue.stats()}")
+        for key, error in queue.failures():
+            logger.warning(f"Failed: {key}: {error}")